@@ -2,6 +2,9 @@
 
 # This bash script calls isbg for spam learning for all the mail
 # accounts in the provided list.
+#
+# Deprecated: isbg_accounts processes all the accounts of a ini file from
+# a single process, see isbg_accounts(1).
 
 declare -A usernames
 
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bench_get_formated_uids.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Benchmark of SpamAssassin.get_formated_uids.
+
+It simulates an incremental run: a mailbox with `n` uids where every uid
+but the newest 50 has been processed in the past. The past uids are given
+as a list (as the old trackfiles) and as a UidSet (as the new ones).
+
+The old implementation, that was O(n·m), is only run for small sizes.
+
+Usage::
+
+    $ python benchmarks/bench_get_formated_uids.py
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg.imaputils import UidSet  # noqa: E402
+from isbg.spamproc import SpamAssassin  # noqa: E402
+
+
+def old_get_formated_uids(uids, origpastuids, partialrun):
+    """Get the uids formated, as isbg <= 2.1.0."""
+    uids = sorted(uids[0].split(), key=int, reverse=True)
+    newpastuids = [u for u in origpastuids if str(u) in uids]
+    uids = [u for u in uids if int(u) not in newpastuids]
+    if partialrun:
+        uids = uids[:int(partialrun)]
+    return uids, newpastuids
+
+
+def bench(func, uids, origpastuids, number=3):
+    """Get the best time of `number` calls."""
+    return min(timeit.repeat(lambda: func(uids, origpastuids, 50),
+                             number=1, repeat=number))
+
+
+def main():
+    """Run the benchmark."""
+    print("{:>9} {:>12} {:>12} {:>12}".format("uids", "old (list)",
+                                              "new (list)", "new (UidSet)"))
+    for num in [10000, 100000, 1000000]:
+        uids = [' '.join(str(u) for u in range(1, num + 1))]
+        pastlist = list(range(1, num - 49))
+        pastset = UidSet.from_ranges([[1, num - 50]])
+        assert SpamAssassin.get_formated_uids(uids, pastlist, 50)[0] == \
+            SpamAssassin.get_formated_uids(uids, pastset, 50)[0]
+
+        old = "{:>11.3f}s".format(
+            bench(old_get_formated_uids, uids, pastlist, 1)) \
+            if num <= 10000 else "{:>12}".format("-")
+        print("{:>9} {} {:>11.3f}s {:>11.3f}s".format(
+            num, old,
+            bench(SpamAssassin.get_formated_uids, uids, pastlist),
+            bench(SpamAssassin.get_formated_uids, uids, pastset)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bench_sa_unwrap.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Benchmark of sa_unwrap.unwrap.
+
+It unwraps a message that is not a SpamAssassin report
+(``examples/spam.eml``) and a report (``examples/spam.from.spamassassin.eml``)
+as they are fetched by isbg, as a :py:class:`isbg.imaputils.RawMessage`. The
+old implementation always parses the message and walks its MIME tree.
+
+Usage::
+
+    $ python benchmarks/bench_sa_unwrap.py
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import sa_unwrap  # noqa: E402
+from isbg.imaputils import RawMessage  # noqa: E402
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), '..', 'examples')
+
+
+def old_unwrap(mail):
+    """Unwrap a RawMessage, parsing it always as isbg <= 2.1.0."""
+    return sa_unwrap.sa_unwrap_from_email(mail.message)
+
+
+def bench(func, raw, number=1000):
+    """Get the best time per call, with a new RawMessage every call."""
+    return min(timeit.repeat(lambda: func(RawMessage(raw)),
+                             number=number, repeat=3)) / number
+
+
+def main():
+    """Run the benchmark."""
+    print("{:<28} {:>12} {:>12}".format("message", "old", "new"))
+    for name in ['spam.eml', 'spam.from.spamassassin.eml']:
+        with open(os.path.join(EXAMPLES, name), 'rb') as fmail:
+            raw = fmail.read()
+        assert (old_unwrap(RawMessage(raw)) is None) == \
+            (sa_unwrap.unwrap(RawMessage(raw)) is None)
+        print("{:<28} {:>10.1f}us {:>10.1f}us".format(
+            name, bench(old_unwrap, raw) * 1e6,
+            bench(sa_unwrap.unwrap, raw) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
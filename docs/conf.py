@@ -277,6 +277,9 @@ man_pages = [
     ('manpage.isbg_sa_unwrap', 'isbg_sa_unwrap', u'unwraps a email bundeled ' +
      u'by SpamAssassin.',
      [author], 1),
+    ('manpage.isbg_accounts', 'isbg_accounts', u'runs isbg for several ' +
+     u'accounts.',
+     [author], 1),
 ]
 # -- Options for Texinfo output -------------------------------------------
 
@@ -76,6 +76,8 @@ Command line Options::
   --usage                Show the usage information.
   --version              Show the version information.
 
+  --daemon               Keep running, waiting for new messages with
+                         IMAP IDLE, until interrupted.
   --dryrun               Do not actually make any changes.
   --delete               The spams will be marked for deletion from
                          your inbox.
@@ -87,6 +89,8 @@ Command line Options::
   --flag                 The spams will be flagged in your inbox.
   --gmail                Delete by copying to '[Gmail]/Trash' folder.
   --ignorelockfile       Don't stop if lock file is present.
+  --imapcompress         Compress the IMAP connection (COMPRESS=DEFLATE)
+                         if the server supports it.
   --imappasswd passwd    IMAP account password.
   --imapport port        Use a custom port.
   --imapinbox mbox       Name of your inbox folder [Default: INBOX].
@@ -97,6 +101,10 @@ Command line Options::
   --learnunflagged       Only learn if unflagged
                          (for  --learnthenflag).
   --learnflagged         Only learn flagged.
+  --learnedindex         Store the fingerprints of the messages learned,
+                         and don't fetch nor learn them again.
+  --learnworkers num     Learn up to 'num' messages concurrently
+                         [default: 1].
   --lockfilegrace=<min>  Set the lifetime of the lock file
                          [default: 240.0].
   --lockfilename file    Override the lock file name.
@@ -112,13 +120,38 @@ Command line Options::
                          [default: 50].
   --passwdfilename fn    Use a file to supply the password.
   --savepw               Store the password to be used in future runs.
+  --scankeyword kw       Mark the messages processed with the IMAP
+                         keyword kw (e.g. $IsbgScanned) and only process
+                         the ones without it, instead of using the
+                         trackfile for the inbox.
   --spamc                Use spamc instead of standalone SpamAssassin
                          binary.
+  --singlepass           Score and get the SpamAssassin report of
+                         the messages in only one pass.
+  --spamd address        Use the native spamd client connecting to
+                         address (host[:port] or a unix socket path)
+                         instead of spamc or SpamAssassin.
+  --spamheadersmaxage s  Max age in seconds of the messages whose
+                         stamp is trusted [default: 3600].
   --spaminbox mbox       Name of your spam folder
                          [Default: INBOX.spam].
   --nossl                Don't use SSL to connect to the IMAP server.
   --teachonly            Don't search spam, just learn from folders.
   --trackfile file       Override the trackfile name.
+  --trustspamheaders mta
+                         Trust the X-Spam-Status headers stamped by
+                         SpamAssassin in the host mta, and don't scan
+                         again the messages with them.
+  --verdictcache         Store the verdicts in a cache shared by all the
+                         accounts, and don't scan again the messages
+                         found in it.
+  --verdictindex         Store the Message-ID and size of the messages
+                         processed in the trackfiles, and remap them to
+                         their new uids when the UIDVALIDITY changes.
+  --verdictttl secs      Seconds that a verdict of the cache is valid
+                         [default: 21600].
+  --workers num          Scan up to 'num' messages concurrently
+                         [default: 1].
   --verbose              Show IMAP stuff happening.
   --verbose-mails        Show mail bodies (extra-verbose).
 
@@ -127,12 +160,15 @@ Command line Options::
     """
 
 
-def parse_args(sbg):
+def parse_args(sbg, argv=None):
     """Argument processing of the command line.
 
     :param sbg: the `isbg.ISBG` instance which would be updated with the
                 parameters.
     :type sbg: isbg.ISBG
+    :param argv: the arguments to process instead of the command line ones
+                 (:py:data:`sys.argv`).
+    :type argv: list(str)
     :return: `None`
 
     :Example: You can run it using:
@@ -141,7 +177,7 @@ def parse_args(sbg):
         >>> parse_args(sbg)
     """
     try:
-        opts = docopt(__cmd_opts__.__doc__, version="isbg_v" +
+        opts = docopt(__cmd_opts__.__doc__, argv=argv, version="isbg_v" +
                       isbg.__version__ + ", from: " +
                       os.path.abspath(__file__) + "\n\n" + isbg.__license__)
         opts = dict([(k, v) for k, v in opts.items()
@@ -179,6 +215,8 @@ def parse_args(sbg):
     sbg.imapsets.learnspambox = opts.get('--learnspambox')
     sbg.imapsets.learnhambox = opts.get('--learnhambox')
     sbg.imapsets.nossl = opts.get('--nossl', sbg.imapsets.nossl)
+    sbg.imapsets.compress = opts.get('--imapcompress',
+                                     sbg.imapsets.compress)
 
     sbg.lockfilegrace = float(opts.get('--lockfilegrace', sbg.lockfilegrace))
 
@@ -224,6 +262,26 @@ def parse_args(sbg):
     elif sbg.partialrun == 0:
         sbg.partialrun = None
 
+    sbg.verdictcache = opts.get('--verdictcache', sbg.verdictcache)
+    sbg.verdictindex = opts.get('--verdictindex', sbg.verdictindex)
+
+    sbg.trustspamheaders = opts.get('--trustspamheaders',
+                                    sbg.trustspamheaders)
+    sbg.scankeyword = opts.get('--scankeyword', sbg.scankeyword)
+
+    for opt in ['workers', 'learnworkers', 'verdictttl',
+                'spamheadersmaxage']:
+        try:
+            setattr(sbg, opt, int(opts.get('--' + opt, getattr(sbg, opt))))
+        except ValueError:
+            raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                                 "{} \'{}\' must be a integer".format(
+                                 opt, opts["--" + opt]))
+        if getattr(sbg, opt) < 1:
+            raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                                 "{} \'{}\' must be 1 or higher".format(
+                                 opt, repr(getattr(sbg, opt))))
+
     sbg.verbose = opts.get('--verbose', sbg.verbose)
     sbg.verbose_mails = opts.get('--verbose-mails', sbg.verbose_mails)
     sbg.ignorelockfile = opts.get("--ignorelockfile", sbg.ignorelockfile)
@@ -234,12 +292,16 @@ def parse_args(sbg):
 
     sbg.learnunflagged = opts.get('--learnunflagged', sbg.learnunflagged)
     sbg.learnflagged = opts.get('--learnflagged', sbg.learnflagged)
+    sbg.learnedindex = opts.get('--learnedindex', sbg.learnedindex)
     sbg.learnthendestroy = opts.get('--learnthendestroy', sbg.learnthendestroy)
     sbg.learnthenflag = opts.get('--learnthendestroy', sbg.learnthenflag)
     sbg.expunge = opts.get('--expunge', sbg.expunge)
 
     sbg.teachonly = opts.get('--teachonly', sbg.teachonly)
+    sbg.daemon = opts.get('--daemon', sbg.daemon)
     sbg.spamc = opts.get('--spamc', sbg.spamc)
+    sbg.spamd = opts.get('--spamd', sbg.spamd)
+    sbg.singlepass = opts.get('--singlepass', sbg.singlepass)
 
     sbg.exitcodes = opts.get('--exitcodes', sbg.exitcodes)
 
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  accounts.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Process several IMAP accounts from a single process.
+
+The accounts are read from a ini file: every section is an account, and the
+keys are the isbg command line options without the leading ``--``. The
+values ``yes``, ``true`` and ``on`` set a flag, the values ``no``,
+``false`` and ``off`` are ignored, and any other value is used as the
+argument of the option. The ``[DEFAULT]`` section applies to all the
+accounts::
+
+    [DEFAULT]
+    imaphost = imap.example.org
+    spaminbox = INBOX.Spam
+    delete = yes
+    expunge = yes
+    noninteractive = yes
+
+    [user1]
+    imapuser = user1
+    imappasswd = passwd1
+
+    [user2]
+    imapuser = user2
+    passwdfilename = /etc/isbg/user2.passwd
+
+Each account uses its own lock file (unless ``lockfilename`` is given), its
+own trackfiles and its own password file.
+
+.. versionadded:: 2.2.0
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import os
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    import configparser               # Python 3
+except ImportError:
+    import ConfigParser as configparser  # Python 2
+
+try:
+    # Creating command-line interface
+    from docopt import docopt, DocoptExit, printable_usage
+except ImportError:
+    sys.stderr.write("Missing dependency: docopt\n")
+    raise
+
+if __package__ is None and not hasattr(sys, 'frozen'):
+    # direct call of accounts.py
+    path = os.path.realpath(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(os.path.dirname(path)))
+from isbg import isbg  # noqa: E402
+from isbg.__main__ import parse_args  # noqa: E402
+
+#: Values that set a flag in the accounts file.
+TRUE_VALUES = ('yes', 'true', 'on')
+#: Values that unset a flag in the accounts file.
+FALSE_VALUES = ('no', 'false', 'off')
+
+
+def read_accounts(filename):
+    """Read the accounts file.
+
+    Args:
+        filename (str): The accounts file name.
+    Returns:
+        list(tuple(str, list(str))): The name of every account with the
+            command line arguments to use with it.
+
+    """
+    config = configparser.RawConfigParser()
+    if not config.read(filename):
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Can't read the accounts file {}".format(
+                                 filename))
+    accounts = []
+    for name in config.sections():
+        argv = []
+        for key, value in config.items(name):
+            if value.lower() in FALSE_VALUES:
+                continue
+            argv.append('--' + key)
+            if value.lower() not in TRUE_VALUES:
+                argv.append(value)
+        accounts.append((name, argv))
+    return accounts
+
+
+def account_logger(name):
+    """Get the logger of a account.
+
+    Its messages are prefixed with the account name, and they are not
+    propagated to the isbg logger.
+
+    Args:
+        name (str): The account name.
+    Returns:
+        logging.Logger: The logger.
+
+    """
+    logger = logging.getLogger(__name__ + '.' + name)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(
+            '[{}] %(message)s'.format(name)))
+        logger.addHandler(handler)
+    logger.propagate = False
+    return logger
+
+
+def run_account(name, argv, sa_semaphore=None):
+    """Process a account.
+
+    Args:
+        name (str): The account name.
+        argv (list(str)): The command line arguments of the account.
+        sa_semaphore (threading.Semaphore): The semaphore that limits the
+            concurrent calls to SpamAssassin, or None.
+    Returns:
+        int: The exit code of the account, as in
+            :py:data:`isbg.isbg.__exitcodes__`.
+
+    """
+    sbg = isbg.ISBG()
+    sbg.logger = account_logger(name)
+    locked = False
+    try:
+        parse_args(sbg, argv)
+        if '--lockfilename' not in argv:
+            sbg.lockfilename = isbg.ISBG.set_filename(sbg.imapsets, "lock")
+        sbg.interactive = False
+        sbg.sa_semaphore = sa_semaphore
+        locked = not sbg.ignorelockfile
+        ret = sbg.do_isbg()
+        return isbg.__exitcodes__['ok'] if ret is None else ret
+    except isbg.ISBGError as err:
+        if err.exitcode == isbg.__exitcodes__['locked']:
+            locked = False  # It's not our lock file.
+        sbg.logger.error(err.message)
+        return err.exitcode
+    except Exception:  # pylint: disable=broad-except
+        sbg.logger.exception("Error processing the account")
+        return isbg.__exitcodes__['error']
+    finally:
+        if locked:
+            sbg.removelock()
+
+
+def run_accounts(accounts, connections=1, spamconnections=None):
+    """Process several accounts concurrently.
+
+    Args:
+        accounts (list(tuple(str, list(str)))): The accounts, as returned by
+            :py:func:`read_accounts`.
+        connections (int): The maximum number of accounts processed at the
+            same time, and so of IMAP connections.
+        spamconnections (int): The maximum number of concurrent calls to
+            SpamAssassin, or None to not limit them.
+    Returns:
+        list(tuple(str, int)): The name and the exit code of every account.
+
+    """
+    sa_semaphore = None
+    if spamconnections is not None:
+        sa_semaphore = threading.BoundedSemaphore(spamconnections)
+    pool = ThreadPool(max(1, min(connections, len(accounts))))
+    try:
+        codes = pool.map(lambda account: run_account(account[0], account[1],
+                                                     sa_semaphore),
+                         accounts)
+    finally:
+        pool.close()
+        pool.join()
+    return [(account[0], code) for account, code in zip(accounts, codes)]
+
+
+def __isbg_accounts_opts__():  # noqa: D207
+    """isbg_accounts runs isbg for all the accounts of a accounts file.
+
+Command line Options::
+
+ Usage:
+  isbg_accounts.py <ACCOUNTS_FILE> [--connections num]
+                   [--spamconnections num] [--asyncio]
+  isbg_accounts.py (-h | --help)
+  isbg_accounts.py --usage
+  isbg_accounts.py --version
+
+ Options:
+  -h, --help              Show the help screen.
+  --usage                 Show the usage information.
+  --version               Show the version information.
+
+  --connections num       Accounts processed at the same time, and so the
+                          maximum of IMAP connections [default: 1].
+  --spamconnections num   Maximum of concurrent calls to SpamAssassin, for
+                          all the accounts. If not informed, they are not
+                          limited.
+  --asyncio               Process the accounts with asyncio, from a single
+                          thread (it requires python 3.5).
+
+"""
+
+
+def isbg_accounts():
+    """Run when this module is called from the command line.
+
+    It ends with a sys.exit with 0 if all the accounts have end ok, or with
+    the exit code of the first account that has failed.
+    """
+    try:
+        opts = docopt(__isbg_accounts_opts__.__doc__,
+                      version="isbg_accounts v" + isbg.__version__ +
+                      ", from: " + os.path.abspath(__file__) + "\n\n" +
+                      isbg.__license__)
+    except DocoptExit:
+        sys.stderr.write('Error with options!!!\n')
+        raise
+
+    if opts.get("--usage"):
+        sys.stdout.write(
+            "{}\n".format(printable_usage(__isbg_accounts_opts__.__doc__)))
+        return
+
+    try:
+        connections = int(opts["--connections"])
+        spamconnections = opts.get("--spamconnections")
+        if spamconnections is not None:
+            spamconnections = int(spamconnections)
+        accounts = read_accounts(opts["<ACCOUNTS_FILE>"])
+    except ValueError:
+        sys.stderr.write("The connections must be integers\n")
+        sys.exit(isbg.__exitcodes__['flags'])
+    except isbg.ISBGError as err:
+        sys.stderr.write(err.message + "\n")
+        sys.exit(err.exitcode)
+
+    if opts.get("--asyncio"):
+        import asyncio
+        from isbg import aio
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(
+                aio.run_accounts(accounts, connections, spamconnections))
+        finally:
+            loop.close()
+    else:
+        results = run_accounts(accounts, connections, spamconnections)
+
+    failed = [code for _, code in results
+              if code not in (isbg.__exitcodes__['ok'],
+                              isbg.__exitcodes__['newmsgs'],
+                              isbg.__exitcodes__['newspam'],
+                              isbg.__exitcodes__['newmsgspam'])]
+    sys.exit(failed[0] if failed else isbg.__exitcodes__['ok'])
+
+
+if __name__ == '__main__':
+    isbg_accounts()
@@ -0,0 +1,1017 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  aio.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Asyncio backend for isbg.
+
+It has :py:mod:`asyncio` counterparts of the IMAP client
+(:py:class:`AsyncImap4`), of the ``spamd`` client
+(:py:class:`AsyncSpamdClient`), of :py:class:`~isbg.spamproc.SpamAssassin`
+and of :py:meth:`isbg.isbg.ISBG.do_spamassassin`, so a single thread can
+process many accounts, with many operations in flight, without a thread for
+every connection.
+
+It requires python 3.5 or later, and it's not imported by the ``isbg``
+package.
+
+Example:
+    >>> from isbg import aio
+    >>> from isbg.__main__ import parse_args
+    >>> sbg = aio.AsyncISBG()
+    >>> parse_args(sbg, ['--imaphost', 'imap.example.org', ...])
+    >>> asyncio.new_event_loop().run_until_complete(sbg.do_isbg())
+
+.. versionadded:: 2.2.0
+
+"""
+
+import asyncio
+import functools
+import imaplib
+import re
+import ssl
+import time
+
+from isbg import imaputils
+from isbg import isbg
+from isbg import spamd
+from isbg import spamproc
+from isbg import utils
+from isbg.__main__ import parse_args
+from isbg.accounts import account_logger
+
+from .utils import __
+
+#: Regular expression for a literal at the end of a response line.
+_LITERAL_RE = re.compile(br'\{(\d+)\}$')
+#: Regular expressions for the untagged responses.
+_UNTAGGED_STATUS_RE = re.compile(br'\* (\d+) ([A-Z-]+)(?: (.*))?$')
+_UNTAGGED_RE = re.compile(br'\* ([A-Z-]+)(?: (.*))?$')
+
+
+def _quote(arg):
+    """Quote a string argument of a command."""
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _mailbox(name):
+    """Quote a mailbox name if it's needed."""
+    if name.startswith('"') or re.match(r'^[\w.\-/\[\]&]+$', name):
+        return name
+    return _quote(name)
+
+
+class AsyncImap4(object):
+    """Asyncio *IMAP4* client with the operations used by isbg.
+
+    Its coroutines return the same values than the methods of
+    :py:class:`~isbg.imaputils.IsbgImap4` (the responses converted to
+    *ascii*, and checked with `assertok`), so the helpers of
+    :py:mod:`isbg.imaputils` can be used with them.
+
+    The commands of a connection are sent one after another, but any number
+    of connections can be used from the same event loop.
+
+    Args:
+        host (str): The *IMAP* server.
+        port (int): The *IMAP* port.
+        nossl (bool): If *True*, ``SSL`` is not used.
+        assertok (callable): If not *None*, it's called as ``assertok(res,
+            command, *args)`` with every response.
+        timeout (float): If not *None*, the max seconds to wait for a
+            response line.
+
+    """
+
+    _tag_prefix = 'ISBG'
+
+    def __init__(self, host='', port=143, nossl=False, assertok=None,
+                 timeout=None):
+        """Initialize a AsyncImap4 object, without connecting."""
+        self.host = host
+        self.port = port
+        self.nossl = nossl
+        self.assertok = assertok
+        self.timeout = timeout
+        self.reader, self.writer = (None, None)
+        self.lock = None
+        self.welcome = None
+        self._tagnum = 0
+        self._capabilities = set()
+
+    async def connect(self):
+        """Connect with the server and read its capabilities."""
+        context = None if self.nossl else ssl.create_default_context()
+        self.lock = asyncio.Lock()
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=context)
+        self.welcome = await self._readline()
+        if not self.welcome.startswith((b'* OK', b'* PREAUTH')):
+            raise imaplib.IMAP4.error(
+                "Unexpected greeting: {!r}".format(self.welcome))
+        await self.capability()
+        return self
+
+    async def _wait(self, coroutine):
+        """Wait for a coroutine for `timeout` seconds."""
+        if self.timeout is None:
+            return await coroutine
+        return await asyncio.wait_for(coroutine, self.timeout)
+
+    async def _readline(self):
+        """Read a line, without the end of line."""
+        line = await self._wait(self.reader.readline())
+        if not line:
+            raise imaplib.IMAP4.abort("socket error: EOF")
+        return line[:-2] if line.endswith(b'\r\n') else line.rstrip(b'\n')
+
+    async def _read_response(self):
+        """Read a response with its literals.
+
+        Returns:
+            list: The line, or for every literal a ``(line, literal)`` tuple
+            followed by the rest of the response, as :py:mod:`imaplib`.
+
+        """
+        elems = []
+        line = await self._readline()
+        while True:
+            match = _LITERAL_RE.search(line)
+            if match is None:
+                elems.append(line)
+                return elems
+            literal = await self._wait(
+                self.reader.readexactly(int(match.group(1))))
+            elems.append((line, literal))
+            line = await self._readline()
+
+    async def _command(self, name, *args, literal=None):
+        """Send a command and read its responses.
+
+        If the command fails or it's cancelled before reading all its
+        responses, the connection is closed, as the rest of them would be
+        read by the next command.
+
+        Args:
+            name (str): The command, e.g. ``SELECT``.
+            *args (str): The arguments, the *None* ones are skipped.
+            literal (bytes): If not *None*, it's sent as the last argument.
+
+        Returns:
+            tuple: The status of the response (``OK``, ``NO`` or ``BAD``),
+            its text and a :obj:`dict` with the untagged responses by name.
+
+        Raises:
+            imaplib.IMAP4.abort: If the connection has been closed.
+
+        """
+        async with self.lock:
+            if self.writer is None:
+                raise imaplib.IMAP4.abort("connection closed")
+            try:
+                return await self._exchange(name, args, literal)
+            except BaseException:
+                self.close()
+                raise
+
+    async def _exchange(self, name, args, literal):
+        """Send a command and read its responses, see `_command`."""
+        self._tagnum += 1
+        tag = '{}{}'.format(self._tag_prefix, self._tagnum).encode()
+        line = ' '.join([name] + [str(arg) for arg in args
+                                  if arg is not None])
+        if literal is not None:
+            line += ' {{{}}}'.format(len(literal))
+        self.writer.write(tag + b' ' + line.encode('utf-8') + b'\r\n')
+        await self.writer.drain()
+
+        untagged = {}
+        while True:
+            elems = await self._read_response()
+            first = elems[0][0] if isinstance(elems[0], tuple) \
+                else elems[0]
+            if first.startswith(b'+'):
+                if literal is not None:
+                    self.writer.write(literal + b'\r\n')
+                    await self.writer.drain()
+                    literal = None
+                continue
+            if first.startswith(tag + b' '):
+                status, _, text = first[len(tag) + 1:].partition(b' ')
+                return status.decode('ascii'), text, untagged
+            match = _UNTAGGED_STATUS_RE.match(first)
+            if match is not None:
+                typ = match.group(2)
+                data = match.group(1)
+                if match.group(3):
+                    data += b' ' + match.group(3)
+            else:
+                match = _UNTAGGED_RE.match(first)
+                if match is None:
+                    raise imaplib.IMAP4.abort(
+                        "unexpected response: {!r}".format(first))
+                typ, data = match.group(1), match.group(2) or b''
+            typ = typ.decode('ascii')
+            if typ == 'BYE' and name != 'LOGOUT':
+                raise imaplib.IMAP4.abort(data.decode('ascii', 'replace'))
+            if isinstance(elems[0], tuple):
+                elems[0] = (data, elems[0][1])
+            else:
+                elems[0] = data
+            untagged.setdefault(typ, []).extend(elems)
+
+    def _response(self, res, name, *args):
+        """Convert a response to *ascii* and check it with `assertok`."""
+        if name == 'uid FETCH':
+            res = imaputils.ascii_fetch_response(res)
+        else:
+            res = utils.get_ascii_or_value(res)
+        if self.assertok:
+            self.assertok(res, name, *args)
+        return res
+
+    async def _simple(self, name, response, *args):
+        """Send a command and get its `response` untagged responses."""
+        typ, text, untagged = await self._command(name, *args)
+        return typ, untagged.get(response, [None]) if typ == 'OK' else [text]
+
+    async def append(self, mailbox, flags, date_time, message):
+        """Append message to named mailbox."""
+        if flags and not flags.startswith('('):
+            flags = '(' + flags + ')'
+        if date_time:
+            date_time = imaplib.Time2Internaldate(date_time)
+        if isinstance(message, str):
+            message = message.encode('utf-8', errors='replace')
+        typ, text, _ = await self._command('APPEND', _mailbox(mailbox),
+                                           flags or None, date_time or None,
+                                           literal=message)
+        return utils.get_ascii_or_value((typ, [text]))
+
+    async def capability(self):
+        """Fetch capabilities list from server."""
+        res = self._response(
+            await self._simple('CAPABILITY', 'CAPABILITY'), 'capability')
+        self._capabilities = set(
+            ' '.join(c for c in res[1] if c).upper().split())
+        return res
+
+    async def expunge(self):
+        """Permanently remove deleted items from selected mailbox."""
+        return self._response(await self._simple('EXPUNGE', 'EXPUNGE'),
+                              'expunge')
+
+    async def login(self, user, passwd):
+        """Identify client using plain text password."""
+        res = await self._simple('LOGIN', 'OK', _quote(user), _quote(passwd))
+        res = self._response(res, 'login', user, 'xxxxxxxx')
+        await self.capability()  # They can change after login.
+        return res
+
+    async def logout(self):
+        """Shutdown connection to server."""
+        try:
+            res = await self._simple('LOGOUT', 'BYE')
+        finally:
+            self.close()
+        return utils.get_ascii_or_value(res)
+
+    def close(self):
+        """Close the connection."""
+        if self.writer is not None:
+            self.writer.close()
+            self.reader, self.writer = (None, None)
+
+    async def noop(self):
+        """Send NOOP command."""
+        return self._response(await self._simple('NOOP', 'OK'), 'noop')
+
+    async def status(self, mailbox, names):
+        """Request named status conditions for mailbox."""
+        return self._response(
+            await self._simple('STATUS', 'STATUS', _mailbox(mailbox), names),
+            'status', mailbox, names)
+
+    async def select(self, mailbox='INBOX', readonly=False):
+        """Select a Mailbox."""
+        return self._response(
+            await self._simple('EXAMINE' if readonly else 'SELECT', 'EXISTS',
+                               _mailbox(mailbox)),
+            'select', mailbox, readonly)
+
+    async def uid(self, command, *args):
+        """Execute "command arg ..." with messages identified by UID."""
+        command = command.upper()
+        name = command if command in ('SEARCH', 'SORT', 'THREAD') \
+            else 'FETCH'
+        return self._response(await self._simple('UID', name, command, *args),
+                              'uid ' + command, args)
+
+    async def get_status(self, mailbox, names):
+        """Get status items of a mailbox, as `IsbgImap4.get_status`."""
+        typ, _, untagged = await self._command(
+            'STATUS', _mailbox(mailbox), '({})'.format(' '.join(names)))
+        if typ != 'OK':
+            return {}
+        return imaputils.parse_status(untagged.get('STATUS', [None]))
+
+    def has_capability(self, name):
+        """Check if the server has a capability, e.g. ``CONDSTORE``."""
+        return name.upper() in self._capabilities
+
+
+async def login_imap(imapsets, logger=None, assertok=None):
+    """Connect and login to the imap server, as `imaputils.login_imap`."""
+    max_retry = 10
+    retry_time = 0.60   # seconds
+    imap = AsyncImap4(imapsets.host, imapsets.port, imapsets.nossl, assertok)
+    for retry in range(1, max_retry + 1):
+        try:
+            await imap.connect()
+            break   # ok, exit from loop
+        except OSError as exc:
+            if logger:
+                logger.warning(__(
+                    ("Error in IMAP connection: {} ... retry {} of {}"
+                     ).format(exc, retry, max_retry)))
+            if retry >= max_retry:
+                raise
+            await asyncio.sleep(retry_time)
+    if logger:
+        logger.debug(__("Server capabilities: {}".format(
+            sorted(imap._capabilities))))
+    if imapsets.nossl and logger:
+        logger.warning("WARNING: Using insecure IMAP connection: without SSL.")
+    # Authenticate (only simple supported)
+    await imap.login(imapsets.user, imapsets.passwd)
+    if imapsets.compress and logger:
+        logger.debug("IMAP compression: not supported with asyncio")
+    return imap
+
+
+async def fetch_messages(imap, uids, logger=None):
+    """Fetch a batch of messages with a single ``UID FETCH``.
+
+    Args:
+        imap (AsyncImap4): The connection.
+        uids (list(str)): The *uids* of the messages.
+        logger (logging.Logger): If a message cannot be fetched a warning is
+            written to this logger.
+
+    Returns:
+        list(tuple): The *uid* and the `email.message.Message` of every
+        message, as :py:func:`isbg.imaputils.get_messages`.
+
+    """
+    if not uids:
+        return []
+    res = await imap.uid("FETCH", imaputils.uid_sequence_set(uids),
+                         "(BODY.PEEK[])")
+    return list(imaputils.fetched_messages(uids, res, logger))
+
+
+async def fetch_headers(imap, uids, batch_size=200):
+    """Fetch the headers of messages, without their bodies.
+
+    Args:
+        imap (AsyncImap4): The connection.
+        uids (list(str)): The *uids* of the messages.
+        batch_size (int): The max number of messages of every ``UID FETCH``.
+
+    Returns:
+        dict: The ``INTERNALDATE`` and the headers of every *uid*, as
+        :py:func:`isbg.imaputils.get_headers`.
+
+    """
+    headers = {}
+    for start in range(0, len(uids), batch_size):
+        batch = uids[start:start + batch_size]
+        res = await imap.uid("FETCH", imaputils.uid_sequence_set(batch),
+                             "(INTERNALDATE BODY.PEEK[HEADER])")
+        headers.update(imaputils.fetched_headers(res))
+    return headers
+
+
+async def fetch_fingerprints(imap, uids, batch_size=200):
+    """Fetch the fingerprints of messages, without their bodies.
+
+    Args:
+        imap (AsyncImap4): The connection.
+        uids (list(str)): The *uids* of the messages.
+        batch_size (int): The max number of messages of every ``UID FETCH``.
+
+    Returns:
+        dict: The fingerprint of every *uid*, as
+        :py:func:`isbg.imaputils.get_fingerprints`.
+
+    """
+    fingerprints = {}
+    for start in range(0, len(uids), batch_size):
+        batch = uids[start:start + batch_size]
+        res = await imap.uid(
+            "FETCH", imaputils.uid_sequence_set(batch),
+            "(RFC822.SIZE BODY.PEEK[HEADER.FIELDS ({})])".format(
+                imaputils.FINGERPRINT_FIELDS))
+        fingerprints.update(imaputils.fetched_fingerprints(res))
+    return fingerprints
+
+
+async def fetch_message_keys(imap, uids, batch_size=200):
+    """Fetch the keys of messages, without their bodies.
+
+    Args:
+        imap (AsyncImap4): The connection.
+        uids (list(str)): The *uids* of the messages.
+        batch_size (int): The max number of messages of every ``UID FETCH``.
+
+    Returns:
+        dict: The key of every *uid*, as
+        :py:func:`isbg.imaputils.get_message_keys`.
+
+    """
+    keys = {}
+    for start in range(0, len(uids), batch_size):
+        batch = uids[start:start + batch_size]
+        res = await imap.uid(
+            "FETCH", imaputils.uid_sequence_set(batch),
+            "(RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])")
+        keys.update(imaputils.fetched_message_keys(res))
+    return keys
+
+
+class AsyncSpamdClient(spamd.SpamdClient):
+    """Asyncio client for the *SPAMC/1.5* protocol of ``spamd``.
+
+    Its :py:meth:`request` and the methods using it are coroutines, with
+    the same results than the ones of :py:class:`~isbg.spamd.SpamdClient`.
+
+    """
+
+    async def request(self, command, message=b'', headers=None):
+        """Send a request to ``spamd`` and get its response.
+
+        Raises:
+            isbg.spamd.SpamdError: If the response is not valid.
+            OSError: If there is a error with the connection.
+            asyncio.TimeoutError: If `timeout` has expired.
+
+        """
+        data = self._request_data(command, message, headers)
+
+        async def exchange():
+            if self.socket_path is not None:
+                reader, writer = await asyncio.open_unix_connection(
+                    self.socket_path)
+            else:
+                reader, writer = await asyncio.open_connection(self.host,
+                                                               self.port)
+            try:
+                writer.write(data)
+                await writer.drain()
+                if writer.can_write_eof():
+                    writer.write_eof()
+                return await reader.read()
+            finally:
+                writer.close()
+
+        return spamd.SpamdResponse.parse(
+            await asyncio.wait_for(exchange(), self.timeout))
+
+    async def _result(self, request, message, *args):
+        """Get the response of a request, or *None* on errors."""
+        try:
+            return await request(message, *args)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                spamd.SpamdError):
+            return None
+
+    async def test_mail(self, mail):
+        """Test a email, as `SpamdClient.test_mail`."""
+        message = spamd._as_bytes(mail)
+        if len(message) > self.max_size:
+            return "-9999", spamd.EX_TOOBIG
+        return spamd._test_result(await self._result(self.check, message))
+
+    async def feed_mail(self, mail):
+        """Feed a email with the report, as `SpamdClient.feed_mail`."""
+        message = spamd._as_bytes(mail)
+        if len(message) > self.max_size:
+            return message, spamd.EX_OK
+        return spamd._feed_result(await self._result(self.process, message))
+
+    async def process_mail(self, mail):
+        """Test and feed a email, as `SpamdClient.process_mail`."""
+        message = spamd._as_bytes(mail)
+        if len(message) > self.max_size:
+            return "-9999", u"-9999", spamd.EX_TOOBIG
+        return spamd._process_result(
+            await self._result(self.process, message))
+
+    async def learn_mail(self, mail, learn_type):
+        """Learn a email, as `SpamdClient.learn_mail`."""
+        message = spamd._as_bytes(mail)
+        if len(message) > self.max_size:
+            return spamd.EX_TOOBIG, spamd.EX_TOOBIG
+        return spamd._learn_result(
+            await self._result(self.tell, message, learn_type))
+
+
+async def _gather(func, items, workers):
+    """Apply a coroutine function to the items, `workers` at a time.
+
+    Returns:
+        list: The results, in the same order than the items.
+
+    """
+    semaphore = asyncio.Semaphore(max(workers or 1, 1))
+
+    async def run(item):
+        async with semaphore:
+            return await func(item)
+
+    return await asyncio.gather(*[run(item) for item in items])
+
+
+def _sa_limited(func):
+    """Decorate a coroutine method to hold `sa_semaphore`, if it's set."""
+    async def func_wrapper(self, *args, **kwargs):
+        if self.sa_semaphore is None:
+            return await func(self, *args, **kwargs)
+        async with self.sa_semaphore:
+            return await func(self, *args, **kwargs)
+    return func_wrapper
+
+
+class AsyncSpamAssassin(spamproc.SpamAssassin):
+    """Learn and process spams from a imap account with asyncio.
+
+    It's the :py:class:`~isbg.spamproc.SpamAssassin` counterpart, with
+    :py:meth:`learn` and :py:meth:`process_inbox` as coroutines, and `imap`
+    a :py:class:`AsyncImap4`.
+
+    With `spamd`, the messages are sent with a :py:class:`AsyncSpamdClient`,
+    else ``spamc`` or ``spamassassin`` are run by the default executor of
+    the event loop. The messages are fetched in batches of `batch_size`, and
+    up to `workers` (or `learnworkers`) of them are classified (or learned)
+    at the same time while the next batch is fetched. If `sa_semaphore` is
+    set, it must be a :py:class:`asyncio.Semaphore`.
+
+    Only the I/O is done here, the decisions are taken by the methods
+    inherited from :py:class:`~isbg.spamproc.SpamAssassin`.
+
+    """
+
+    #: Number of messages fetched with every ``UID FETCH``.
+    batch_size = 50
+
+    @property
+    def spamd_client(self):
+        """Get the native ``spamd`` client, if `spamd` is used.
+
+        :getter: A :py:class:`AsyncSpamdClient`, or *None* if `spamd` is not
+            set.
+        :type: AsyncSpamdClient
+        """
+        if self.spamd and self._spamd_client is None:
+            self._spamd_client = AsyncSpamdClient.from_address(self.spamd)
+        return self._spamd_client
+
+    async def _run(self, func, *args):
+        """Run a blocking function in the default executor."""
+        return await asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(func, *args))
+
+    @_sa_limited
+    async def _learn_mail(self, mail, learn_type):
+        """Learn a mail with ``spamd`` or ``spamc``."""
+        if self.spamd_client is not None:
+            return await self.spamd_client.learn_mail(mail, learn_type)
+        return await self._run(spamproc.learn_mail, mail, learn_type)
+
+    @_sa_limited
+    async def _test_mail(self, mail):
+        """Test a mail with ``spamd`` or with `cmd_test`."""
+        if self.spamd_client is not None:
+            return await self.spamd_client.test_mail(mail)
+        return await self._run(spamproc.test_mail, mail, False, self.cmd_test)
+
+    @_sa_limited
+    async def _feed_mail(self, mail):
+        """Feed a mail with ``spamd`` or with `cmd_save`."""
+        if self.spamd_client is not None:
+            return await self.spamd_client.feed_mail(mail)
+        return await self._run(spamproc.feed_mail, mail, False, self.cmd_save)
+
+    @_sa_limited
+    async def _process_mail(self, mail):
+        """Test and feed a mail with ``spamd`` or with `cmd_process`."""
+        if self.spamd_client is not None:
+            return await self.spamd_client.process_mail(mail)
+        return await self._run(spamproc.process_mail, mail, False,
+                               self.cmd_process)
+
+    async def _flush(self, actions):
+        """Send the commands of a `UidCommands` batch."""
+        for command, seqset, args in actions.drain():
+            await self.imap.uid(command, seqset, *args)
+
+    async def _pipeline(self, uids, func, workers, act, stats=None):
+        """Fetch, apply `func` to and act over the messages of `uids`.
+
+        The next batch is fetched while `func` is applied to the messages of
+        the current one, `workers` at a time, and `act` is called with the
+        results in the same order than `uids`. If `act` returns *False*, it
+        stops.
+        """
+        batches = [uids[i:i + self.batch_size]
+                   for i in range(0, len(uids), self.batch_size)]
+        if not batches:
+            return
+
+        async def fetch(batch):
+            start = time.time()
+            fetched = self._keyed(await fetch_messages(
+                self.imap, [u for u in batch if self._need_body(u)],
+                self.logger))
+            messages = [next(fetched) if self._need_body(uid) else (uid, None)
+                        for uid in batch]
+            if stats is not None:
+                for _ in messages:
+                    stats.add_stage_time('fetch', (time.time() - start) /
+                                         len(messages))
+            return messages
+
+        async def classify(message):
+            start = time.time()
+            res = await func(message)
+            if stats is not None:
+                stats.add_stage_time('classify', time.time() - start)
+            return res
+
+        fetching = asyncio.ensure_future(fetch(batches[0]))
+        try:
+            for idx in range(len(batches)):
+                messages = await fetching
+                if idx + 1 < len(batches):
+                    fetching = asyncio.ensure_future(fetch(batches[idx + 1]))
+                for res in await _gather(classify, messages, workers):
+                    start = time.time()
+                    goon = await act(res)
+                    if stats is not None:
+                        stats.add_stage_time('act', time.time() - start)
+                    if goon is False:
+                        return
+        finally:
+            # A cancelled UID FETCH would close the connection, so the
+            # pending one is completed and its messages discarded.
+            if not fetching.done():
+                try:
+                    await fetching
+                except Exception:  # pylint: disable=broad-except
+                    pass
+
+    async def _learn(self, message, learn_type):
+        """Unwrap and learn a message, as `SpamAssassin._learn`."""
+        uid, mail = message
+        mail = self._unwrap(uid, mail)
+        if self.dryrun:
+            code, code_orig = (0, 0)
+        else:
+            code, code_orig = await self._learn_mail(mail, learn_type)
+            if self.verdicts is not None:
+                self.verdicts.forget(mail)
+        return uid, mail, code, code_orig
+
+    async def learn(self, folder, learn_type, move_to, origpastuids,
+                    modseq=0):
+        """Learn the spams (and if requested deleted or move them).
+
+        It's the coroutine counterpart of `SpamAssassin.learn`.
+        """
+        sa_learning = spamproc.Sa_Learn()
+        self._check_learn(folder, learn_type)
+
+        highestmodseq = 0
+        if self.imap.has_capability('CONDSTORE'):
+            highestmodseq = (await self.imap.get_status(
+                folder, ['HIGHESTMODSEQ'])).get('HIGHESTMODSEQ', 0)
+        criteria = self._learn_search(sa_learning, folder, origpastuids,
+                                      modseq, highestmodseq)
+        if criteria is None:
+            return sa_learning
+
+        await self.imap.select(folder)
+        _, uids = await self.imap.uid("SEARCH", None, *criteria)
+        uids = self._learn_uids(sa_learning, uids, origpastuids, modseq,
+                                highestmodseq)
+
+        move = not self.dryrun and self.imap.has_capability('MOVE')
+        actions = imaputils.UidCommands(self.imap)
+
+        fingerprints = None
+        if self.fingerprints is not None:
+            fingerprints = await fetch_fingerprints(self.imap, uids)
+            uids = self._skip_learned(sa_learning, actions, uids, fingerprints,
+                                      learn_type, move_to, move)
+
+        async def act(res):
+            self._learn_result(sa_learning, actions, res, fingerprints,
+                               learn_type, move_to, move)
+
+        self._keys = {}
+        await self._pipeline(uids, lambda message: self._learn(
+            message, learn_type), self.learnworkers, act)
+        await self._flush(actions)
+        self._learn_done(sa_learning, highestmodseq)
+        return sa_learning
+
+    async def _classify(self, message):
+        """Unwrap and test a message, as `SpamAssassin._classify`."""
+        uid, mail, known = self._known_verdict(message)
+        if known is not None:
+            return known
+        new_mail = None
+        if self.singlepass and not self.noreport:
+            score, new_mail, code = await self._process_mail(mail)
+        else:
+            score, code = await self._test_mail(mail)
+        self._cache_verdict(mail, score, code)
+        return uid, mail, score, new_mail, code
+
+    async def _process_spam(self, uid, score, mail, spamdeletelist,
+                            new_mail=None):
+        """Process a spam mail, as `SpamAssassin._process_spam`."""
+        if self._delete_spam(uid, score, spamdeletelist):
+            return False
+        if not self._report_needed():
+            return True
+
+        code, res = (None, None)
+        if new_mail is None:
+            new_mail, code = await self._feed_mail(mail)
+        if new_mail != u"-9999":
+            res = await self.imap.append(self.imapsets.spaminbox, None, None,
+                                         new_mail)
+        return self._spam_reported(uid, mail, new_mail, code, res,
+                                   spamdeletelist)
+
+    async def process_inbox(self, origpastuids, highwater=0):
+        """Run spamassassin in the folder for spam.
+
+        It's the coroutine counterpart of `SpamAssassin.process_inbox`.
+        """
+        sa_proc = spamproc.Sa_Process()
+        self._cachehits = 0
+
+        spamlist = []
+        spamdeletelist = []
+
+        # select inbox
+        await self.imap.select(self.imapsets.inbox, 1)
+
+        # get the uids of all mails with a size less then the maxsize
+        _, uids = await self.imap.uid("SEARCH", None,
+                                      *self._inbox_criteria(highwater))
+        uids, found = self._inbox_uids(sa_proc, uids, origpastuids, highwater)
+
+        self._stamps, self._keys = ({}, {})
+        if self.trustspamheaders and not self.dryrun:
+            self._stamps = self._stamp_verdicts(
+                await fetch_headers(self.imap, uids))
+            sa_proc.stamped = len(self._stamps)
+
+        async def act(res):
+            uid, mail, score, new_mail, code = res
+            scored = self._scored(sa_proc, uids, uid, mail, score, new_mail,
+                                  code)
+            if scored is None:
+                return False
+            score, code = scored
+            if code and await self._process_spam(uid, score, mail,
+                                                 spamdeletelist, new_mail):
+                spamlist.append(uid)
+            return True
+
+        await self._pipeline(list(uids), self._classify, self.workers, act,
+                             sa_proc)
+
+        # If we found any spams, now go and mark the original messages
+        if self._mark_needed(sa_proc, uids, spamlist, spamdeletelist):
+            await self.imap.select(self.imapsets.inbox)
+            move = self.imap.has_capability('MOVE')
+            actions = imaputils.UidCommands(self.imap)
+            self._keyword_actions(actions, uids)
+            deleted = self._spam_actions(actions, spamlist, spamdeletelist,
+                                         sa_proc, move)
+            await self._flush(actions)
+            expunge = self._expunge_uids(deleted, sa_proc, move)
+            if expunge:
+                actions.add("EXPUNGE", expunge)
+                await self._flush(actions)
+            elif expunge is None:
+                await self.imap.expunge()
+
+        self._set_highwater(sa_proc, found, highwater, origpastuids)
+        return sa_proc
+
+
+class AsyncISBG(isbg.ISBG):
+    """ISBG with the IMAP and SpamAssassin work done with asyncio.
+
+    :py:meth:`do_imap_login`, :py:meth:`do_imap_logout`,
+    :py:meth:`do_spamassassin` and :py:meth:`do_isbg` are coroutines. The
+    trackfiles, the lock file and the password are handled as with
+    :py:class:`~isbg.isbg.ISBG`. ``--imaplist``, ``--daemon`` and
+    ``--imapcompress`` are not supported.
+
+    """
+
+    async def do_imap_login(self):
+        """Login to the imap server."""
+        self.imap = await login_imap(self.imapsets, logger=self.logger,
+                                     assertok=self.assertok)
+
+    async def do_imap_logout(self):
+        """Sign off from the imap connection."""
+        await self.imap.logout()
+
+    async def past_read(self, uidvalidity, folder, mailbox, struct=None):
+        """Read the past uids and the verdict index, as `ISBG.past_read`."""
+        if struct is None:
+            struct = self.trackfile_load(folder)
+        stale = self._stale_index(uidvalidity, folder, struct)
+        if not stale:
+            return (self.pastuid_read(uidvalidity, folder, struct),
+                    self.index_read(uidvalidity, folder, struct))
+        await self.imap.select(mailbox, 1)
+        _, uids = await self.imap.uid("SEARCH", None, "ALL")
+        return self._remap_index(
+            stale, await fetch_message_keys(self.imap,
+                                            (uids[0] or '').split()),
+            folder)
+
+    async def _learn_folder(self, sa, folder, learn_type, move_to, learnskip):
+        """Learn a folder, as `ISBG._learn_folder`."""
+        status = await self.imap.get_status(folder, self.status_items)
+        uidvalidity = status.get('UIDVALIDITY', 0)
+        struct = self.trackfile_load(learn_type)
+        if learnskip and self._folder_unchanged(status, learn_type, folder,
+                                                struct):
+            return spamproc.Sa_Learn()
+        pastuids, index = await self.past_read(uidvalidity, learn_type,
+                                               folder, struct)
+        learned = await sa.learn(folder, learn_type, move_to, pastuids,
+                                 self.modseq_read(uidvalidity, learn_type,
+                                                  struct))
+        self._track(uidvalidity, learn_type, learned, status, index,
+                    modseq=learned.modseq)
+        return learned
+
+    async def do_spamassassin(self):
+        """Do the spamassassin procesing, as `ISBG.do_spamassassin`."""
+        sa = AsyncSpamAssassin.create_from_isbg(self)
+        # Flags changes are not seen with STATUS:
+        learnskip = not (self.learnflagged or self.learnunflagged)
+
+        s_learned = spamproc.Sa_Learn()
+        if self.imapsets.learnspambox:
+            s_learned = await self._learn_folder(
+                sa, self.imapsets.learnspambox, 'spam', None, learnskip)
+
+        h_learned = spamproc.Sa_Learn()
+        if self.imapsets.learnhambox:
+            h_learned = await self._learn_folder(
+                sa, self.imapsets.learnhambox, 'ham', self.movehamto,
+                learnskip)
+
+        if self.fingerprints is not None:
+            self.fingerprints.save()
+
+        proc = spamproc.Sa_Process()
+        if not self.teachonly and self.scankeyword:
+            # The processed messages are marked in the server, no trackfile.
+            await self.imap.select(self.imapsets.spaminbox, 1)
+            proc = await sa.process_inbox([])
+        elif not self.teachonly:
+            # The status is read after learning, as ham can be moved to it.
+            status = await self.imap.get_status(self.imapsets.inbox,
+                                                self.status_items)
+            uidvalidity = status.get('UIDVALIDITY', 0)
+            struct = self.trackfile_load('inbox')
+            if not self._folder_unchanged(status, 'inbox',
+                                          self.imapsets.inbox, struct):
+                # check spaminbox exists by examining it
+                await self.imap.select(self.imapsets.spaminbox, 1)
+
+                pastuids, index = await self.past_read(
+                    uidvalidity, 'inbox', self.imapsets.inbox, struct)
+                proc = await sa.process_inbox(
+                    pastuids, self.highwater_read(uidvalidity, 'inbox',
+                                                  struct))
+                self._track(uidvalidity, 'inbox', proc, status, index,
+                            highwater=proc.highwater)
+
+        if self.verdicts is not None:
+            self.verdicts.save()
+        self._log_stats(s_learned, h_learned, proc)
+        return proc
+
+    async def do_isbg(self):
+        """Execute the main isbg process, as `ISBG.do_isbg`."""
+        if self.imaplist or self.daemon:
+            raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                                 "--imaplist and --daemon can't be used " +
+                                 "with asyncio")
+        self._do_prepare()
+        await self.do_imap_login()
+        if self.savepw:
+            self._do_save_password()
+        try:
+            proc = await self.do_spamassassin()
+        finally:
+            await self.do_imap_logout()
+        return self._get_exitcode(proc)
+
+
+async def run_account(name, argv, semaphore=None, sa_semaphore=None):
+    """Process a account with asyncio, as `isbg.accounts.run_account`.
+
+    Args:
+        name (str): The account name.
+        argv (list(str)): The command line arguments of the account.
+        semaphore (asyncio.Semaphore): If not *None*, it's held while the
+            account is processed.
+        sa_semaphore (asyncio.Semaphore): The semaphore that limits the
+            concurrent calls to SpamAssassin, or None.
+    Returns:
+        int: The exit code of the account.
+
+    """
+    sbg = AsyncISBG()
+    sbg.logger = account_logger(name)
+    locked = False
+    try:
+        parse_args(sbg, argv)
+        if '--lockfilename' not in argv:
+            sbg.lockfilename = isbg.ISBG.set_filename(sbg.imapsets, "lock")
+        sbg.interactive = False
+        sbg.sa_semaphore = sa_semaphore
+        if semaphore is None:
+            semaphore = asyncio.Semaphore()
+        async with semaphore:
+            locked = not sbg.ignorelockfile
+            ret = await sbg.do_isbg()
+        return isbg.__exitcodes__['ok'] if ret is None else ret
+    except isbg.ISBGError as err:
+        if err.exitcode == isbg.__exitcodes__['locked']:
+            locked = False  # It's not our lock file.
+        sbg.logger.error(err.message)
+        return err.exitcode
+    except Exception:  # pylint: disable=broad-except
+        sbg.logger.exception("Error processing the account")
+        return isbg.__exitcodes__['error']
+    finally:
+        if locked:
+            sbg.removelock()
+
+
+async def run_accounts(accounts, connections=1, spamconnections=None):
+    """Process several accounts with asyncio, as `accounts.run_accounts`.
+
+    Args:
+        accounts (list(tuple(str, list(str)))): The accounts.
+        connections (int): The max number of accounts processed at the same
+            time, and so of IMAP connections.
+        spamconnections (int): The maximum number of concurrent calls to
+            SpamAssassin, or None to not limit them.
+    Returns:
+        list(tuple(str, int)): The name and the exit code of every account.
+
+    """
+    semaphore = asyncio.Semaphore(max(connections, 1))
+    sa_semaphore = None
+    if spamconnections is not None:
+        sa_semaphore = asyncio.BoundedSemaphore(max(spamconnections, 1))
+    codes = await asyncio.gather(*[run_account(name, argv, semaphore,
+                                               sa_semaphore)
+                                   for name, argv in accounts])
+    return [(account[0], code) for account, code in zip(accounts, codes)]
@@ -28,14 +28,18 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import bisect
 import email          # To easily encapsulated emails messages
 import email.message  # required for typing.TypeVar to work in py3
 import imaplib
+import io
 import re             # For regular expressions
 import socket         # to catch the socket.error exception
+import threading
 import time
+import zlib
 
-from hashlib import md5
+from hashlib import md5, sha256
 
 from isbg import utils
 from .utils import __
@@ -46,6 +50,15 @@ Email = TypeVar(email.message.Message)
 Uid = Union[int, str]
 Uids = List[int]
 
+# The MOVE command (RFC 6851) is unknown for the imaplib of python 2, and
+# COMPRESS (RFC 4978) for all.
+imaplib.Commands.setdefault('MOVE', ('SELECTED',))
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+#: Max length of the sequence set of a command. :rfc:`7162` recommends to
+#: limit the command lines to 8192 octets.
+MAX_SEQUENCE_SET_LEN = 4096
+
 
 def mail_content(mail):
     # type: (Email) -> AnyStr
@@ -62,6 +75,8 @@ def mail_content(mail):
         email.errors.MessageError:  if mail is not *bytes* nor *str*.
 
     """
+    if isinstance(mail, RawMessage):
+        return mail.raw
     if not isinstance(mail, email.message.Message):
         raise email.errors.MessageError(
             "mail '{}' is not a email.message.Message.".format(repr(mail)))
@@ -88,27 +103,100 @@ def new_message(body):
         TypeError: If the content is empty.
 
     """
-    mail = None
+    if not body.strip():
+        raise TypeError(
+            __("body '{}' cannot be empty.".format(repr(body))))
 
     if isinstance(body, bytes):
         try:
-            mail = email.message_from_bytes(body)  # pylint: disable=no-member
-            if mail.as_bytes() in [b'', b'\n']:
-                raise TypeError(
-                    __("body '{}' cannot be empty.".format(repr(body))))
-            return mail
+            return email.message_from_bytes(body)  # pylint: disable=no-member
         except AttributeError:  # py2
             pass
 
     try:
-        mail = email.message_from_string(body)
+        return email.message_from_string(body)
     except UnicodeEncodeError:
         body = body.encode("ascii", errors='replace')
-        mail = email.message_from_string(body)
-    if mail.as_string() in ['', '\n']:
-        raise TypeError(
-            __("body '{}' cannot be empty.".format(repr(body))))
-    return mail
+        return email.message_from_string(body)
+
+
+class RawMessage(object):
+    r"""A email message kept as the bytes fetched from the *imap* server.
+
+    The bytes are used as they are to feed SpamAssassin (see
+    :py:func:`mail_content`) and to get the size of the message, and the
+    `email.message.Message` is only parsed the first time that it's needed,
+    e.g. to get a header. So the message is not serialized again, and
+    SpamAssassin gets the same bytes than the server has.
+
+    The attributes and the headers of the parsed message can be used as
+    with a `email.message.Message`:
+
+        >>> mail = RawMessage(b'Subject: foo\r\n\r\nboo\r\n')
+        >>> mail.size, mail['Subject']
+        (23, 'foo')
+
+    Args:
+        raw (:obj:`bytes` or :obj:`str`): The message, with its headers.
+
+    Raises:
+        TypeError: If the message is empty.
+
+    """
+
+    def __init__(self, raw):
+        """Initialize a RawMessage object."""
+        if not isinstance(raw, bytes):
+            raw = raw.encode('utf-8', errors='replace')
+        if not raw.strip():
+            raise TypeError(
+                __("body '{}' cannot be empty.".format(repr(raw))))
+        self.raw = raw  #: The message as it has been fetched.
+        self._message = None
+
+    @property
+    def message(self):
+        """Get the message parsed.
+
+        :getter: The `email.message.Message`, parsed the first time.
+        :type: email.message.Message
+        """
+        if self._message is None:
+            self._message = new_message(self.raw)
+        return self._message
+
+    @property
+    def size(self):
+        """Get the size of the message in bytes."""
+        return len(self.raw)
+
+    def as_bytes(self):
+        """Get the message as it has been fetched."""
+        return self.raw
+
+    def as_string(self):
+        """Get the message as a string."""
+        if isinstance(self.raw, str):  # py2
+            return self.raw
+        return self.raw.decode('utf-8', errors='replace')
+
+    def __getitem__(self, name):
+        """Get a header of the message."""
+        return self.message[name]
+
+    def __contains__(self, name):
+        """Check if the message has a header."""
+        return name in self.message
+
+    def __getattr__(self, name):
+        """Get the attributes of the parsed message."""
+        if name.startswith('__') or name in ('raw', '_message'):
+            raise AttributeError(name)
+        return getattr(self.message, name)
+
+    def __repr__(self):
+        """Get the representation."""
+        return "RawMessage({!r})".format(utils.shorten(self.raw, 60))
 
 
 def get_message(imap, uid, append_to=None, logger=None):
@@ -125,7 +213,7 @@ def get_message(imap, uid, append_to=None, logger=None):
             mail a warning is written to this logger. Defaults to *None*.
 
     Returns:
-        email.message.Message: The message fetched from the *imap* connection.
+        RawMessage: The message fetched from the *imap* connection.
 
     """
     res = imap.uid("FETCH", uid, "(BODY.PEEK[])")
@@ -133,14 +221,14 @@ def get_message(imap, uid, append_to=None, logger=None):
     if res[0] != "OK":
         try:
             body = res[1][0][1]
-            mail = new_message(body)
+            mail = RawMessage(body)
         except Exception:  # pylint: disable=broad-except
             logger.warning(__(
                 ("Confused - rfc822 fetch gave {} - The message was " +
                  "probably deleted while we were running").format(res)))
     else:
         body = res[1][0][1]
-        mail = new_message(body)
+        mail = RawMessage(body)
 
     if append_to is not None:
         append_to.append(int(uid))
@@ -148,6 +236,600 @@ def get_message(imap, uid, append_to=None, logger=None):
     return mail
 
 
+def uid_sequence_set(uids):
+    # type: (Iterable[Uid]) -> str
+    """Build a compact *IMAP* sequence set from a list of *uids*.
+
+    Consecutive *uids* are collapsed into ranges, so the result can be used
+    as the message set of a single ``UID`` command.
+
+    Example:
+        >>> uid_sequence_set([101, '102', 105, 106, 107, 110])
+        '101:102,105:107,110'
+
+    Args:
+        uids (:obj:`list` of :obj:`int` or :obj:`str`): The *uids*.
+
+    Returns:
+        str: The sequence set.
+
+    """
+    return UidSet(uids).sequence_set()
+
+
+def uid_sequence_sets(uids, maxlen=MAX_SEQUENCE_SET_LEN):
+    # type: (Iterable[Uid], int) -> Iterator[str]
+    """Build compact *IMAP* sequence sets not longer than `maxlen`.
+
+    Like :py:func:`uid_sequence_set`, but the sequence set is split to not
+    send too long commands.
+
+    Example:
+        >>> list(uid_sequence_sets([1, 2, 3, 5, 7, 8], maxlen=6))
+        ['1:3,5', '7:8']
+
+    Args:
+        uids (:obj:`list` of :obj:`int` or :obj:`str`): The *uids*.
+        maxlen (int): The max length of every sequence set.
+
+    Returns:
+        Iterator[str]: The sequence sets.
+
+    """
+    seqset = ''
+    for first, last in UidSet(uids).ranges:
+        elem = str(first) if first == last else '{}:{}'.format(first, last)
+        if seqset and len(seqset) + len(elem) + 1 > maxlen:
+            yield seqset
+            seqset = ''
+        seqset = seqset + ',' + elem if seqset else elem
+    if seqset:
+        yield seqset
+
+
+class UidCommands(object):
+    r"""A batch of ``UID`` commands over sets of *uids*.
+
+    The *uids* added with the same command and arguments are sent with a
+    single command (or more, if the sequence set is longer than `maxlen`)
+    when it is flushed. The commands are sent in the order they were first
+    added.
+
+    Example:
+        >>> actions = UidCommands(imap)
+        >>> actions.add("STORE", [12, 13, 14], "+FLAGS.SILENT", "(\\Seen)")
+        >>> actions.add("COPY", [55], "Spam")
+        >>> actions.add("STORE", [15], "+FLAGS.SILENT", "(\\Seen)")
+        >>> actions.flush()  # UID STORE 12:15 ... and UID COPY 55 Spam
+
+    Args:
+        imap (IsbgImap4): The imap helper object with the connection.
+        maxlen (int): The max length of the sequence sets.
+
+    """
+
+    def __init__(self, imap, maxlen=MAX_SEQUENCE_SET_LEN):
+        """Initialize a UidCommands object."""
+        self.imap = imap
+        self.maxlen = maxlen
+        self._commands = []  # list of ((command, args), uids)
+
+    def add(self, command, uids, *args):
+        """Add *uids* to a command with its arguments.
+
+        Examples:
+            >>> actions.add("COPY", uids, mailbox)
+
+        """
+        key = (command, args)
+        for cmd_key, cmd_uids in self._commands:
+            if cmd_key == key:
+                cmd_uids.extend(uids)
+                return
+        self._commands.append((key, list(uids)))
+
+    def drain(self):
+        """Empty the batch and get its commands without sending them.
+
+        Returns:
+            list(tuple): The commands as ``(command, seqset, args)``.
+
+        """
+        commands, self._commands = self._commands, []
+        return [(command, seqset, args)
+                for (command, args), uids in commands
+                for seqset in uid_sequence_sets(uids, self.maxlen)]
+
+    def flush(self):
+        """Send the commands and empty the batch."""
+        for command, seqset, args in self.drain():
+            self.imap.uid(command, seqset, *args)
+
+    def __len__(self):
+        """Get the number of commands to send."""
+        return len(self._commands)
+
+
+class UidSet(object):
+    """A set of *uids* stored as sorted and non overlapping ranges.
+
+    It's used to store the past *uids* of a folder: its size, and the cost
+    of loading, saving and checking it, is proportional to the number of
+    ranges, not to the number of *uids*.
+
+    Example:
+        >>> uidset = UidSet([1, 2, 3, 7])
+        >>> uidset.ranges
+        [[1, 3], [7, 7]]
+        >>> 2 in uidset, '7' in uidset, 5 in uidset
+        (True, True, False)
+
+    Args:
+        uids (:obj:`list` of :obj:`int` or :obj:`str`, optional): The
+            initial *uids*.
+
+    """
+
+    def __init__(self, uids=None):
+        """Initialize a UidSet object."""
+        self._starts = []
+        self._ends = []
+        if uids is not None:
+            self.update(uids)
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """Create a UidSet from a list of ``[first, last]`` ranges."""
+        uidset = cls()
+        uidset._merge([(int(first), int(last)) for first, last in ranges])
+        return uidset
+
+    @property
+    def ranges(self):
+        """Get the ranges.
+
+        :getter: The list of ``[first, last]`` ranges, sorted.
+        :type: list(list(int))
+        """
+        return [[first, last] for first, last in zip(self._starts,
+                                                     self._ends)]
+
+    def _merge(self, ranges):
+        """Merge a list of ``(first, last)`` ranges."""
+        ranges.extend(zip(self._starts, self._ends))
+        ranges.sort()
+        starts, ends = [], []
+        for first, last in ranges:
+            if ends and first <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], last)
+            else:
+                starts.append(first)
+                ends.append(last)
+        self._starts, self._ends = starts, ends
+
+    def update(self, uids):
+        """Add the *uids* of an iterable (or the ranges of a UidSet)."""
+        if isinstance(uids, UidSet):
+            self._merge(list(zip(uids._starts, uids._ends)))
+            return
+        ranges = []
+        for uid in sorted(set(int(u) for u in uids)):
+            if ranges and ranges[-1][1] + 1 == uid:
+                ranges[-1][1] = uid
+            else:
+                ranges.append([uid, uid])
+        self._merge([tuple(rng) for rng in ranges])
+
+    def add(self, uid):
+        """Add a *uid*."""
+        self.update([uid])
+
+    def upto(self, uid):
+        """Get a new UidSet with the *uids* lower or equal than `uid`."""
+        uid = int(uid)
+        idx = bisect.bisect_right(self._starts, uid)
+        uidset = UidSet()
+        uidset._starts = self._starts[:idx]
+        uidset._ends = self._ends[:idx]
+        if idx:
+            uidset._ends[-1] = min(uidset._ends[-1], uid)
+        return uidset
+
+    def sequence_set(self):
+        """Get the *IMAP* sequence set, as ``1:3,7``."""
+        return ','.join(str(first) if first == last else
+                        '{}:{}'.format(first, last)
+                        for first, last in zip(self._starts, self._ends))
+
+    def __contains__(self, uid):
+        """Check if a *uid* is in the set."""
+        uid = int(uid)
+        idx = bisect.bisect_right(self._starts, uid) - 1
+        return idx >= 0 and uid <= self._ends[idx]
+
+    def __iter__(self):
+        """Iterate over the *uids*, sorted."""
+        for first, last in zip(self._starts, self._ends):
+            for uid in range(first, last + 1):
+                yield uid
+
+    def __len__(self):
+        """Get the number of *uids*."""
+        return sum(last - first + 1
+                   for first, last in zip(self._starts, self._ends))
+
+    def __eq__(self, other):
+        """Check if two sets has the same *uids*."""
+        if not isinstance(other, UidSet):
+            return NotImplemented
+        return self._starts == other._starts and self._ends == other._ends
+
+    def __ne__(self, other):
+        """Check if two sets has different *uids*."""
+        res = self.__eq__(other)
+        return res if res is NotImplemented else not res
+
+    def __repr__(self):
+        """Get the representation."""
+        return "UidSet.from_ranges({!r})".format(self.ranges)
+
+
+#: Regular expression to get the data items of a ``FETCH`` response.
+_FETCH_ITEM_RE = re.compile(
+    r'\s*([A-Za-z0-9.]+(?:\[[^\]]*\])?(?:<\d+>)?)\s+'
+    r'(\([^)]*\)|"[^"]*"|\{\d+\}|[^\s()]+)')
+
+
+def parse_fetch(data):
+    # type: (list) -> Iterator[Tuple[int, dict]]
+    """Split the data of a multi-message ``FETCH`` response by message.
+
+    `data` is the list returned by :py:meth:`imaplib.IMAP4.uid` for a
+    ``FETCH`` command: the literals come as ``(header, literal)`` tuples and
+    the rest of the response as plain strings.
+
+    Args:
+        data (list): The ``FETCH`` response data.
+
+    Returns:
+        Iterator[Tuple[int, dict]]: For every message with an ``UID`` data
+        item, a pair with the *uid* and a :obj:`dict` with the data items,
+        using the upper case name of the item as key (e.g. ``'BODY[]'``).
+
+    """
+    messages = []
+    for elem in data:
+        literal = None
+        if isinstance(elem, tuple):
+            elem, literal = elem
+        if elem is None:
+            continue
+        if isinstance(elem, bytes):
+            elem = elem.decode('ascii', errors='replace')
+        if re.match(r'\d+ \(', elem):
+            messages.append([elem[elem.index('(') + 1:], []])
+        elif messages:
+            messages[-1][0] += elem
+        else:
+            continue
+        if literal is not None:
+            messages[-1][1].append(literal)
+
+    for text, literals in messages:
+        literals = iter(literals)
+        items = {}
+        for key, value in _FETCH_ITEM_RE.findall(text):
+            if value.startswith('{'):
+                value = next(literals, None)
+            items[key.upper()] = value
+        if 'UID' in items:
+            yield int(items['UID']), items
+
+
+def get_messages(imap, uids, batch_size=50, logger=None):
+    # type: (IsbgImap4, List[Uid], int, Optional[logging.Logger]) -> Iterator
+    """Get messages fetching them in batches of *uids*.
+
+    Every batch is fetched with a single ``UID FETCH`` command using a
+    compact sequence set (see :py:func:`uid_sequence_set`).
+
+    Args:
+        imap (IsbgImap4): The imap helper object with the connection.
+        uids (:obj:`list` of :obj:`int` or :obj:`str`): The *uids* of the
+            messages to fetch from the *imap* connection.
+        batch_size (int, optional): The max number of messages fetched by
+            every command. Defaults to *50*.
+        logger (logging.Logger, optional): When a message cannot be fetched
+            a warning is written to this logger. Defaults to *None*.
+
+    Returns:
+        Iterator[Tuple[Uid, RawMessage]]: The *uid* and the message fetched,
+        in the same order than `uids`. If a message cannot be fetched, an
+        empty `email.message.Message` is returned.
+
+    """
+    uids = list(uids)
+    for start in range(0, len(uids), batch_size):
+        batch = uids[start:start + batch_size]
+        res = imap.uid("FETCH", uid_sequence_set(batch), "(BODY.PEEK[])")
+        for message in fetched_messages(batch, res, logger):
+            yield message
+
+
+def fetched_messages(uids, res, logger=None):
+    # type: (List[Uid], tuple, Optional[logging.Logger]) -> Iterator
+    """Get the messages of a ``UID FETCH`` of a batch of *uids*.
+
+    Args:
+        uids (:obj:`list` of :obj:`int` or :obj:`str`): The *uids* fetched.
+        res (tuple): The response of the ``UID FETCH ... (BODY.PEEK[])``.
+        logger (logging.Logger, optional): When a message has not been
+            fetched a warning is written to this logger. Defaults to *None*.
+
+    Returns:
+        Iterator[Tuple[Uid, RawMessage]]: The *uid* and the message fetched,
+        in the same order than `uids`, as :py:func:`get_messages`.
+
+    """
+    bodies = {}
+    if res[0] == "OK":
+        for uid, items in parse_fetch(res[1]):
+            bodies[uid] = items.get('BODY[]')
+    for uid in uids:
+        mail = email.message.Message()  # an empty email
+        try:
+            mail = RawMessage(bodies[int(uid)])
+        except Exception:  # pylint: disable=broad-except
+            if logger:
+                logger.warning(__(
+                    ("Confused - rfc822 fetch of {} gave {} - The " +
+                     "message was probably deleted while we were " +
+                     "running").format(uid, res[0])))
+        yield uid, mail
+
+
+#: The header fields fetched to get the fingerprint of a message.
+FINGERPRINT_FIELDS = "MESSAGE-ID DATE FROM"
+
+
+def get_fingerprints(imap, uids, batch_size=200):
+    # type: (IsbgImap4, List[Uid], int) -> dict
+    """Get the fingerprints of messages, without fetching their bodies.
+
+    Only the size and the :py:data:`FINGERPRINT_FIELDS` headers are fetched,
+    in batches of *uids*.
+
+    Args:
+        imap (IsbgImap4): The imap helper object with the connection.
+        uids (:obj:`list` of :obj:`int` or :obj:`str`): The *uids*.
+        batch_size (int, optional): The max number of messages fetched by
+            every command. Defaults to *200*.
+
+    Returns:
+        dict: The fingerprint of every *uid* (as :obj:`int`), see
+        :py:func:`fetched_fingerprints`.
+
+    """
+    uids = list(uids)
+    fingerprints = {}
+    for start in range(0, len(uids), batch_size):
+        res = imap.uid("FETCH", uid_sequence_set(uids[start:start +
+                                                      batch_size]),
+                       "(RFC822.SIZE BODY.PEEK[HEADER.FIELDS ({})])".format(
+                           FINGERPRINT_FIELDS))
+        fingerprints.update(fetched_fingerprints(res))
+    return fingerprints
+
+
+def fetched_fingerprints(res):
+    # type: (tuple) -> dict
+    """Get the fingerprints of the messages of a ``UID FETCH``.
+
+    The fingerprint is a hash of the size and the normalized
+    :py:data:`FINGERPRINT_FIELDS` headers of the message. The messages
+    without any of these headers have not fingerprint.
+
+    Args:
+        res (tuple): The response of the ``UID FETCH`` of
+            :py:func:`get_fingerprints`.
+
+    Returns:
+        dict: The fingerprint (a :obj:`str`, or *None*) of every *uid* (as
+        :obj:`int`) found in the response.
+
+    """
+    fingerprints = {}
+    if res[0] != "OK":
+        return fingerprints
+    for uid, items in parse_fetch(res[1]):
+        headers = b''
+        for key, value in items.items():
+            if key.startswith('BODY[HEADER') and value is not None:
+                headers = value
+        if not isinstance(headers, bytes):
+            headers = headers.encode('utf-8', errors='replace')
+        headers = b' '.join(headers.lower().split())
+        if headers:
+            size = items.get('RFC822.SIZE', '0').encode('ascii')
+            fingerprints[uid] = sha256(size + b' ' + headers).hexdigest()
+        else:
+            fingerprints[uid] = None
+    return fingerprints
+
+
+#: The regex of the ``Message-ID`` header.
+MESSAGEID_RE = re.compile(br'^message-id:\s*(<[^>\r\n]*>)',
+                          re.IGNORECASE | re.MULTILINE)
+
+
+def _message_key(headers, size):
+    # type: (AnyStr, int) -> str
+    """Get the key of a message from its headers and its size."""
+    if not isinstance(headers, bytes):
+        headers = headers.encode('utf-8', errors='replace')
+    match = MESSAGEID_RE.search(headers)
+    if match is None:
+        return None
+    return "{} {}".format(match.group(1).decode('ascii', 'replace'), size)
+
+
+def message_key(mail):
+    # type: (Email) -> str
+    """Get the key of a message to find it again if its *uid* changes.
+
+    The key is the ``Message-ID`` and the size of the message, as got by
+    :py:func:`get_message_keys` without fetching the message again.
+
+    Args:
+        mail (RawMessage): The message, as fetched.
+
+    Returns:
+        str: The key, or *None* if the message has not ``Message-ID``.
+
+    """
+    content = mail_content(mail)
+    match = re.search(b'\r?\n\r?\n' if isinstance(content, bytes)
+                      else '\r?\n\r?\n', content)
+    headers = content if match is None else content[:match.start()]
+    return _message_key(headers, len(content))
+
+
+def get_message_keys(imap, uids, batch_size=200):
+    # type: (IsbgImap4, List[Uid], int) -> dict
+    """Get the keys of messages, without fetching their bodies.
+
+    Only the size and the ``Message-ID`` are fetched, in batches of *uids*.
+
+    Args:
+        imap (IsbgImap4): The imap helper object with the connection.
+        uids (:obj:`list` of :obj:`int` or :obj:`str`): The *uids*.
+        batch_size (int, optional): The max number of messages fetched by
+            every command. Defaults to *200*.
+
+    Returns:
+        dict: The key of every *uid* (as :obj:`int`), see
+        :py:func:`fetched_message_keys`.
+
+    """
+    uids = list(uids)
+    keys = {}
+    for start in range(0, len(uids), batch_size):
+        res = imap.uid("FETCH", uid_sequence_set(uids[start:start +
+                                                      batch_size]),
+                       "(RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])")
+        keys.update(fetched_message_keys(res))
+    return keys
+
+
+def fetched_message_keys(res):
+    # type: (tuple) -> dict
+    """Get the keys of the messages of a ``UID FETCH``.
+
+    Args:
+        res (tuple): The response of the ``UID FETCH`` of
+            :py:func:`get_message_keys`.
+
+    Returns:
+        dict: The key (a :obj:`str`, or *None*, see :py:func:`message_key`)
+        of every *uid* (as :obj:`int`) found in the response.
+
+    """
+    keys = {}
+    if res[0] != "OK":
+        return keys
+    for uid, items in parse_fetch(res[1]):
+        headers = b''
+        for key, value in items.items():
+            if key.startswith('BODY[HEADER') and value is not None:
+                headers = value
+        keys[uid] = _message_key(headers, int(items.get('RFC822.SIZE', 0)))
+    return keys
+
+
+def get_headers(imap, uids, batch_size=200):
+    # type: (IsbgImap4, List[Uid], int) -> dict
+    """Get the headers and the ``INTERNALDATE`` of messages.
+
+    The bodies are not fetched. The messages are fetched in batches of
+    *uids*.
+
+    Args:
+        imap (IsbgImap4): The imap helper object with the connection.
+        uids (:obj:`list` of :obj:`int` or :obj:`str`): The *uids*.
+        batch_size (int, optional): The max number of messages fetched by
+            every command. Defaults to *200*.
+
+    Returns:
+        dict: The headers of every *uid* (as :obj:`int`), see
+        :py:func:`fetched_headers`.
+
+    """
+    uids = list(uids)
+    headers = {}
+    for start in range(0, len(uids), batch_size):
+        res = imap.uid("FETCH", uid_sequence_set(uids[start:start +
+                                                      batch_size]),
+                       "(INTERNALDATE BODY.PEEK[HEADER])")
+        headers.update(fetched_headers(res))
+    return headers
+
+
+def fetched_headers(res):
+    # type: (tuple) -> dict
+    """Get the headers of the messages of a ``UID FETCH``.
+
+    Args:
+        res (tuple): The response of the ``UID FETCH`` of
+            :py:func:`get_headers`.
+
+    Returns:
+        dict: A tuple with the ``INTERNALDATE`` (as seconds since the epoch,
+        *None* if it's unknown) and the headers (a
+        `email.message.Message` without body) of every *uid* (as
+        :obj:`int`) found in the response.
+
+    """
+    headers = {}
+    if res[0] != "OK":
+        return headers
+    for uid, items in parse_fetch(res[1]):
+        internaldate = items.get('INTERNALDATE')
+        if internaldate is not None:
+            internaldate = imaplib.Internaldate2tuple(
+                'INTERNALDATE {}'.format(internaldate).encode('ascii'))
+        if internaldate is not None:
+            internaldate = time.mktime(internaldate)
+        try:
+            mail = new_message(items.get('BODY[HEADER]') or b'')
+        except TypeError:
+            mail = email.message.Message()  # an empty email
+        headers[uid] = (internaldate, mail)
+    return headers
+
+
+def parse_status(data):
+    # type: (list) -> dict
+    """Get the items of a ``STATUS`` response as integers.
+
+    Args:
+        data (list): The ``STATUS`` response data, e.g.
+            ``['INBOX (UIDNEXT 12 MESSAGES 10)']``.
+
+    Returns:
+        dict: The items, as ``{'UIDNEXT': 12, 'MESSAGES': 10}``.
+
+    """
+    status = {}
+    if data and data[0]:
+        body = data[0]
+        if isinstance(body, bytes):
+            body = body.decode('ascii', errors='replace')
+        body = body[body.rfind('(') + 1:]
+        for name, value in re.findall(r'([A-Za-z]+)\s+(\d+)', body):
+            status[name.upper()] = int(value)
+    return status
+
+
 def imapflags(flaglist):
     # type: (List[str]) -> str
     """Transform a list to a string as expected for the IMAP4 standard.
@@ -166,6 +848,19 @@ def imapflags(flaglist):
     return '(' + ','.join(flaglist) + ')'
 
 
+def ascii_fetch_response(res):
+    """Convert a ``FETCH`` response to *ascii*, but its literals.
+
+    The literals (the messages) are kept as they are, so they are not copied
+    and they can be used as :py:class:`RawMessage`.
+    """
+    typ, data = res
+    return (utils.get_ascii_or_value(typ),
+            [(utils.get_ascii_or_value(elem[0]), elem[1])
+             if isinstance(elem, tuple) else utils.get_ascii_or_value(elem)
+             for elem in data])
+
+
 def bytes_to_ascii(func):
     """Decorate a method to return his return value as *ascii*."""
     def func_wrapper(cls, *args, **kwargs):
@@ -190,6 +885,60 @@ def assertok(name):
     return assertok_decorator
 
 
+def synchronized(func):
+    """Decorate a method to run it holding the connection lock."""
+    def func_wrapper(cls, *args, **kwargs):
+        with cls.lock:
+            return func(cls, *args, **kwargs)
+    return func_wrapper
+
+
+class _DeflateStream(io.RawIOBase):
+    """A raw stream over a socket compressed with *DEFLATE* (:rfc:`1951`).
+
+    It's used with ``COMPRESS=DEFLATE`` (:rfc:`4978`): the writes are
+    compressed and flushed, so every command is sent at once, and the reads
+    are decompressed.
+    """
+
+    def __init__(self, sock):
+        """Initialize a _DeflateStream object over `sock`."""
+        super(_DeflateStream, self).__init__()
+        self.sock = sock
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                            zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+        self._pending = b''
+        self._offset = 0
+
+    def readable(self):
+        """Return True, the stream is readable."""
+        return True
+
+    def writable(self):
+        """Return True, the stream is writable."""
+        return True
+
+    def readinto(self, buf):
+        """Read decompressed data into `buf`."""
+        while self._offset >= len(self._pending):
+            data = self.sock.recv(65536)
+            if not data:
+                return 0
+            self._pending = self._decompressor.decompress(data)
+            self._offset = 0
+        size = min(len(buf), len(self._pending) - self._offset)
+        buf[:size] = self._pending[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+    def write(self, data):
+        """Compress and send `data`."""
+        self.sock.sendall(self._compressor.compress(bytes(data)) +
+                          self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        return len(data)
+
+
 class IsbgImap4(object):
     """Proxy class for :obj:`imaplib.IMAP4` and :obj:`imaplib.IMAP4_SSL`.
 
@@ -197,74 +946,135 @@ class IsbgImap4(object):
     decorators to log the calls and to try to convert the returns values to
     str.
 
-    The only original method is ``get_uidvalidity``, used to return the current
-    *uidvalidity* from a mailbox.
+    The only original methods are ``get_uidvalidity``, used to return the
+    current *uidvalidity* from a mailbox, ``get_status``, to get the status
+    items of a mailbox as integers, ``examine``, to get the ``EXISTS`` and
+    ``UIDNEXT`` of a mailbox, ``has_capability``, ``compress`` and ``idle``.
+
+    Every command holds the `lock`, so the connection can be shared between
+    threads (the commands are run one after another).
 
     """
 
     def __init__(self, host='', port=143, nossl=False, assertok=None):
         """Create a imaplib.IMAP4[_SSL] with an assertok method."""
         self.assertok = assertok
+        self.lock = threading.RLock()
         self.nossl = nossl
+        self._capabilities = None
         if nossl:
             self.imap = imaplib.IMAP4(host, port)
         else:
             self.imap = imaplib.IMAP4_SSL(host, port)
 
+    @synchronized
     # @assertok('append')  <-- it fails in some servers
     @bytes_to_ascii
     def append(self, mailbox, flags, date_time, message):
         """Append message to named mailbox."""
         return self.imap.append(mailbox, flags, date_time, message)
 
+    @synchronized
     @assertok('cabability')
     @bytes_to_ascii
     def capability(self):
         """Fetch capabilities list from server."""
         return self.imap.capability()
 
+    @synchronized
     @assertok('expunge')
     @bytes_to_ascii
     def expunge(self):
         """Permanently remove deleted items from selected mailbox."""
         return self.imap.expunge()
 
+    @synchronized
     @assertok('list')
     @bytes_to_ascii
     def list(self, directory='""', pattern='*'):
         """List mailbox names in directory matching pattern."""
         return self.imap.list(directory, pattern)
 
+    @synchronized
     @assertok('login')
     @bytes_to_ascii
     def login(self, user, passwd):
         """Identify client using plain text password."""
+        self._capabilities = None  # They can change after login.
         return self.imap.login(user, passwd)
 
+    @synchronized
     @assertok('logout')
     @bytes_to_ascii
     def logout(self):
         """Shutdown connection to server."""
         return self.imap.logout()
 
+    def shutdown(self):
+        """Close the connection to the server without ``LOGOUT``.
+
+        It's used when the connection has been lost, so the socket is not
+        leaked.
+        """
+        self.imap.shutdown()
+
+    @synchronized
+    @assertok('noop')
+    @bytes_to_ascii
+    def noop(self):
+        """Send NOOP command."""
+        return self.imap.noop()
+
+    @synchronized
     @assertok('status')
     @bytes_to_ascii
     def status(self, mailbox, names):
         """Request named status conditions for mailbox."""
         return self.imap.status(mailbox, names)
 
+    @synchronized
     @assertok('select')
     @bytes_to_ascii
     def select(self, mailbox='INBOX', readonly=False):
         """Select a Mailbox."""
         return self.imap.select(mailbox, readonly)
 
+    @synchronized
     @assertok('uid')
-    @bytes_to_ascii
     def uid(self, command, *args):
-        """Execute "command arg ..." with messages identified by UID."""
-        return self.imap.uid(command, *args)
+        """Execute "command arg ..." with messages identified by UID.
+
+        The literals of a ``FETCH`` are not converted to *ascii*.
+        """
+        res = self.imap.uid(command, *args)
+        if command.upper() == 'FETCH':
+            return ascii_fetch_response(res)
+        return utils.get_ascii_or_value(res)
+
+    @synchronized
+    def examine(self, mailbox):
+        """Select a mailbox read-only and get its state.
+
+        Args:
+            mailbox (str): The mailbox.
+
+        Returns:
+            dict: The ``EXISTS`` and, if the server has sent it, the
+            ``UIDNEXT`` of the mailbox, as integers.
+
+        """
+        res = self.select(mailbox, True)
+        state = {}
+        try:
+            state['EXISTS'] = int(res[1][0])
+        except (TypeError, ValueError, IndexError):
+            pass
+        uidnext = self.imap.response('UIDNEXT')[1]
+        if uidnext and uidnext[-1] is not None:
+            state['UIDNEXT'] = int(uidnext[-1])
+        return state
 
+    @synchronized
     def get_uidvalidity(self, mailbox):
         """Validate a mailbox.
 
@@ -285,9 +1095,154 @@ class IsbgImap4(object):
                 uidvalidity = int(uidval.groups()[0])
         return uidvalidity
 
+    @synchronized
+    def get_status(self, mailbox, names):
+        """Get status items of a mailbox.
+
+        Args:
+            mailbox (str): The mailbox.
+            names (list(str)): The items, e.g. ``['UIDNEXT', 'MESSAGES']``.
+
+        Returns:
+            dict: The items returned by the server, as integers. The items
+            not returned (e.g. ``HIGHESTMODSEQ`` without ``CONDSTORE``) are
+            not in it.
+
+        """
+        mbstatus = self.imap.status(mailbox, '({})'.format(' '.join(names)))
+        if mbstatus[0] != 'OK':
+            return {}
+        return parse_status(mbstatus[1])
+
+    @synchronized
+    def compress(self):
+        """Enable ``COMPRESS=DEFLATE`` (:rfc:`4978`).
+
+        After it, all the data sent and received through the connection is
+        compressed.
+
+        Returns:
+            bool: *True* if the compression has been enabled, *False* if the
+            server does not support it or has refused it.
+
+        """
+        if not self.has_capability('COMPRESS=DEFLATE'):
+            return False
+        typ, _ = self.imap._simple_command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            return False
+        # python 2 IMAP4_SSL reads and writes with sslobj, not with sock.
+        sock = getattr(self.imap, 'sslobj', None) or self.imap.sock
+        stream = _DeflateStream(sock)
+        reader = io.BufferedReader(stream)
+        self.imap.file = reader
+        self.imap.read = reader.read
+        self.imap.readline = reader.readline
+        self.imap.send = stream.write
+        return True
+
+    def _readline_timeout(self, timeout):
+        """Read a line, waiting for it at most `timeout` seconds.
+
+        The line is read with a timeout in the socket, so the data already
+        read and kept by the readers (e.g. decompressed or in the buffer of
+        the file) is also seen.
+
+        Returns:
+            bytes: The line, or *None* after `timeout` seconds without it.
+
+        """
+        sock = getattr(self.imap, 'sslobj', None) or self.imap.sock
+        oldtimeout = sock.gettimeout()
+        sock.settimeout(timeout)
+        try:
+            return self.imap.readline()
+        except socket.timeout:
+            # The python 3 socket files can't be read after a timeout.
+            if isinstance(getattr(self.imap.file, 'raw', None),
+                          getattr(socket, 'SocketIO', ())):
+                self.imap.file = self.imap.sock.makefile('rb')
+            return None
+        finally:
+            sock.settimeout(oldtimeout)
+
+    @synchronized
+    def idle(self, timeout=29 * 60):
+        """Wait for changes in the selected mailbox with ``IDLE``.
+
+        It sends ``IDLE`` (:rfc:`2177`) and waits for an untagged response
+        from the server, or until `timeout`, and then it ends it with
+        ``DONE``.
+
+        Args:
+            timeout (float): The max seconds to wait. The server can end the
+                connection after 30 minutes, so it should be lower.
+
+        Returns:
+            list(str): The untagged responses got, e.g. ``['* 3 EXISTS']``.
+            If it's empty, nothing has changed before `timeout`.
+
+        Raises:
+            imaplib.IMAP4.error: If the server has refused ``IDLE``.
+            imaplib.IMAP4.abort: If the connection has been closed.
+
+        """
+        imap = self.imap
+        tag = imap._new_tag()
+        imap.tagged_commands.pop(tag, None)  # We read the response.
+        imap.send(tag + b' IDLE\r\n')
+        responses = []
+        while True:
+            line = imap.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("socket error: EOF in IDLE")
+            if line.startswith(b'+'):
+                break
+            if line.startswith(tag):
+                raise imaplib.IMAP4.error("IDLE command error: {}".format(
+                    utils.get_ascii_or_value(line.strip())))
+            responses.append(line)
+        if not responses:
+            line = self._readline_timeout(timeout)
+            if line == b'':
+                raise imaplib.IMAP4.abort("socket error: EOF in IDLE")
+            if line is not None:
+                responses.append(line)
+        imap.send(b'DONE\r\n')
+        while True:
+            line = imap.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("socket error: EOF in IDLE")
+            if line.startswith(tag):
+                break
+            responses.append(line)
+        return [utils.get_ascii_or_value(line.strip()) for line in responses
+                if line.strip()]
+
+    def has_capability(self, name):
+        """Check if the server has a capability, e.g. ``CONDSTORE``."""
+        with self.lock:
+            if self._capabilities is None:
+                res = self.capability()
+                self._capabilities = set(
+                    ' '.join(c for c in res[1] if c).upper().split())
+            return name.upper() in self._capabilities
+
+
+class ImapConnectionError(socket.error):
+    """The connection to the *imap* server has failed after several retries.
+
+    It's a `socket.error`, as the errors that it replaces.
+    """
+
 
 def login_imap(imapsets, logger=None, assertok=None):
-    """Login to the imap server."""
+    """Login to the imap server.
+
+    Raises:
+        ImapConnectionError: If it can't connect to the server.
+
+    """
     if not isinstance(imapsets, ImapSettings):
         raise TypeError("imapsets is not a ImapSettings")
 
@@ -304,7 +1259,7 @@ def login_imap(imapsets, logger=None, assertok=None):
                     ("Error in IMAP connection: {} ... retry {} of {}"
                      ).format(exc, retry, max_retry)))
             if retry >= max_retry:
-                raise Exception(exc)
+                raise ImapConnectionError(exc)
             else:
                 time.sleep(retry_time)
     if logger:
@@ -314,6 +1269,11 @@ def login_imap(imapsets, logger=None, assertok=None):
         logger.warning("WARNING: Using insecure IMAP connection: without SSL.")
     # Authenticate (only simple supported)
     imap.login(imapsets.user, imapsets.passwd)
+    if imapsets.compress:
+        compressed = imap.compress()
+        if logger:
+            logger.debug(__("IMAP compression: {}".format(
+                "enabled" if compressed else "not supported")))
     return imap
 
 
@@ -327,6 +1287,8 @@ class ImapSettings(object):
         self.user = ''               #: IMAP user name.
         self.passwd = None           #: Password for the IMAP user name.
         self.nossl = False           #: Not use ssl for IMAP connection.
+        #: Use ``COMPRESS=DEFLATE`` if the server supports it.
+        self.compress = False
 
         #: Inbox folder, default to ```INBOX```.
         self.inbox = 'INBOX'
@@ -24,17 +24,21 @@ import os
 import sys     # Because sys.stderr.write() is called bellow
 
 from isbg import imaputils
+from isbg import learned
 from isbg import secrets
 from isbg import spamproc
 from isbg import utils
+from isbg import verdicts
 
 from .utils import __
 
 import atexit
 import getpass
+import imaplib
 import json
 import logging
 import re
+import socket
 import time
 
 # xdg base dir specification (only xdg_cache_home is used)
@@ -211,6 +215,35 @@ class ISBG(object):
             ``False``.
         spamc (bool): If True use spamc instead of standalone SpamAssassin.
             Default to ``False``.
+        spamd (str): If it's not None, the ``spamd`` address (``host[:port]``
+            or a unix socket path) used with the native ``spamd`` client
+            instead of ``spamc`` or SpamAssassin. Default to ``None``.
+        singlepass (bool): If True the spam score and the message with the
+            SpamAssassin report are got in only one pass. Default to
+            ``False``.
+        workers (int): The number of messages scanned concurrently. Default
+            to ``1``.
+        verdictcache (bool): If True the verdicts are stored in a cache
+            shared by all the accounts, and the messages found in it are not
+            scanned again. Default to ``False``.
+        verdictttl (int): The seconds that a verdict of the cache is valid.
+            Default to ``21600``.
+        verdictfilename (str): The cache file name. Default to
+            ``xdg_cache_home``/isbg/verdicts.
+        verdicts (isbg.verdicts.VerdictCache): The cache used if
+            `verdictcache`, initialized the first time that is needed.
+        trustspamheaders (str): If it's not None, the host of the MTA whose
+            ``X-Spam-Status`` headers are trusted, so the messages with them
+            are not scanned again. Default to ``None``.
+        spamheadersmaxage (int): The max age in seconds of the messages
+            whose ``X-Spam-Status`` is trusted. Default to ``3600``.
+        scankeyword (str): If it's not None, the processed messages of the
+            inbox are marked with this keyword and the messages without it
+            are processed, instead of using the trackfile. Default to
+            ``None``.
+        sa_semaphore (threading.Semaphore): If it's not None, it's held
+            while calling to SpamAssassin, to limit the calls of several
+            accounts processed concurrently. Default to ``None``.
         gmail (bool): If True Delete by copying to `[Gmail]/Trash` folder.
             Default to ``False``.
         deletehigherthan (float): If it's not None, the minimum score from a
@@ -229,6 +262,13 @@ class ISBG(object):
             Default to ``False``.
         learnthenflag (bool): If True flag learned messages. Default to
             ``False``.
+        learnworkers (int): The number of messages learned concurrently.
+            Default to ``1``.
+        learnedindex (bool): If True the fingerprints of the messages learned
+            are stored, and they are not fetched nor learned again. Default
+            to ``False``.
+        fingerprints (isbg.learned.LearnedIndex): The index used if
+            `learnedindex`, initialized the first time that is needed.
         movehamto (str): If it's not None, IMAP folder where the ham mail will
             be moved. Default to ``None``.
 
@@ -257,9 +297,34 @@ class ISBG(object):
         trackfile (str): Base name where the processed ``uids`` will be stored
             to not reprocess them. Default to ``None`` when initialized and
             initialized the first time that is needed.
+        verdictindex (bool): If True the ``Message-ID`` and the size of the
+            messages processed are also stored in the trackfiles, so the
+            messages are remapped to their new ``uids`` when the
+            ``UIDVALIDITY`` of a folder changes (see :py:meth:`past_read`).
+            Default to ``False``.
+
+    This attribute is derived from the command line and related to the
+    daemon mode:
+
+    Attributes:
+        daemon (bool): If True keep running, waiting for new messages with
+            ``IDLE``, see :py:meth:`do_daemon`. Default to ``False``.
 
     """
 
+    #: The ``STATUS`` items used to check if a folder has changed.
+    status_items = ['UIDNEXT', 'MESSAGES', 'UIDVALIDITY']
+    #: In daemon mode, max seconds in ``IDLE`` (:rfc:`2177` recommends to
+    #: reissue it at least every 29 minutes).
+    idle_timeout = 29 * 60
+    #: In daemon mode, seconds between checks without ``IDLE`` support.
+    poll_interval = 5 * 60
+    #: In daemon mode, seconds to wait before reconnecting after an error.
+    #: It's doubled after every failed reconnection.
+    reconnect_delay = 60
+    #: In daemon mode, max seconds to wait before reconnecting.
+    max_reconnect_delay = 30 * 60
+
     def __init__(self):
         """Initialize a ISBG object."""
         self.imapsets = imaputils.ImapSettings()
@@ -273,7 +338,8 @@ class ISBG(object):
         #    datefmt='%Y%m%d %H:%M:%S %Z')
         # see https://docs.python.org/2/howto/logging-cookbook.html
         self.logger = logging.getLogger(__name__)       #: a logger
-        self.logger.addHandler(logging.StreamHandler())
+        if not self.logger.handlers:
+            self.logger.addHandler(logging.StreamHandler())
 
         # We create the dir for store cached information (if needed)
         if not os.path.isdir(os.path.join(xdg_cache_home, "isbg")):
@@ -285,13 +351,24 @@ class ISBG(object):
         self._set_loglevel(logging.INFO)
         # Processing options:
         self.dryrun, self.maxsize, self.teachonly = (False, 120000, False)
-        self.spamc, self.gmail = (False, False)
+        self.spamc, self.gmail, self.spamd = (False, False, None)
+        self.singlepass, self.workers = (False, 1)
+        self.sa_semaphore = None
+        # Verdict cache options:
+        self.verdictcache, self.verdictttl = (False, 6 * 3600)
+        self.verdictfilename = os.path.join(xdg_cache_home, "isbg",
+                                            "verdicts")
+        self.verdicts = None
+        self.trustspamheaders, self.spamheadersmaxage = (None, 3600)
+        self.scankeyword = None
         # spamassassin options:
         self.movehamto, self.delete = (None, False)
         self.deletehigherthan, self.flag, self.expunge = (None, False, False)
         # Learning options:
         self.learnflagged, self.learnunflagged = (False, False)
         self.learnthendestroy, self.learnthenflag = (False, False)
+        self.learnworkers = 1
+        self.learnedindex, self.fingerprints = (False, None)
         # Lockfile options:
         self.ignorelockfile = False
         self.lockfilename = os.path.join(xdg_cache_home, "isbg", "lock")
@@ -300,6 +377,11 @@ class ISBG(object):
         self.passwdfilename, self.savepw = (None, False)
         # Trackfile options:
         self.trackfile, self.partialrun = (None, 50)
+        self.verdictindex = False
+        # Daemon mode:
+        self.daemon = False
+        # The STATUS of the inbox when it was processed the last time.
+        self._inbox_status = None
 
         try:
             self.interactive = sys.stdin.isatty()
@@ -381,30 +463,247 @@ class ISBG(object):
                             "\n%s returned %s - aborting\n" % (repr(args), res)
                             )
 
-    def pastuid_read(self, uidvalidity, folder='inbox'):
-        """Read the uids stored in a file for  a folder.
+    def trackfile_load(self, folder):
+        """Load the trackfile of a folder.
+
+        The trackfile is parsed once per folder and run, and its contents are
+        passed as `struct` to :py:meth:`status_unchanged`,
+        :py:meth:`past_read`, :py:meth:`pastuid_read`,
+        :py:meth:`highwater_read`, :py:meth:`modseq_read` and
+        :py:meth:`index_read`.
+
+        Returns:
+            dict: The contents of the trackfile, empty if it doesn't exist or
+            it can't be read.
 
-        pastuids_read keeps track of which uids we have already seen, so
-        that we don't analyze them multiple times. We store its
-        contents between sessions by saving into a file as Python
-        code (makes loading it here real easy since we just source
-        the file)
         """
         if self.trackfile is None:
             self.trackfile = ISBG.set_filename(self.imapsets, "track")
-        pastuids = []
         try:
             with open(self.trackfile + folder, 'r') as rfile:
                 struct = json.load(rfile)
-                if struct['uidvalidity'] == uidvalidity:
-                    pastuids = struct['uids']
+                if isinstance(struct, dict):
+                    return struct
+        except Exception:  # pylint: disable=broad-except
+            pass
+        return {}
+
+    def _trackfile_read(self, uidvalidity, folder, struct=None):
+        """Read the trackfile of a folder, if its `uidvalidity` matches.
+
+        Args:
+            uidvalidity (int): The current ``UIDVALIDITY``.
+            folder (str): The name of the trackfile folder.
+            struct (dict, optional): The trackfile already loaded with
+                :py:meth:`trackfile_load`. If *None*, it's loaded.
+        Returns:
+            dict: The contents of the trackfile, or *None* if it doesn't
+            exist, it can't be read or the `uidvalidity` has changed.
+
+        """
+        if struct is None:
+            struct = self.trackfile_load(folder)
+        if struct.get('uidvalidity') == uidvalidity:
+            return struct
+        return None
+
+    def pastuid_read(self, uidvalidity, folder='inbox', struct=None):
+        """Read the uids stored in a file for  a folder.
+
+        pastuids_read keeps track of which uids we have already seen, so
+        that we don't analyze them multiple times. We store its
+        contents between sessions by saving into a json file the ranges of
+        uids.
+
+        Trackfiles written by older versions, with the list of every uid, are
+        also read (and written with ranges the next time).
+
+        Returns:
+            isbg.imaputils.UidSet: The past uids, empty if the trackfile
+            doesn't exist or the `uidvalidity` has changed.
+
+        """
+        pastuids = imaputils.UidSet()
+        struct = self._trackfile_read(uidvalidity, folder, struct)
+        try:
+            if struct is None:
+                pass
+            elif 'ranges' in struct:
+                pastuids = imaputils.UidSet.from_ranges(struct['ranges'])
+            else:  # The format of isbg <= 2.1.0
+                pastuids = imaputils.UidSet(struct['uids'])
         except Exception:  # pylint: disable=broad-except
             pass
         return pastuids
 
+    def highwater_read(self, uidvalidity, folder='inbox', struct=None):
+        """Read the high-water mark stored in a file for a folder.
+
+        The high-water mark is the highest *uid* that, with all the lower
+        ones, has been already processed, so only the higher *uids* have to
+        be searched.
+
+        Returns:
+            int: The high-water mark, ``0`` if the trackfile doesn't exist,
+            the `uidvalidity` has changed or `maxsize` is now higher (so
+            bigger messages, not processed before, have to be checked).
+
+        """
+        struct = self._trackfile_read(uidvalidity, folder, struct)
+        try:
+            if struct is not None and struct['maxsize'] >= self.maxsize:
+                return int(struct['highwater'])
+        except Exception:  # pylint: disable=broad-except
+            pass
+        return 0
+
+    def modseq_read(self, uidvalidity, folder, struct=None):
+        """Read the ``HIGHESTMODSEQ`` stored in a file for a folder.
+
+        Returns:
+            int: The ``HIGHESTMODSEQ`` of the folder in the last run, ``0``
+            if it's unknown or the `uidvalidity` has changed.
+
+        """
+        struct = self._trackfile_read(uidvalidity, folder, struct)
+        try:
+            if struct is not None:
+                return int(struct.get('highestmodseq', 0))
+        except Exception:  # pylint: disable=broad-except
+            pass
+        return 0
+
+    def index_read(self, uidvalidity, folder='inbox', struct=None):
+        """Read the verdict index stored in a file for a folder.
+
+        Returns:
+            dict: The *uid* and the verdict of the messages processed by
+            their key (see :py:func:`isbg.imaputils.message_key`), empty if
+            it's unknown or the `uidvalidity` has changed.
+
+        """
+        struct = self._trackfile_read(uidvalidity, folder, struct)
+        try:
+            if struct is not None:
+                return dict(struct.get('index', {}))
+        except Exception:  # pylint: disable=broad-except
+            pass
+        return {}
+
+    def _stale_index(self, uidvalidity, folder, struct=None):
+        """Read the verdict index of a folder whose `uidvalidity` changed.
+
+        Returns:
+            dict: The verdict index stored with the old ``UIDVALIDITY``,
+            empty if `verdictindex` is not set, the trackfile doesn't exist
+            or the `uidvalidity` has not changed.
+
+        """
+        if not self.verdictindex:
+            return {}
+        if struct is None:
+            struct = self.trackfile_load(folder)
+        try:
+            if struct.get('uidvalidity', uidvalidity) != uidvalidity:
+                return dict(struct.get('index', {}))
+        except Exception:  # pylint: disable=broad-except
+            pass
+        return {}
+
+    def _remap_index(self, stale, keys, folder):
+        """Remap the messages of a stale verdict index to their new uids.
+
+        Args:
+            stale (dict): The verdict index with the old ``UIDVALIDITY``.
+            keys (dict): The key of every *uid* of the folder, as returned by
+                :py:func:`isbg.imaputils.get_message_keys`.
+            folder (str): The name of the trackfile folder.
+        Returns:
+            tuple: The past uids (a :py:class:`isbg.imaputils.UidSet`) and
+            the verdict index with the new uids.
+
+        """
+        index = {}
+        for uid, key in keys.items():
+            if key is not None and key in stale:
+                index[key] = [uid, stale[key][1]]
+        self.logger.info(__(
+            "UIDVALIDITY of {} has changed: {}/{} messages remapped".format(
+                folder, len(index), len(keys))))
+        return imaputils.UidSet(v[0] for v in index.values()), index
+
+    def past_read(self, uidvalidity, folder, mailbox, struct=None):
+        """Read the past uids and the verdict index of a folder.
+
+        If `verdictindex` is set and the ``UIDVALIDITY`` of the folder has
+        changed, e.g. after a server migration, the keys of all its messages
+        are fetched (without their bodies) and the messages found in the old
+        index are remapped to their new uids, so only the new messages are
+        processed again.
+
+        Args:
+            uidvalidity (int): The current ``UIDVALIDITY``.
+            folder (str): The name of the trackfile folder.
+            mailbox (str): The IMAP folder.
+            struct (dict, optional): The trackfile already loaded with
+                :py:meth:`trackfile_load`. If *None*, it's loaded.
+        Returns:
+            tuple: The past uids, as :py:meth:`pastuid_read`, and the verdict
+            index, as :py:meth:`index_read`.
+
+        """
+        if struct is None:
+            struct = self.trackfile_load(folder)
+        stale = self._stale_index(uidvalidity, folder, struct)
+        if not stale:
+            return (self.pastuid_read(uidvalidity, folder, struct),
+                    self.index_read(uidvalidity, folder, struct))
+        self.imap.select(mailbox, 1)
+        _, uids = self.imap.uid("SEARCH", None, "ALL")
+        return self._remap_index(
+            stale, imaputils.get_message_keys(self.imap,
+                                              (uids[0] or '').split()),
+            folder)
+
+    def status_unchanged(self, status, folder='inbox', struct=None):
+        """Check if a folder has not changed since its last complete run.
+
+        Args:
+            status (dict): The current status of the folder, as returned by
+                :py:meth:`isbg.imaputils.IsbgImap4.get_status` with
+                :py:attr:`status_items`.
+            folder (str): The name of the trackfile folder.
+            struct (dict, optional): The trackfile already loaded with
+                :py:meth:`trackfile_load`. If *None*, it's loaded.
+
+        Returns:
+            bool: *True* if the ``UIDVALIDITY``, ``UIDNEXT`` and
+            ``MESSAGES`` are the same that in the last complete run, so the
+            folder can be skipped. For the inbox, `maxsize` must be not
+            higher either.
+
+        """
+        if 'UIDNEXT' not in status or 'MESSAGES' not in status:
+            return False
+        struct = self._trackfile_read(status.get('UIDVALIDITY', 0), folder,
+                                      struct)
+        if struct is None:
+            return False
+        if folder == 'inbox' and struct.get('maxsize', 0) < self.maxsize:
+            return False
+        return (struct.get('uidnext') == status['UIDNEXT'] and
+                struct.get('messages') == status['MESSAGES'])
+
     def pastuid_write(self, uidvalidity, origpastuids, newpastuids,
-                      folder='inbox'):
-        """Write the uids in a file for the folder."""
+                      folder='inbox', highwater=None, modseq=None,
+                      status=None, index=None):
+        """Write the uids and the high-water mark in a file for the folder.
+
+        If not *None*, the `highwater` mark (with the current `maxsize`),
+        the ``HIGHESTMODSEQ`` `modseq` and the ``UIDNEXT`` and ``MESSAGES``
+        of the `status` are also written. If not empty, the verdict `index`
+        is also written, without the messages that are not in the past uids.
+        """
         if self.trackfile is None:
             self.trackfile = ISBG.set_filename(self.imapsets, "track")
 
@@ -416,10 +715,23 @@ class ISBG(object):
         self.logger.debug(__(('Writing pastuids for folder {}: {} ' +
                               'origpastuids, newpastuids: {}').format(
             folder, len(origpastuids), newpastuids)))
+        pastuids = imaputils.UidSet(origpastuids)
+        pastuids.update(newpastuids)
         struct = {
             'uidvalidity': uidvalidity,
-            'uids': list(set(newpastuids + origpastuids))
+            'ranges': pastuids.ranges
         }
+        if highwater is not None:
+            struct['highwater'] = highwater
+            struct['maxsize'] = self.maxsize
+        if modseq:
+            struct['highestmodseq'] = modseq
+        if status is not None and 'UIDNEXT' in status:
+            struct['uidnext'] = status['UIDNEXT']
+            struct['messages'] = status.get('MESSAGES')
+        if index:
+            struct['index'] = dict((k, v) for k, v in index.items()
+                                   if v[0] in pastuids)
         json.dump(struct, wfile)
         wfile.close()
 
@@ -491,36 +803,122 @@ class ISBG(object):
 
         """
         sa = spamproc.SpamAssassin.create_from_isbg(self)
+        # Flags changes are not seen with STATUS:
+        learnskip = not (self.learnflagged or self.learnunflagged)
 
         # SpamAssassin training: Learn spam
         s_learned = spamproc.Sa_Learn()
         if self.imapsets.learnspambox:
-            uidvalidity = self.imap.get_uidvalidity(self.imapsets.learnspambox)
-            origpastuids = self.pastuid_read(uidvalidity, 'spam')
-            s_learned = sa.learn(self.imapsets.learnspambox, 'spam', None,
-                                 origpastuids)
-            self.pastuid_write(uidvalidity, s_learned.newpastuids,
-                               s_learned.uids, 'spam')
+            s_learned = self._learn_folder(sa, self.imapsets.learnspambox,
+                                           'spam', None, learnskip)
 
         # SpamAssassin training: Learn ham
         h_learned = spamproc.Sa_Learn()
         if self.imapsets.learnhambox:
-            uidvalidity = self.imap.get_uidvalidity(self.imapsets.learnhambox)
-            origpastuids = self.pastuid_read(uidvalidity, 'ham')
-            h_learned = sa.learn(self.imapsets.learnhambox, 'ham',
-                                 self.movehamto, origpastuids)
-            self.pastuid_write(uidvalidity, h_learned.newpastuids,
-                               h_learned.uids, 'ham')
-
-        if not self.teachonly:
-            # check spaminbox exists by examining it
+            h_learned = self._learn_folder(sa, self.imapsets.learnhambox,
+                                           'ham', self.movehamto, learnskip)
+
+        if self.fingerprints is not None:
+            self.fingerprints.save()
+
+        proc = spamproc.Sa_Process()
+        if not self.teachonly and self.scankeyword:
+            # The processed messages are marked in the server, no trackfile.
             self.imap.select(self.imapsets.spaminbox, 1)
+            proc = sa.process_inbox([])
+        elif not self.teachonly:
+            # The status is read after learning, as ham can be moved to it.
+            status = self.imap.get_status(self.imapsets.inbox,
+                                          self.status_items)
+            uidvalidity = status.get('UIDVALIDITY', 0)
+            self._inbox_status = status
+            struct = self.trackfile_load('inbox')
+            if not self._folder_unchanged(status, 'inbox',
+                                          self.imapsets.inbox, struct):
+                # check spaminbox exists by examining it
+                self.imap.select(self.imapsets.spaminbox, 1)
+
+                origpastuids, index = self.past_read(
+                    uidvalidity, 'inbox', self.imapsets.inbox, struct)
+                highwater = self.highwater_read(uidvalidity, 'inbox', struct)
+                proc = sa.process_inbox(origpastuids, highwater)
+                self._track(uidvalidity, 'inbox', proc, status, index,
+                            highwater=proc.highwater)
+
+        if self.verdicts is not None:
+            self.verdicts.save()
+        self._log_stats(s_learned, h_learned, proc)
+        return proc
+
+    def _learn_folder(self, sa, folder, learn_type, move_to, learnskip):
+        """Learn a folder, if it has changed, and update its trackfile.
+
+        Args:
+            sa (isbg.spamproc.SpamAssassin): The learner.
+            folder (str): The IMAP folder.
+            learn_type (str): ``spam`` or ``ham``, also the name of its
+                trackfile folder.
+            move_to (str): If not *None*, the folder to move the messages.
+            learnskip (bool): If the folder is skipped when its status has
+                not changed.
+        Returns:
+            isbg.spamproc.Sa_Learn: The result of the learning.
+
+        """
+        status = self.imap.get_status(folder, self.status_items)
+        uidvalidity = status.get('UIDVALIDITY', 0)
+        struct = self.trackfile_load(learn_type)
+        if learnskip and self._folder_unchanged(status, learn_type, folder,
+                                                struct):
+            return spamproc.Sa_Learn()
+        origpastuids, index = self.past_read(uidvalidity, learn_type, folder,
+                                             struct)
+        learned = sa.learn(folder, learn_type, move_to, origpastuids,
+                           self.modseq_read(uidvalidity, learn_type, struct))
+        self._track(uidvalidity, learn_type, learned, status, index,
+                    modseq=learned.modseq)
+        return learned
+
+    def _folder_unchanged(self, status, folder, mailbox, struct):
+        """Check if a folder can be skipped, see :py:meth:`status_unchanged`.
+
+        Args:
+            status (dict): The current status of the folder.
+            folder (str): The name of the trackfile folder.
+            mailbox (str): The IMAP folder.
+            struct (dict): The trackfile, see :py:meth:`trackfile_load`.
+        Returns:
+            bool: *True* if it has not changed, so it's skipped.
+
+        """
+        if self.status_unchanged(status, folder, struct):
+            self.logger.debug(__("{} has no new messages".format(mailbox)))
+            return True
+        return False
+
+    def _track(self, uidvalidity, folder, result, status, index, **kwargs):
+        """Write the trackfile of a folder learned or processed.
+
+        Args:
+            uidvalidity (int): The ``UIDVALIDITY`` of the folder.
+            folder (str): The name of the trackfile folder.
+            result (Sa_Learn or Sa_Process): The result of the learning or
+                the process.
+            status (dict): The status of the folder, written only if the
+                `result` is complete.
+            index (dict): The verdict index read, updated with the one of the
+                `result`.
+            **kwargs: The `highwater` or `modseq` to write, see
+                :py:meth:`pastuid_write`.
 
-            uidvalidity = self.imap.get_uidvalidity(self.imapsets.inbox)
-            origpastuids = self.pastuid_read(uidvalidity)
-            proc = sa.process_inbox(origpastuids)
-            self.pastuid_write(uidvalidity, proc.newpastuids, proc.uids)
+        """
+        index.update(result.index)
+        self.pastuid_write(uidvalidity, result.newpastuids, result.uids,
+                           folder, status=status if result.complete else None,
+                           index=index, **kwargs)
 
+    def _log_stats(self, s_learned, h_learned, proc):
+        """Log the statistics of `do_spamassassin`, if not `nostats`."""
         if self.nostats is False:
             if self.imapsets.learnspambox is not None:
                 self.logger.info(__(
@@ -536,7 +934,126 @@ class ISBG(object):
                                                            proc.nummsg)))
                 self.logger.info(__("{}/{} was automatically deleted".format(
                     proc.spamdeleted, proc.numspam)))
+                if self.verdicts is not None:
+                    self.logger.info(__(
+                        "{}/{} verdicts got from the cache".format(
+                            proc.cachehits, proc.nummsg)))
+                if self.trustspamheaders:
+                    self.logger.info(__(
+                        "{}/{} verdicts got from the headers".format(
+                            proc.stamped, proc.nummsg)))
+                for stage in ['fetch', 'classify', 'act']:
+                    count, seconds = proc.stages.get(stage, (0, 0.0))
+                    self.logger.debug(__(
+                        "{} stage: {} messages in {:.3f}s".format(
+                            stage, count, seconds)))
+
+    def _inbox_changed(self, state):
+        """Check if the inbox has got messages since it was processed.
+
+        Args:
+            state (dict): The state of the inbox, as returned by
+                :py:meth:`isbg.imaputils.IsbgImap4.examine`.
+        Returns:
+            bool: *True* if its ``UIDNEXT`` (or, if it's unknown, if its
+            ``EXISTS`` is higher) is not the one read by the last
+            :py:meth:`do_spamassassin`.
+
+        """
+        status = self._inbox_status
+        if not status:
+            return False
+        if 'UIDNEXT' in state and 'UIDNEXT' in status:
+            return state['UIDNEXT'] != status['UIDNEXT']
+        return state.get('EXISTS', 0) > status.get('MESSAGES', 0)
+
+    def _backlog(self, proc):
+        """Check if a process has left messages of the inbox to process.
+
+        With `partialrun`, only some of the new messages are processed in
+        every run. They are processed again without waiting, until a run
+        processes all of them (or none).
+        """
+        return not (proc.complete or self.dryrun) and bool(proc.uids)
+
+    def _drop_imap(self):
+        """Close the lost *imap* connection, ignoring its errors."""
+        if self.imap is not None:
+            try:
+                self.imap.shutdown()
+            except Exception:  # pylint: disable=broad-except
+                pass
+        self.imap = None
+
+    def _wait_for_changes(self):
+        """Wait for new messages in the inbox, with ``IDLE`` if possible.
+
+        It doesn't wait if messages have arrived while it was processed.
+        """
+        if self._inbox_changed(self.imap.examine(self.imapsets.inbox)):
+            self.logger.debug(__("New messages in {} while processing".format(
+                self.imapsets.inbox)))
+            return
+        if self.imap.has_capability('IDLE'):
+            self.logger.debug(__("Waiting in IDLE for {} seconds".format(
+                self.idle_timeout)))
+            responses = self.imap.idle(self.idle_timeout)
+            self.logger.debug(__("IDLE returned {}".format(responses)))
+        else:
+            self.logger.debug(__("Sleeping {} seconds (no IDLE)".format(
+                self.poll_interval)))
+            time.sleep(self.poll_interval)
+            self.imap.noop()  # keep the connection alive
+
+    def do_daemon(self):
+        """Keep processing the account until interrupted.
+
+        It keeps the *imap* connection open and calls
+        :py:meth:`do_spamassassin` every time that the inbox changes (using
+        ``IDLE``, or every :py:attr:`poll_interval` if the server doesn't
+        support it), or at least every :py:attr:`idle_timeout` seconds. Only
+        the new messages are processed (see :py:meth:`status_unchanged` and
+        :py:meth:`highwater_read`). If some of them are left by `partialrun`,
+        it doesn't wait to process them.
+
+        If the connection is lost or the server can't be reached, it logins
+        again after :py:attr:`reconnect_delay` seconds, doubled after every
+        failed attempt up to :py:attr:`max_reconnect_delay`. The lock file is
+        touched in every cycle, so it doesn't expire.
 
+        Returns:
+            isbg.spamproc.Sa_Process: The last process, when it's interrupted
+            with :py:exc:`KeyboardInterrupt`.
+
+        """
+        proc = spamproc.Sa_Process()
+        delay = self.reconnect_delay
+        try:
+            while True:
+                try:
+                    if self.imap is None:
+                        self.do_imap_login()
+                    if not self.ignorelockfile and \
+                            os.path.exists(self.lockfilename):
+                        os.utime(self.lockfilename, None)
+                    proc = self.do_spamassassin()
+                    delay = self.reconnect_delay
+                    if self._backlog(proc):
+                        self.logger.debug(__(
+                            "{} has more messages to process".format(
+                                self.imapsets.inbox)))
+                    else:
+                        self._wait_for_changes()
+                except (socket.error, imaplib.IMAP4.abort) as exc:
+                    # imaputils.ImapConnectionError is a socket.error
+                    self.logger.warning(__(
+                        "IMAP connection error: {}. Reconnecting in {} "
+                        "seconds".format(exc, delay)))
+                    self._drop_imap()
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.max_reconnect_delay)
+        except KeyboardInterrupt:
+            self.logger.info("Interrupted, exiting")
         return proc
 
     def do_imap_login(self):
@@ -556,6 +1073,36 @@ class ISBG(object):
         exitcode if its called from the command line and have the --exitcodes
         param.
         """
+        self._do_prepare()
+
+        # ***** Main code starts here *****
+
+        # Connection with the imaplib server
+        self.do_imap_login()
+
+        # Should we save it?
+        if self.savepw:
+            self._do_save_password()
+
+        proc = None
+        if self.imaplist:
+            # List imap directories
+            self.do_list_imap()
+        elif self.daemon:
+            # Spamassasin training and processing, until interrupted:
+            proc = self.do_daemon()
+        else:
+            # Spamassasin training and processing:
+            proc = self.do_spamassassin()
+
+        # sign off
+        if self.imap is not None:
+            self.do_imap_logout()
+
+        return self._get_exitcode(proc)
+
+    def _do_prepare(self):
+        """Set the file names, acquire the lock file and get the password."""
         if self.delete and not self.gmail and \
                 "\\Deleted" not in self.spamflags:
             self.spamflags.append("\\Deleted")
@@ -566,6 +1113,14 @@ class ISBG(object):
         if self.passwdfilename is None:
             self.passwdfilename = ISBG.set_filename(self.imapsets, "password")
 
+        if self.verdictcache and self.verdicts is None:
+            self.verdicts = verdicts.get_cache(self.verdictfilename)
+
+        if self.learnedindex and self.fingerprints is None:
+            self.fingerprints = learned.LearnedIndex(
+                ISBG.set_filename(self.imapsets, "learned"),
+                self.spamd or ("spamc" if self.spamc else "spamassassin"))
+
         self.logger.debug(__("Lock file is {}".format(self.lockfilename)))
         self.logger.debug(__("Trackfile starts with {}".format(self.trackfile))
                           )
@@ -583,25 +1138,8 @@ class ISBG(object):
         if self.imapsets.passwd is None:
             self._do_get_password()
 
-        # ***** Main code starts here *****
-
-        # Connection with the imaplib server
-        self.do_imap_login()
-
-        # Should we save it?
-        if self.savepw:
-            self._do_save_password()
-
-        if self.imaplist:
-            # List imap directories
-            self.do_list_imap()
-        else:
-            # Spamassasin training and processing:
-            proc = self.do_spamassassin()
-
-        # sign off
-        self.do_imap_logout()
-
+    def _get_exitcode(self, proc):
+        """Get the exit code of `do_isbg` from the process result."""
         if self.exitcodes and __name__ == '__main__':
             if not self.teachonly:
                 if proc.numspam == 0:
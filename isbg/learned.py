@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  learned.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Index of the messages already learned by SpamAssassin.
+
+The fingerprints (see :py:func:`isbg.imaputils.get_fingerprints`) of the
+messages learned from an account are stored in a json file, with the type
+learned. When all the account is learned again, e.g. because the
+``UIDVALIDITY`` of a folder has changed or the trackfile has been lost,
+only the headers of the messages are fetched and the messages already
+learned with the same type are not fetched nor sent to SpamAssassin.
+
+The fingerprints are stored by SpamAssassin backend (the ``spamd`` address,
+``spamc`` or ``spamassassin``), as every one could use a different Bayes
+database. The file should be removed if the Bayes database is cleared.
+
+.. versionadded:: 2.2.0
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import time
+
+
+class LearnedIndex(object):
+    """The fingerprints of the messages learned, stored in a json file.
+
+    Args:
+        filename (str): The index file name.
+        backend (str): The SpamAssassin backend used to learn.
+
+    """
+
+    #: Max number of fingerprints kept by backend, the oldest are removed.
+    max_entries = 200000
+
+    def __init__(self, filename, backend):
+        """Initialize a LearnedIndex object."""
+        self.filename = filename  #: The index file name.
+        self.backend = backend    #: The SpamAssassin backend.
+        self._struct = None
+        self._changed = False
+
+    @property
+    def _learned(self):
+        """Get the fingerprints of the backend, reading the file if needed."""
+        if self._struct is None:
+            try:
+                with open(self.filename, 'r') as rfile:
+                    self._struct = dict(json.load(rfile))
+            except (IOError, OSError, ValueError, TypeError):
+                self._struct = {}
+        return self._struct.setdefault(self.backend, {})
+
+    def learned(self, fingerprint):
+        """Get how a message has been learned.
+
+        Args:
+            fingerprint (str): The fingerprint of the message, or *None*.
+        Returns:
+            str: ``spam`` or ``ham``, or *None* if it has not been learned.
+
+        """
+        if fingerprint is None:
+            return None
+        return self._learned.get(fingerprint, [None])[0]
+
+    def add(self, fingerprint, learn_type):
+        """Store that a message has been learned.
+
+        Args:
+            fingerprint (str): The fingerprint of the message, or *None*.
+            learn_type (str): ``spam`` or ``ham``.
+
+        """
+        if fingerprint is not None:
+            self._learned[fingerprint] = [learn_type, time.time()]
+            self._changed = True
+
+    def save(self):
+        """Write the index file, if it has changed."""
+        if not self._changed:
+            return
+        learned = self._learned
+        if len(learned) > self.max_entries:
+            oldest = sorted(learned, key=lambda k: learned[k][1])
+            for fingerprint in oldest[:len(learned) - self.max_entries]:
+                del learned[fingerprint]
+        with open(self.filename, 'w') as wfile:
+            os.chmod(self.filename, 0o600)
+            json.dump(self._struct, wfile)
+        self._changed = False
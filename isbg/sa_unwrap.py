@@ -44,6 +44,7 @@ if __package__ is None and not hasattr(sys, 'frozen'):
     path = os.path.realpath(os.path.abspath(__file__))
     sys.path.insert(0, os.path.dirname(os.path.dirname(path)))
 import isbg  # noqa: E402
+from isbg import imaputils  # noqa: E402
 
 try:
     # Creating command-line interface
@@ -66,6 +67,26 @@ except AttributeError:
     MESSAGE = email.message_from_string          # Python2+3
 
 
+def maybe_wrapped(raw):
+    """Check if a raw email could contain a email wrapped by SpamAssassin.
+
+    It only looks for the ``x-spam-type`` parameter in the bytes, so it's
+    much faster than parsing the message. If it's not found the message is not
+    a SpamAssassin report and it doesn't need to be parsed.
+
+    Args:
+        raw (bytes, str): The email.
+
+    Returns:
+        bool: False if the email does not contain a wrapped email.
+
+    """
+    # A lower() and a substring search is faster than a IGNORECASE regex.
+    if isinstance(raw, bytes):
+        return b'x-spam-type' in raw.lower()
+    return 'x-spam-type' in raw.lower()
+
+
 def sa_unwrap_from_email(msg):
     """Unwrap a email from the spamassasin email.
 
@@ -99,22 +120,34 @@ def unwrap(mail):
     the mail could be a email.message.Email, a file or a string or buffer.
     It ruturns a list with all the email.message.Email founds.
 
+    The raw mails (all but a email.message.Email) are only parsed if
+    :py:func:`maybe_wrapped` finds the SpamAssassin markers in them.
+
     Args:
-        mail (email.message.Message, FILE_TYPES, str): the mail to unwrap.
+        mail (email.message.Message, isbg.imaputils.RawMessage, FILE_TYPES,
+            str): the mail to unwrap.
 
     Returns:
         [email.message.Message]: A list with the unwraped mails.
 
     """
+    if isinstance(mail, imaputils.RawMessage):
+        if not maybe_wrapped(mail.raw):
+            return None
+        return sa_unwrap_from_email(mail.message)
     if isinstance(mail, email.message.Message):
         return sa_unwrap_from_email(mail)
     if isinstance(mail, FILE_TYPES):  # files are also stdin...
-        return sa_unwrap_from_email(PARSE_FILE(mail))
-    try:
-        mail = email.message_from_bytes(mail)  # py3 only
-    except AttributeError:
-        mail = email.message_from_string(mail)
-    return sa_unwrap_from_email(mail)
+        mail = mail.read()
+    if not maybe_wrapped(mail):
+        return None
+    if isinstance(mail, bytes):
+        try:
+            return sa_unwrap_from_email(
+                email.message_from_bytes(mail))  # py3 only
+        except AttributeError:
+            pass
+    return sa_unwrap_from_email(email.message_from_string(mail))
 
 
 def __isbg_sa_unwrap_opts__():  # noqa: D207
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  spamd.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+r"""Native ``spamd`` client module for isbg.
+
+It speaks the *SPAMC/1.5* protocol used by ``spamc`` with a ``spamd``
+server, over TCP or a unix socket, so no process is created for every
+message.
+
+Examples:
+    >>> from isbg import spamd
+    >>> client = spamd.SpamdClient.from_address('localhost:783')
+    >>> client.check(b'Subject: foo\n\nboo\n').spam
+    (False, '1.3', '5.0')
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import re
+import socket
+
+from isbg import imaputils
+
+PROTOCOL_VERSION = "SPAMC/1.5"  #: The protocol version used.
+
+EX_OK = 0              #: No error.
+EX_UNAVAILABLE = 69    #: Service unavailable (e.g. ``TELL`` not allowed).
+EX_IOERR = 74          #: Input/output error.
+EX_TOOBIG = 98         #: Message too big, as returned by ``spamc``.
+
+
+class SpamdError(Exception):
+    """Error communicating with ``spamd``."""
+
+
+class SpamdResponse(object):
+    """A response from ``spamd``.
+
+    Attributes:
+        code (int): The response code, ``0`` (*EX_OK*) if all went ok.
+        message (str): The response message, e.g. ``EX_OK``.
+        headers (dict): The response headers, with its names in lower case.
+        body (bytes): The response body.
+
+    """
+
+    #: Regular expression for the ``Spam`` header.
+    _spam_re = re.compile(
+        r'(True|False|Yes|No)\s*;\s*(-?\d+(?:\.\d+)?)\s*/\s*(-?\d+(?:\.\d+)?)',
+        re.IGNORECASE)
+
+    def __init__(self, code, message, headers=None, body=b''):
+        """Initialize a SpamdResponse object."""
+        self.code = code
+        self.message = message
+        self.headers = headers if headers is not None else {}
+        self.body = body
+
+    @classmethod
+    def parse(cls, data):
+        """Parse the raw response of ``spamd``.
+
+        Args:
+            data (bytes): The response.
+
+        Returns:
+            SpamdResponse: The response parsed.
+
+        Raises:
+            SpamdError: If it's not a valid response.
+
+        """
+        head, sep, body = data.partition(b'\r\n\r\n')
+        if not sep:
+            head, body = data, b''
+        lines = head.decode('ascii', errors='replace').split('\r\n')
+        res = re.match(r'SPAMD/\d+\.\d+\s+(\d+)\s*(.*)', lines[0])
+        if res is None:
+            raise SpamdError("Bad response from spamd: {}".format(
+                repr(lines[0])))
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return cls(int(res.group(1)), res.group(2), headers, body)
+
+    @property
+    def spam(self):
+        """Get the verdict from the ``Spam`` header.
+
+        :getter: The verdict as a tuple ``(is_spam, score, threshold)``, with
+            the score and the threshold as strings, or *None* if the
+            response has no ``Spam`` header.
+        :type: tuple
+        """
+        res = self._spam_re.search(self.headers.get('spam', ''))
+        if res is None:
+            return None
+        return (res.group(1).lower() in ['true', 'yes'], res.group(2),
+                res.group(3))
+
+
+class SpamdClient(object):
+    """Client for the *SPAMC/1.5* protocol of ``spamd``.
+
+    ``spamd`` closes the connection after every response, so a new
+    connection is opened for every request, but an instance can be reused
+    (and shared between threads) for any number of messages.
+
+    Attributes:
+        host (str): The ``spamd`` host. Defaults to ``localhost``.
+        port (int): The ``spamd`` TCP port. Defaults to ``783``.
+        socket_path (str): If not *None*, the unix socket of ``spamd``, used
+            instead of `host` and `port`.
+        user (str): If not *None*, the user name sent to ``spamd``.
+        timeout (float): The socket timeout in seconds. Defaults to ``600``,
+            the same as ``spamc``.
+        max_size (int): Messages larger than this are not sent to ``spamd``.
+            Defaults to ``500 KB``, the same as ``spamc``.
+
+    """
+
+    def __init__(self, host='localhost', port=783, socket_path=None,
+                 user=None, timeout=600, max_size=500 * 1024):
+        """Initialize a SpamdClient object."""
+        self.host = host
+        self.port = int(port)
+        self.socket_path = socket_path
+        self.user = user
+        self.timeout = timeout
+        self.max_size = max_size
+
+    @classmethod
+    def from_address(cls, address, **kwargs):
+        """Create a client from an address.
+
+        Args:
+            address (str): A unix socket path (if it contains a ``/``),
+                or ``host[:port]``.
+            **kwargs: Other arguments of :py:class:`SpamdClient`.
+
+        Returns:
+            SpamdClient: The new client.
+
+        """
+        if '/' in address:
+            return cls(socket_path=address, **kwargs)
+        host, port = address, 783
+        res = re.match(r'^\[?([^\]]*?)\]?:(\d+)$', address)
+        if res is not None and (address.startswith('[') or
+                                address.count(':') == 1):
+            host, port = res.group(1), int(res.group(2))
+        return cls(host=host, port=port, **kwargs)
+
+    def _connect(self):
+        """Open a new connection with ``spamd``."""
+        if self.socket_path is not None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            return sock
+        return socket.create_connection((self.host, self.port),
+                                        self.timeout)
+
+    def _request_data(self, command, message, headers):
+        """Build the raw request sent to ``spamd``."""
+        head = ["{} {}".format(command, PROTOCOL_VERSION),
+                "Content-length: {}".format(len(message))]
+        if self.user is not None:
+            head.append("User: {}".format(self.user))
+        for name, value in headers or []:
+            head.append("{}: {}".format(name, value))
+        return ("\r\n".join(head) + "\r\n\r\n").encode('ascii') + message
+
+    def request(self, command, message=b'', headers=None):
+        """Send a request to ``spamd`` and get its response.
+
+        Args:
+            command (str): The command, e.g. ``CHECK``.
+            message (bytes): The message.
+            headers (list(tuple)): Extra request headers as a list of
+                ``(name, value)``.
+
+        Returns:
+            SpamdResponse: The response.
+
+        Raises:
+            SpamdError: If the response is not valid.
+            socket.error: If there is a error with the connection.
+
+        """
+        data = self._request_data(command, message, headers)
+        sock = self._connect()
+        try:
+            sock.sendall(data)
+            try:
+                sock.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            sock.close()
+        return SpamdResponse.parse(b''.join(chunks))
+
+    def check(self, message):
+        """Check if the message is spam (``CHECK``)."""
+        return self.request("CHECK", message)
+
+    def symbols(self, message):
+        """Check the message and get the matched rules (``SYMBOLS``)."""
+        return self.request("SYMBOLS", message)
+
+    def report(self, message):
+        """Check the message and get the SpamAssassin report of it."""
+        return self.request("REPORT", message)
+
+    def process(self, message):
+        """Check the message and get it modified (``PROCESS``)."""
+        return self.request("PROCESS", message)
+
+    def headers(self, message):
+        """Check the message and get only its headers modified."""
+        return self.request("HEADERS", message)
+
+    def tell(self, message, learn_type):
+        """Learn or forget a message (``TELL``).
+
+        Args:
+            message (bytes): The message.
+            learn_type (str): ``spam``, ``ham`` or ``forget``.
+
+        Returns:
+            SpamdResponse: The response.
+
+        """
+        return self.request("TELL", message, _tell_headers(learn_type))
+
+    def test_mail(self, mail):
+        """Test a email, as :py:func:`isbg.spamproc.test_mail`.
+
+        Args:
+            mail (email.message.Message): The email to test.
+
+        Returns:
+            str, int: The score, formated as ``spamc -c`` does, and ``1``
+            if it is spam or ``0`` if not. On errors, it returns ``-9999``
+            as score.
+
+        """
+        message = _as_bytes(mail)
+        if len(message) > self.max_size:
+            return "-9999", EX_TOOBIG
+        try:
+            res = self.check(message)
+        except (socket.error, SpamdError):
+            res = None
+        return _test_result(res)
+
+    def feed_mail(self, mail):
+        """Feed a email with the report, as :py:func:`isbg.spamproc.feed_mail`.
+
+        Args:
+            mail (email.message.Message): The email to process.
+
+        Returns:
+            bytes, int: The email with the report and ``0``. On errors, it
+            returns ``-9999`` as email.
+
+        """
+        message = _as_bytes(mail)
+        if len(message) > self.max_size:
+            return message, EX_OK
+        try:
+            res = self.process(message)
+        except (socket.error, SpamdError):
+            res = None
+        return _feed_result(res)
+
+    def process_mail(self, mail):
+        """Test and feed a email, as :py:func:`isbg.spamproc.process_mail`.
+
+        Only one ``PROCESS`` request is done to get the score and the email
+        with the report.
+
+        Args:
+            mail (email.message.Message): The email to process.
+
+        Returns:
+            str, bytes, int: The score, the email with the report, and ``1``
+            if it is spam or ``0`` if not. On errors, it returns ``-9999``
+            as score and email.
+
+        """
+        message = _as_bytes(mail)
+        if len(message) > self.max_size:
+            return "-9999", u"-9999", EX_TOOBIG
+        try:
+            res = self.process(message)
+        except (socket.error, SpamdError):
+            res = None
+        return _process_result(res)
+
+    def learn_mail(self, mail, learn_type):
+        """Learn a email, as :py:func:`isbg.spamproc.learn_mail`.
+
+        Args:
+            mail (email.message.Message): email to learn.
+            learn_type (str): ``spam``, ``ham`` or ``forget``.
+
+        Returns:
+            int, int: ``5`` if it has been learned or forgotten, ``6`` if it
+            was already learned or forgotten, ``98`` if it's too big,
+            ``-9999`` on communication errors or the ``spamd`` error code,
+            and the original ``spamd`` code.
+
+        """
+        message = _as_bytes(mail)
+        if len(message) > self.max_size:
+            return EX_TOOBIG, EX_TOOBIG
+        try:
+            res = self.tell(message, learn_type)
+        except (socket.error, SpamdError):
+            res = None
+        return _learn_result(res)
+
+
+def _tell_headers(learn_type):
+    """Get the headers of a ``TELL`` request."""
+    if learn_type == 'forget':
+        return [("Remove", "local")]
+    return [("Message-class", learn_type), ("Set", "local")]
+
+
+def _test_result(res):
+    """Get the result of `SpamdClient.test_mail` from a response or None."""
+    if res is None:
+        return "-9999", None
+    if res.code != EX_OK or res.spam is None:
+        return "0/0\n", res.code
+    spam, score, threshold = res.spam
+    return "{}/{}\n".format(score, threshold), 1 if spam else 0
+
+
+def _feed_result(res):
+    """Get the result of `SpamdClient.feed_mail` from a response or None."""
+    if res is None:
+        return u"-9999", None
+    if res.code != EX_OK:
+        return u"-9999", res.code
+    return res.body, res.code
+
+
+def _process_result(res):
+    """Get the result of `SpamdClient.process_mail` from a response or None."""
+    if res is None:
+        return "-9999", u"-9999", None
+    if res.code != EX_OK or res.spam is None:
+        return "0/0\n", u"-9999", res.code
+    spam, score, threshold = res.spam
+    return "{}/{}\n".format(score, threshold), res.body, 1 if spam else 0
+
+
+def _learn_result(res):
+    """Get the result of `SpamdClient.learn_mail` from a response or None."""
+    if res is None:
+        return -9999, None
+    if res.code != EX_OK:
+        return res.code, res.code
+    if 'didset' in res.headers or 'didremove' in res.headers:
+        return 5, res.code
+    return 6, res.code
+
+
+def _as_bytes(mail):
+    """Get the content of a email as bytes."""
+    content = imaputils.mail_content(mail)
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8', errors='replace')
+    return content
@@ -33,11 +33,18 @@ import isbg
 
 from isbg import imaputils
 from isbg import sa_unwrap
+from isbg import spamd
 from isbg import utils
 
 from .utils import __
 
+import collections
+import itertools
 import logging
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
 
 #: Used to detect already our successfully (un)learned messages.
 __spamc_msg__ = {
@@ -145,6 +152,292 @@ def feed_mail(mail, spamc=False, cmd=False):
     return new_mail, orig_code
 
 
+def process_mail(mail, spamc=False, cmd=False):
+    """Test a email and feed it with the spamassassin report in one pass.
+
+    Args:
+        mail (email.message.Message): email to process.
+        spamc (bool): If True use ``spamc -E`` instead of ``spamassassin
+            --exit-code``.
+        cmd (list(str)): If informed, the command to use.
+    Returns:
+        str, bytes, int: The score, the email with the report and the
+        return code (not ``0`` if it is spam).
+
+        If there is an error the score and the mail are ``-9999``, and if
+        the score can not be found in the processed mail, the score is
+        ``0/0`` (as ``spamc -c`` returns when it can not contact ``spamd``).
+
+    """
+    score = "0/0\n"
+    new_mail = u"-9999"
+    orig_code = None
+
+    if cmd:
+        saproc = cmd
+    elif spamc:
+        saproc = ["spamc", "-E"]
+    else:
+        saproc = ["spamassassin", "--exit-code"]
+
+    proc = utils.popen(saproc)
+    try:
+        new_mail = proc.communicate(imaputils.mail_content(mail))[0]
+        orig_code = proc.returncode
+        try:
+            score = utils.score_from_mail(new_mail.decode(errors='ignore'))
+        except AttributeError:  # score not found.
+            score = "0/0\n"
+    except Exception:  # pylint: disable=broad-except
+        score, new_mail = "-9999", u"-9999"
+
+    proc.stdin.close()
+
+    return score, new_mail, orig_code
+
+
+def ordered_map(func, iterable, workers=None):
+    """Apply a function to every item using a pool of threads.
+
+    The items are taken from `iterable` in the calling thread in chunks, and
+    the results are returned in the same order than the items, so the caller
+    can act over them as if they were processed serially.
+
+    Args:
+        func (callable): The function to apply.
+        iterable (iterable): The items.
+        workers (int): The number of threads. If it's *None* or lower than
+            ``2``, no threads are used.
+    Returns:
+        Iterator: The results of `func`.
+
+    """
+    if workers is None or workers < 2:
+        for item in iterable:
+            yield func(item)
+        return
+
+    iterator = iter(iterable)
+    pool = ThreadPool(workers)
+    try:
+        chunk = list(itertools.islice(iterator, workers * 4))
+        while chunk:
+            for res in pool.imap(func, chunk):
+                yield res
+            chunk = list(itertools.islice(iterator, workers * 4))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class BoundedQueue(object):
+    """A FIFO queue between threads bounded by items and by bytes.
+
+    A :py:meth:`put` blocks while the queue has `maxitems` items or while
+    adding the item would exceed `maxbytes` (an item is always accepted
+    when the queue is empty, so a single big item can not block it).
+
+    """
+
+    DONE = object()  #: Returned by :py:meth:`get` when there are no more.
+
+    def __init__(self, maxitems, maxbytes=None):
+        """Initialize a BoundedQueue object."""
+        self.maxitems = maxitems
+        self.maxbytes = maxbytes
+        self._items = collections.deque()
+        self._bytes = 0
+        self._closed = False
+        self._aborted = False
+        self._cond = threading.Condition()
+
+    def _full(self, size):
+        """Check if there is not room for a new item."""
+        if not self._items:
+            return False
+        if len(self._items) >= self.maxitems:
+            return True
+        return (self.maxbytes is not None and
+                self._bytes + size > self.maxbytes)
+
+    def put(self, item, size=0):
+        """Put an item, waiting for room if needed.
+
+        Returns:
+            bool: False if the queue has been aborted.
+
+        """
+        with self._cond:
+            while not self._aborted and self._full(size):
+                self._cond.wait()
+            if self._aborted:
+                return False
+            self._items.append((item, size))
+            self._bytes += size
+            self._cond.notify_all()
+            return True
+
+    def get(self):
+        """Get an item, waiting for it if needed.
+
+        Returns:
+            The item, or :py:attr:`DONE` if the queue has been closed and it
+            is empty, or if it has been aborted.
+
+        """
+        with self._cond:
+            while not self._aborted and not self._closed and \
+                    not self._items:
+                self._cond.wait()
+            if self._aborted or not self._items:
+                return self.DONE
+            item, size = self._items.popleft()
+            self._bytes -= size
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        """Close the queue, no more items will be put."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def abort(self):
+        """Abort the queue, it wakes up and discards any put and get."""
+        with self._cond:
+            self._aborted = True
+            self._items.clear()
+            self._cond.notify_all()
+
+
+def pipeline(source, func, workers=1, maxitems=50, maxbytes=None,
+             size=None, hook=None):
+    """Run a fetch, classify and act pipeline.
+
+    The items are taken from `source` by a producer thread (the *fetch*
+    stage), `func` is applied to them by `workers` threads (the *classify*
+    stage) and the results are returned in the same order than the items
+    to the caller (the *act* stage). The stages are connected by
+    :py:class:`BoundedQueue` queues.
+
+    The items in flight, from the fetched to the acted ones, are bounded by
+    `maxitems` and `maxbytes` (plus the item being fetched), so the results
+    waiting behind a slow item do not pile up: the *fetch* stage waits for
+    the *act* stage.
+
+    Exceptions raised by `source` or `func` are raised to the caller when
+    the failed item is reached.
+
+    Args:
+        source (iterable): The items.
+        func (callable): The function to apply.
+        workers (int): The number of threads of the *classify* stage.
+        maxitems (int): The max number of items of every queue.
+        maxbytes (int): The max number of bytes of every queue, if not *None*.
+        size (callable): Function returning the size in bytes of an item.
+        hook (callable): If not *None*, it's called as ``hook(stage,
+            seconds)`` for every item processed by every stage.
+    Returns:
+        Iterator: The results of `func`.
+
+    """
+    workers = max(workers or 1, 1)
+    size = size or (lambda item: 0)
+    hook = hook or (lambda stage, seconds: None)
+    fetched = BoundedQueue(maxitems, maxbytes)
+    results = BoundedQueue(maxitems, maxbytes)
+    # The sequence numbers of the items in flight, released in order.
+    window = BoundedQueue(maxitems, maxbytes)
+    running = [workers]
+    lock = threading.Lock()
+
+    def produce():
+        seq = 0
+        try:
+            iterator = iter(source)
+            while True:
+                start = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                hook('fetch', time.time() - start)
+                itemsize = size(item)
+                if not window.put(seq, itemsize) or \
+                        not fetched.put((seq, item, itemsize, None), itemsize):
+                    break
+                seq += 1
+        except Exception as exc:  # pylint: disable=broad-except
+            # The error takes a place in flight too, to be acted in order.
+            if window.put(seq):
+                fetched.put((seq, None, 0, exc))
+        finally:
+            fetched.close()
+
+    def classify():
+        try:
+            while True:
+                entry = fetched.get()
+                if entry is BoundedQueue.DONE:
+                    break
+                seq, item, itemsize, exc = entry
+                res = None
+                if exc is None:
+                    start = time.time()
+                    try:
+                        res = func(item)
+                    except Exception as err:  # pylint: disable=broad-except
+                        exc = err
+                    hook('classify', time.time() - start)
+                if not results.put((seq, res, exc), itemsize):
+                    break
+        finally:
+            with lock:
+                running[0] -= 1
+                if running[0] == 0:
+                    results.close()
+
+    threads = [threading.Thread(target=produce)]
+    threads.extend(threading.Thread(target=classify) for _ in range(workers))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    pending = {}
+    nextseq = 0
+    try:
+        while True:
+            while nextseq not in pending:
+                entry = results.get()
+                if entry is BoundedQueue.DONE:
+                    return
+                pending[entry[0]] = entry
+            _, res, exc = pending.pop(nextseq)
+            window.get()
+            nextseq += 1
+            if exc is not None:
+                raise exc
+            start = time.time()
+            yield res
+            hook('act', time.time() - start)
+    finally:
+        window.abort()
+        fetched.abort()
+        results.abort()
+        for thread in threads:
+            thread.join()
+
+
+def _sa_limited(func):
+    """Decorate a method to hold `sa_semaphore`, if it's set, while running."""
+    def func_wrapper(self, *args, **kwargs):
+        if self.sa_semaphore is None:
+            return func(self, *args, **kwargs)
+        with self.sa_semaphore:
+            return func(self, *args, **kwargs)
+    return func_wrapper
+
+
 class Sa_Learn(object):
     """Commodity class to store information about learning processes."""
 
@@ -154,6 +447,12 @@ class Sa_Learn(object):
         self.learned = 0         #: Number of messages learned.
         self.uids = []           #: The list of ``uids``.
         self.newpastuids = []    #: The new past ``uids``.
+        self.modseq = 0          #: The new ``HIGHESTMODSEQ`` (0 if unknown).
+        #: The *uid* and the type learned by key of the messages learned,
+        #: see :py:func:`isbg.imaputils.message_key`.
+        self.index = {}
+        #: True if all the messages found have been learned.
+        self.complete = False
 
 
 class Sa_Process(object):
@@ -166,6 +465,21 @@ class Sa_Process(object):
         self.spamdeleted = 0     #: Number of deleted spam.
         self.uids = []           #: The list of ``uids``.
         self.newpastuids = []    #: The new past ``uids``.
+        self.highwater = 0       #: The new high-water mark.
+        self.cachehits = 0       #: Number of verdicts got from the cache.
+        self.stamped = 0         #: Number of verdicts got from the headers.
+        #: The *uid* and the verdict (``spam`` or ``ham``) by key of the
+        #: messages processed, see :py:func:`isbg.imaputils.message_key`.
+        self.index = {}
+        #: True if all the messages found have been processed.
+        self.complete = False
+        #: The number of messages and seconds spent by every stage.
+        self.stages = {}
+
+    def add_stage_time(self, stage, seconds):
+        """Add the time spent by a stage processing a message."""
+        count, total = self.stages.get(stage, (0, 0.0))
+        self.stages[stage] = (count + 1, total + seconds)
 
 
 class SpamAssassin(object):
@@ -184,11 +498,19 @@ class SpamAssassin(object):
     #: key args required when initialized.
     _required_kwargs = []
 
+    #: Max number of messages waiting between the stages of process_inbox.
+    queue_items = 50
+    #: Max number of bytes of the messages waiting between the stages.
+    queue_bytes = 16 * 1024 * 1024
+
     #: Key args that will be used.
     _kwargs = ['imap', 'spamc', 'logger', 'partialrun', 'dryrun',
                'learnthendestroy', 'gmail', 'learnthenflag', 'learnunflagged',
                'learnflagged', 'deletehigherthan', 'imapsets', 'maxsize',
-               'noreport', 'spamflags', 'delete', 'expunge']
+               'noreport', 'spamflags', 'delete', 'expunge', 'spamd',
+               'singlepass', 'workers', 'learnworkers', 'sa_semaphore',
+               'verdicts', 'verdictttl', 'fingerprints', 'trustspamheaders',
+               'spamheadersmaxage', 'scankeyword', 'verdictindex']
 
     def __init__(self, **kwargs):
         """Initialize a SpamAssassin object."""
@@ -213,6 +535,80 @@ class SpamAssassin(object):
         # what we use to set flags on the original spam in imapbox
         self.spamflagscmd = "+FLAGS.SILENT"
 
+        #: If not *None*, it's called as ``stats_hook(stage, seconds)`` for
+        #: every message processed by every stage of :py:meth:`process_inbox`
+        #: (``fetch``, ``classify`` and ``act``).
+        self.stats_hook = None
+
+        self._spamd_client = None
+        self._cachehits = 0
+        self._cachelock = threading.Lock()
+        # The messages faked with dryrun by process_inbox.
+        self._faked = 0
+        # The verdicts stamped by the MTA in the messages being processed.
+        self._stamps = {}
+        # The keys of the messages fetched, for the verdict index.
+        self._keys = {}
+
+    @property
+    def spamd_client(self):
+        """Get the native ``spamd`` client, if `spamd` is used.
+
+        :getter: A :py:class:`~isbg.spamd.SpamdClient` connecting to the
+            `spamd` address, or *None* if `spamd` is not set.
+        :type: isbg.spamd.SpamdClient
+        """
+        if self.spamd and self._spamd_client is None:
+            self._spamd_client = spamd.SpamdClient.from_address(self.spamd)
+        return self._spamd_client
+
+    @_sa_limited
+    def _learn_mail(self, mail, learn_type):
+        """Learn a mail with ``spamd`` or ``spamc``."""
+        if self.spamd_client is not None:
+            return self.spamd_client.learn_mail(mail, learn_type)
+        return learn_mail(mail, learn_type)
+
+    @_sa_limited
+    def _test_mail(self, mail):
+        """Test a mail with ``spamd`` or with `cmd_test`."""
+        if self.spamd_client is not None:
+            return self.spamd_client.test_mail(mail)
+        return test_mail(mail, cmd=self.cmd_test)
+
+    @_sa_limited
+    def _feed_mail(self, mail):
+        """Feed a mail with ``spamd`` or with `cmd_save`."""
+        if self.spamd_client is not None:
+            return self.spamd_client.feed_mail(mail)
+        return feed_mail(mail, cmd=self.cmd_save)
+
+    @_sa_limited
+    def _process_mail(self, mail):
+        """Test and feed a mail with ``spamd`` or with `cmd_process`."""
+        if self.spamd_client is not None:
+            return self.spamd_client.process_mail(mail)
+        return process_mail(mail, cmd=self.cmd_process)
+
+    @property
+    def move_spam(self):
+        """Check if the spams are moved to the spam folder with ``UID MOVE``.
+
+        :getter: *True* if the spams are copied as they are (`noreport`), the
+            originals deleted (`delete`, not using `gmail`) and the server
+            supports ``MOVE`` (:rfc:`6851`).
+        :type: bool
+        """
+        return (bool(self.noreport) and bool(self.delete) and
+                not self.gmail and self.imap.has_capability('MOVE'))
+
+    @property
+    def cmd_process(self):
+        """Is the command that tests and dumps out a munged message."""
+        if self.spamc:  # pylint: disable=no-member
+            return ["spamc", "-E"]
+        return ["spamassassin", "--exit-code"]
+
     @property
     def cmd_save(self):
         """Is the command that dumps out a munged message including report."""
@@ -242,7 +638,7 @@ class SpamAssassin(object):
         kw = dict()
         for k in cls._kwargs:
             kw[k] = getattr(sbg, k)
-        return SpamAssassin(**kw)
+        return cls(**kw)
 
     @staticmethod
     def get_formated_uids(uids, origpastuids, partialrun):
@@ -260,16 +656,29 @@ class SpamAssassin(object):
             returns the number defined by `partialrun`. If `partialrun` is
             ```None``` it return all.
 
+            The new past ``uids`` are those of `origpastuids` that are still
+            in `uids`.
+
+        Note:
+            It works with sets of integers, so its cost grows linearly with
+            the number of ``uids``. If `origpastuids` is a
+            :py:class:`~isbg.imaputils.UidSet`, it's not expanded.
+
         """
-        uids = sorted(uids[0].split(), key=int, reverse=True)
-        newpastuids = [u for u in origpastuids if str(u) in uids]
-        uids = [u for u in uids if int(u) not in newpastuids]
+        uids = sorted(set(int(u) for u in uids[0].split()), reverse=True)
+        if isinstance(origpastuids, imaputils.UidSet):
+            newpastuids = [u for u in reversed(uids) if u in origpastuids]
+        else:
+            present = set(uids)
+            newpastuids = [u for u in origpastuids if int(u) in present]
+        past = set(int(u) for u in newpastuids)
+        uids = [str(u) for u in uids if u not in past]
         # Take only X elements if partialrun is enabled
         if partialrun:
             uids = uids[:int(partialrun)]
         return uids, newpastuids
 
-    def learn(self, folder, learn_type, move_to, origpastuids):
+    def learn(self, folder, learn_type, move_to, origpastuids, modseq=0):
         """Learn the spams (and if requested deleted or move them).
 
         Args:
@@ -279,12 +688,24 @@ class SpamAssassin(object):
             move_to (str): If not ```None```, the imap folder where the emails
                 will be moved.
             origpastuids (list(int)): ``uids`` to not process.
+            modseq (int): The ``HIGHESTMODSEQ`` of the folder in the last
+                run, ``0`` if unknown.
         Returns:
             Sa_Learn:
                 It contains the information about the result of the process.
 
             It will call ``spamc`` to learn the emails.
 
+            If the server supports ``CONDSTORE`` (:rfc:`7162`) and `modseq`
+            is known, the folder is skipped if it has not changed, and only
+            the messages changed since then are searched otherwise.
+
+            If `fingerprints` is set, the messages found in it are not
+            fetched nor learned again (see :py:meth:`_skip_learned`).
+
+            If `verdictindex` is set, the keys of the messages learned are
+            returned in its `index`.
+
         Raises:
             isbg.ISBGError: if learn_type is unknown.
 
@@ -294,8 +715,53 @@ class SpamAssassin(object):
 
         """
         sa_learning = Sa_Learn()
+        self._check_learn(folder, learn_type)
+
+        highestmodseq = 0
+        if self.imap.has_capability('CONDSTORE'):
+            highestmodseq = self.imap.get_status(
+                folder, ['HIGHESTMODSEQ']).get('HIGHESTMODSEQ', 0)
+        criteria = self._learn_search(sa_learning, folder, origpastuids,
+                                      modseq, highestmodseq)
+        if criteria is None:
+            return sa_learning
 
-        # Sanity checks:
+        self.imap.select(folder)
+        _, uids = self.imap.uid("SEARCH", None, *criteria)
+        uids = self._learn_uids(sa_learning, uids, origpastuids, modseq,
+                                highestmodseq)
+
+        # The actions are sent in batches of uids at the end.
+        move = not self.dryrun and self.imap.has_capability('MOVE')
+        actions = imaputils.UidCommands(self.imap)
+
+        fingerprints = None
+        if self.fingerprints is not None:
+            fingerprints = imaputils.get_fingerprints(self.imap, uids)
+            uids = self._skip_learned(sa_learning, actions, uids, fingerprints,
+                                      learn_type, move_to, move)
+
+        # The messages are retrieved in batches and learned by the workers.
+        self._keys = {}
+        messages = self._keyed(imaputils.get_messages(self.imap, uids,
+                                                      logger=self.logger))
+        for res in ordered_map(
+                lambda message: self._learn(message, learn_type), messages,
+                self.learnworkers):
+            self._learn_result(sa_learning, actions, res, fingerprints,
+                               learn_type, move_to, move)
+
+        actions.flush()
+        self._learn_done(sa_learning, highestmodseq)
+        return sa_learning
+
+    def _check_learn(self, folder, learn_type):
+        """Check the arguments of :py:meth:`learn`.
+
+        Raises:
+            isbg.ISBGError: if learn_type is unknown or there is not `imap`.
+
+        """
         if learn_type not in ['spam', 'ham']:
             raise isbg.ISBGError(-1, message="Unknown learn_type")
         if self.imap is None:
@@ -304,137 +770,509 @@ class SpamAssassin(object):
         self.logger.debug(__(
             "Teach {} to SA from: {}".format(learn_type, folder)))
 
-        self.imap.select(folder)
+    def _learn_search(self, sa_learning, folder, origpastuids, modseq,
+                      highestmodseq):
+        """Get the ``UID SEARCH`` arguments of the messages to learn.
+
+        Args:
+            sa_learning (Sa_Learn): The result of the learning.
+            folder (str): The IMAP folder.
+            origpastuids (list(int)): ``uids`` to not process.
+            modseq (int): The ``HIGHESTMODSEQ`` of the last run, ``0`` if
+                unknown.
+            highestmodseq (int): The current ``HIGHESTMODSEQ``, ``0`` if the
+                server doesn't support ``CONDSTORE``.
+        Returns:
+            list(str): The search criteria, only of the messages changed
+            since `modseq` if it's known, or *None* if the folder has not
+            changed (and so `sa_learning` is already complete).
+
+        """
+        sa_learning.modseq = modseq if highestmodseq else 0
+        if modseq and highestmodseq == modseq:
+            self.logger.debug(__(
+                "{} has not changed since the last run".format(folder)))
+            sa_learning.newpastuids = origpastuids
+            sa_learning.complete = True
+            return None
+        if modseq and highestmodseq > modseq:
+            return ["MODSEQ", str(modseq + 1), self._learn_criteria()]
+        return [self._learn_criteria()]
+
+    def _learn_criteria(self):
+        """Get the ``SEARCH`` criteria of the messages to learn."""
         if self.learnunflagged:
-            _, uids = self.imap.uid("SEARCH", None, "UNFLAGGED")
-        elif self.learnflagged:
-            _, uids = self.imap.uid("SEARCH", None, "(FLAGGED)")
-        else:
-            _, uids = self.imap.uid("SEARCH", None, "ALL")
+            return "UNFLAGGED"
+        if self.learnflagged:
+            return "(FLAGGED)"
+        return "ALL"
+
+    def _learn_uids(self, sa_learning, uids, origpastuids, modseq,
+                    highestmodseq):
+        """Get the *uids* to learn from the ``UID SEARCH`` response.
+
+        Args:
+            sa_learning (Sa_Learn): The result of the learning.
+            uids (list(str)): The response of the search of
+                :py:meth:`_learn_search`.
+            origpastuids (list(int)): ``uids`` to not process.
+            modseq (int): The ``HIGHESTMODSEQ`` of the last run.
+            highestmodseq (int): The current ``HIGHESTMODSEQ``.
+        Returns:
+            list(str): The *uids* to learn.
+
+        """
+        incremental = bool(modseq) and highestmodseq > modseq
+        if incremental:
+            # Remove the "(MODSEQ n)" at the end of the response
+            uids = [(uids[0] or '').split('(')[0]]
 
         uids, sa_learning.newpastuids = SpamAssassin.get_formated_uids(
             uids, origpastuids, self.partialrun)
+        if incremental:
+            # Only the changed messages have been searched, keep the others.
+            sa_learning.newpastuids = origpastuids
 
         sa_learning.tolearn = len(uids)
+        # The new modseq can be stored only if all the messages are learned.
+        sa_learning.complete = not self.dryrun and (
+            not self.partialrun or len(uids) < int(self.partialrun))
+        return uids
 
-        for uid in uids:
-            mail = imaputils.get_message(self.imap, uid, logger=self.logger)
+    def _learn_result(self, sa_learning, actions, res, fingerprints,
+                      learn_type, move_to, move):
+        """Account the result of :py:meth:`_learn` and add its actions.
 
-            # Unwrap spamassassin reports
-            unwrapped = sa_unwrap.unwrap(mail)
-            if unwrapped is not None:
-                self.logger.debug(__("{} Unwrapped: {}".format(
-                    uid, utils.shorten(imaputils.mail_content(
-                        unwrapped[0]), 140))))
+        Args:
+            sa_learning (Sa_Learn): The result of the learning.
+            actions (isbg.imaputils.UidCommands): The actions to send.
+            res (tuple): The result of :py:meth:`_learn`.
+            fingerprints (dict): The fingerprints of the messages, or *None*.
+            learn_type (str): ```spam``` or ```ham```.
+            move_to (str): If not *None*, the folder to move the message.
+            move (bool): If ``UID MOVE`` can be used.
 
-            if unwrapped is not None and unwrapped:  # len(unwrapped)>0
-                mail = unwrapped[0]
+        """
+        uid, mail, code, code_orig = res
+        self._learned(sa_learning, actions, uid, mail, code, code_orig,
+                      move_to, move)
+        self._add_learned(fingerprints, uid, code, learn_type)
+        if code in (5, 6):
+            self._add_index(sa_learning, uid, learn_type)
 
-            if self.dryrun:
-                code, code_orig = (0, 0)
-            else:
-                code, code_orig = learn_mail(mail, learn_type)
-
-            if code == -9999:  # error processing email, try next.
-                self.logger.exception(__(
-                    'spamc error for mail {}'.format(uid)))
-                self.logger.debug(repr(imaputils.mail_content(mail)))
-                continue
-
-            if code in [69, 74]:
-                raise isbg.ISBGError(
-                    isbg.__exitcodes__['flags'],
-                    "spamassassin is misconfigured (use --allow-tell)")
-
-            if code == 5:  # learned.
-                sa_learning.learned += 1
-                self.logger.debug(__(
-                    "Learned {} (spamc return code {})".format(uid,
-                                                               code_orig)))
-
-            elif code == 6:  # already learned.
-                self.logger.debug(__(
-                    "Already learned {} (spamc return code {})".format(
-                        uid, code_orig)))
-
-            elif code == 98:  # too big.
-                self.logger.warning(__(
-                    "{} is too big (spamc return code {})".format(
-                        uid, code_orig)))
+    @staticmethod
+    def _learn_done(sa_learning, highestmodseq):
+        """Set the new ``HIGHESTMODSEQ``, if all the messages are learned."""
+        if sa_learning.complete and highestmodseq:
+            sa_learning.modseq = highestmodseq
+
+    def _skip_learned(self, sa_learning, actions, uids, fingerprints,
+                      learn_type, move_to, move):
+        """Account the messages already learned according to `fingerprints`.
 
+        They are accounted as already learned (as if ``spamc`` has returned
+        ``6``), so their actions are added but they are not learned again.
+
+        Args:
+            sa_learning (Sa_Learn): The result of the learning.
+            actions (isbg.imaputils.UidCommands): The actions to send.
+            uids (list(str)): The *uids* to learn.
+            fingerprints (dict): The fingerprints of the `uids`.
+            learn_type (str): ```spam``` or ```ham```.
+            move_to (str): If not *None*, the folder to move the messages.
+            move (bool): If ``UID MOVE`` can be used.
+        Returns:
+            list(str): The *uids* that have to be learned.
+
+        """
+        tolearn = []
+        for uid in uids:
+            fingerprint = fingerprints.get(int(uid))
+            if self.fingerprints.learned(fingerprint) == learn_type:
+                self._learned(sa_learning, actions, uid, None, 6, 6, move_to,
+                              move)
             else:
-                raise isbg.ISBGError(-1, ("{}: Unknown return code {} from " +
-                                          "spamc").format(uid, code_orig))
-
-            sa_learning.uids.append(int(uid))
-
-            if not self.dryrun:
-                if self.learnthendestroy:
-                    if self.gmail:
-                        self.imap.uid("COPY", uid, "[Gmail]/Trash")
-                    else:
-                        self.imap.uid("STORE", uid, self.spamflagscmd,
-                                      "(\\Deleted)")
-                elif move_to is not None:
-                    self.imap.uid("COPY", uid, move_to)
-                elif self.learnthenflag:
-                    self.imap.uid("STORE", uid, self.spamflagscmd,
-                                  "(\\Flagged)")
+                tolearn.append(uid)
+        if len(tolearn) < len(uids):
+            self.logger.debug(__("{} messages already learned as {}".format(
+                len(uids) - len(tolearn), learn_type)))
+        return tolearn
 
-        return sa_learning
+    def _add_learned(self, fingerprints, uid, code, learn_type):
+        """Add a learned message to `fingerprints`, if they are used."""
+        if fingerprints is not None and code in (5, 6):
+            self.fingerprints.add(fingerprints.get(int(uid)), learn_type)
+
+    def _keyed(self, messages):
+        """Store the keys of the messages fetched, if `verdictindex` is set.
+
+        Args:
+            messages (Iterator): The *uid* and the message fetched.
+        Returns:
+            Iterator: The same `messages`.
+
+        """
+        for uid, mail in messages:
+            if self.verdictindex and mail is not None:
+                self._keys[uid] = imaputils.message_key(mail)
+            yield uid, mail
+
+    def _add_index(self, result, uid, verdict):
+        """Add a message processed to the `index` of `result`.
+
+        Args:
+            result (Sa_Learn, Sa_Process): The result of the process.
+            uid (str): The *uid* of the message.
+            verdict (str): ``spam`` or ``ham``.
+
+        """
+        key = self._keys.pop(uid, None)
+        if key is not None and not self.dryrun:
+            result.index[key] = [int(uid), verdict]
+
+    def _learned(self, sa_learning, actions, uid, mail, code, code_orig,
+                 move_to, move):
+        """Account a learned message and add its actions.
+
+        Args:
+            sa_learning (Sa_Learn): The result of the learning.
+            actions (isbg.imaputils.UidCommands): The actions to send.
+            uid (str): The *uid* of the message.
+            mail (email.message.Message): The message.
+            code (int): The return code of :py:func:`learn_mail`.
+            code_orig (int): The original return code.
+            move_to (str): If not *None*, the folder to move the message.
+            move (bool): If ``UID MOVE`` can be used.
+
+        Raises:
+            isbg.ISBGError: If SpamAssassin is misconfigured or the return
+                code is unknown.
+
+        """
+        if code == -9999:  # error processing email, try next.
+            self.logger.exception(__(
+                'spamc error for mail {}'.format(uid)))
+            self.logger.debug(repr(imaputils.mail_content(mail)))
+            sa_learning.complete = False
+            return
+
+        if code in [69, 74]:
+            raise isbg.ISBGError(
+                isbg.__exitcodes__['flags'],
+                "spamassassin is misconfigured (use --allow-tell)")
+
+        if code == 5:  # learned.
+            sa_learning.learned += 1
+            self.logger.debug(__(
+                "Learned {} (spamc return code {})".format(uid, code_orig)))
+
+        elif code == 6:  # already learned.
+            self.logger.debug(__(
+                "Already learned {} (spamc return code {})".format(
+                    uid, code_orig)))
+
+        elif code == 98:  # too big.
+            self.logger.warning(__(
+                "{} is too big (spamc return code {})".format(
+                    uid, code_orig)))
+
+        else:
+            raise isbg.ISBGError(-1, ("{}: Unknown return code {} from " +
+                                      "spamc").format(uid, code_orig))
+
+        sa_learning.uids.append(int(uid))
 
-    def _process_spam(self, uid, score, mail, spamdeletelist):
+        if not self.dryrun:
+            if self.learnthendestroy:
+                if self.gmail:
+                    actions.add("MOVE" if move else "COPY", [uid],
+                                "[Gmail]/Trash")
+                else:
+                    actions.add("STORE", [uid], self.spamflagscmd,
+                                "(\\Deleted)")
+            elif move_to is not None:
+                actions.add("MOVE" if move else "COPY", [uid], move_to)
+            elif self.learnthenflag:
+                actions.add("STORE", [uid], self.spamflagscmd,
+                            "(\\Flagged)")
+
+    def _learn(self, message, learn_type):
+        """Unwrap and learn a message.
+
+        It's called by the workers of :py:meth:`learn`, so it does not use
+        the *imap* connection.
+
+        Args:
+            message (tuple): The *uid* and the `email.message.Message`.
+            learn_type (str): ```spam``` or ```ham```.
+        Returns:
+            tuple: The *uid*, the message (unwrapped), the return code and
+            the original return code of :py:func:`learn_mail`.
+
+        """
+        uid, mail = message
+        mail = self._unwrap(uid, mail)
+
+        if self.dryrun:
+            code, code_orig = (0, 0)
+        else:
+            code, code_orig = self._learn_mail(mail, learn_type)
+            if self.verdicts is not None:
+                # Its verdict could change now.
+                self.verdicts.forget(mail)
+        return uid, mail, code, code_orig
+
+    def _unwrap(self, uid, mail):
+        """Get the mail unwrapped from a SpamAssassin report, if it's one."""
+        unwrapped = sa_unwrap.unwrap(mail)
+        if unwrapped is not None and unwrapped:  # len(unwrapped)>0
+            self.logger.debug(__("{} Unwrapped: {}".format(
+                uid, utils.shorten(imaputils.mail_content(
+                    unwrapped[0]), 140))))
+            mail = unwrapped[0]
+        return mail
+
+    def _process_spam(self, uid, score, mail, spamdeletelist, new_mail=None):
+        """Process a spam mail.
+
+        If `new_mail` is not *None*, it's used as the mail with the report
+        instead of feeding again `mail` to SpamAssassin.
+        """
+        if self._delete_spam(uid, score, spamdeletelist):
+            return False
+        if not self._report_needed():
+            return True
+
+        code, res = (None, None)
+        if new_mail is None:
+            new_mail, code = self._feed_mail(mail)
+        if new_mail != u"-9999":
+            res = self.imap.append(self.imapsets.spaminbox, None, None,
+                                   new_mail)
+        return self._spam_reported(uid, mail, new_mail, code, res,
+                                   spamdeletelist)
+
+    def _delete_spam(self, uid, score, spamdeletelist):
+        """Add a spam to `spamdeletelist` if its score is too high.
+
+        Returns:
+            bool: *True* if its score is higher than `deletehigherthan`, so
+            it's deleted instead of moved to the spam folder.
+
+        """
         self.logger.debug(__("{} is spam".format(uid)))
 
         if (self.deletehigherthan is not None and
                 float(score.split('/')[0]) > self.deletehigherthan):
             spamdeletelist.append(uid)
-            return False
+            return True
+        return False
+
+    def _report_needed(self):
+        """Check if the spams have to be stored with the report.
+
+        Returns:
+            bool: *True* if the spam has to be fed to SpamAssassin (unless
+            it's already got with the report) and appended to the spam
+            folder. Else, with `noreport`, it's copied (or moved) as is later
+            with the others.
 
-        # do we want to include the spam report
-        if self.noreport is False:
-            if self.dryrun:
+        """
+        if self.dryrun:
+            if self.noreport is False:
                 self.logger.info("Skipping report because of --dryrun")
             else:
-                new_mail, code = feed_mail(mail, cmd=self.cmd_save)
-                if new_mail == u"-9999":
-                    self.logger.exception(
-                        '{} error for mail {} (ret code {})'.format(
-                            self.cmd_save, uid, code))
-                    self.logger.debug(repr(imaputils.mail_content(mail)))
-                    if uid in spamdeletelist:
-                        spamdeletelist.remove(uid)
-                    return False
-
-                res = self.imap.append(self.imapsets.spaminbox, None, None,
-                                       new_mail)
-                # The above will fail on some IMAP servers for various
-                # reasons. We print out what happened and continue
-                # processing
-                if res[0] != 'OK':
-                    self.logger.error(__(
-                        ("{} failed for uid {}: {}. Leaving original" +
-                         "message alone.").format(
-                            repr(["append", self.imapsets.spaminbox,
-                                  "{email}"]),
-                            repr(uid), repr(res))))
-                    if uid in spamdeletelist:
-                        spamdeletelist.remove(uid)
-                    return False
-        else:
-            # No report:
-            if self.dryrun:
                 self.logger.info("Skipping copy to spambox because" +
                                  " of --dryrun")
-            else:
-                # just copy it as is
-                self.imap.uid("COPY", uid, self.imapsets.spaminbox)
+            return False
+        return self.noreport is False
 
-        return True
+    def _spam_reported(self, uid, mail, new_mail, code, res, spamdeletelist):
+        """Check the result of storing a spam with its report.
+
+        Args:
+            uid (str): The *uid* of the spam.
+            mail (email.message.Message): The spam.
+            new_mail (str): The spam with the report, or ``-9999`` if
+                SpamAssassin has failed.
+            code (int): The return code of :py:func:`feed_mail`, or *None*.
+            res (tuple): The response to ``APPEND``, or *None* if it has not
+                been appended.
+            spamdeletelist (list(str)): The spams to delete.
+        Returns:
+            bool: *True* if it has been stored, else the original message is
+            left alone.
+
+        """
+        if new_mail == u"-9999":
+            self.logger.exception(
+                '{} error for mail {} (ret code {})'.format(
+                    self.cmd_save, uid, code))
+            self.logger.debug(repr(imaputils.mail_content(mail)))
+        elif res[0] != 'OK':
+            # The append will fail on some IMAP servers for various reasons.
+            # We print out what happened and continue processing
+            self.logger.error(__(
+                ("{} failed for uid {}: {}. Leaving original" +
+                 "message alone.").format(
+                    repr(["append", self.imapsets.spaminbox, "{email}"]),
+                    repr(uid), repr(res))))
+        else:
+            return True
+        if uid in spamdeletelist:
+            spamdeletelist.remove(uid)
+        return False
+
+    def _classify(self, message):
+        """Unwrap and test a message.
 
-    def process_inbox(self, origpastuids):
-        """Run spamassassin in the folder for spam."""
+        It's called by the workers of :py:meth:`process_inbox`, so it does
+        not use the *imap* connection.
+
+        Args:
+            message (tuple): The *uid* and the `email.message.Message`.
+        Returns:
+            tuple: The *uid*, the message (unwrapped), the score, the message
+            with the report (only in `singlepass` mode) and the return code.
+            If `dryrun`, the message is not tested and the score, the report
+            and the code are *None*.
+
+        """
+        uid, mail, known = self._known_verdict(message)
+        if known is not None:
+            return known
+        new_mail = None
+        if self.singlepass and not self.noreport:
+            # Test it and get it with the report in one pass
+            score, new_mail, code = self._process_mail(mail)
+        else:
+            # Feed it to SpamAssassin in test mode
+            score, code = self._test_mail(mail)
+        self._cache_verdict(mail, score, code)
+        return uid, mail, score, new_mail, code
+
+    def _known_verdict(self, message):
+        """Unwrap a message and get its verdict, if it's already known.
+
+        Args:
+            message (tuple): The *uid* and the `email.message.Message`.
+        Returns:
+            tuple: The *uid*, the message (unwrapped) and the result of
+            :py:meth:`_classify` if it has not to be tested (it has a trusted
+            stamp, it's in the `verdicts` cache or `dryrun` is set), else
+            *None*.
+
+        """
+        uid, mail = message
+        if uid in self._stamps:
+            # Already scanned by the MTA, the body could be not fetched
+            score, code = self._stamps[uid]
+            return uid, mail, (uid, mail, score, None, code)
+
+        mail = self._unwrap(uid, mail)
+        if self.dryrun:
+            return uid, mail, (uid, mail, None, None, None)
+        verdict = self._cached_verdict(mail)
+        if verdict is not None:
+            # Already scanned, its report is got later if it's needed
+            return uid, mail, (uid, mail) + (verdict[0], None, verdict[1])
+        return uid, mail, None
+
+    def _stamp_verdict(self, internaldate, headers, now):
+        """Get the verdict stamped by the MTA in the headers of a message.
+
+        It's only trusted if the first ``X-Spam-Checker-Version`` header was
+        added by the `trustspamheaders` host, and the message was received
+        less than `spamheadersmaxage` seconds ago.
+
+        Args:
+            internaldate (float): The ``INTERNALDATE`` of the message.
+            headers (email.message.Message): The headers of the message.
+            now (float): The current time.
+        Returns:
+            tuple(str, int): The score and the code (``1`` if it's spam), as
+            :py:func:`test_mail`, or *None* if there is not a trusted stamp.
+
+        """
+        if internaldate is None or \
+                now - internaldate > self.spamheadersmaxage:
+            return None
+        checker = (headers.get('X-Spam-Checker-Version') or '').split()
+        if [x.lower() for x in checker[-2:]] != \
+                ['on', self.trustspamheaders.lower()]:
+            return None
+        status = headers.get('X-Spam-Status') or ''
+        try:
+            score = utils.score_from_mail(status)
+        except AttributeError:  # No score in it.
+            return None
+        return score, 1 if status.strip().lower().startswith('yes') else 0
+
+    def _stamp_verdicts(self, headers):
+        """Get the trusted verdicts of `headers`, see `_stamp_verdict`.
+
+        Args:
+            headers (dict): The ``INTERNALDATE`` and the headers of the
+                messages, as :py:func:`isbg.imaputils.get_headers`.
+        Returns:
+            dict: The score and the code of the *uids* (as :obj:`str`) with
+            a trusted stamp.
+
+        """
+        now = time.time()
+        stamps = {}
+        for uid, (internaldate, mail) in headers.items():
+            verdict = self._stamp_verdict(internaldate, mail, now)
+            if verdict is not None:
+                stamps[str(uid)] = verdict
+        return stamps
+
+    def _need_body(self, uid):
+        """Check if the body of a message of process_inbox must be fetched.
+
+        It's not needed if the message has a trusted stamp, unless it's a
+        spam and the report has to be added to it.
+        """
+        stamp = self._stamps.get(uid)
+        return stamp is None or (stamp[1] == 1 and self.noreport is False)
+
+    def _cached_verdict(self, mail):
+        """Get the score and the code of a mail from `verdicts`.
+
+        Returns:
+            tuple(str, int): The score and the code, or *None* if the
+            `verdicts` cache is not used or the mail is not found in it.
+
+        """
+        if self.verdicts is None:
+            return None
+        verdict = self.verdicts.get(mail, self.verdictttl)
+        if verdict is not None:
+            with self._cachelock:
+                self._cachehits += 1
+        return verdict
+
+    def _cache_verdict(self, mail, score, code):
+        """Store the verdict of a mail in `verdicts`, if it's used."""
+        if self.verdicts is not None and code in (0, 1) and \
+                score not in (None, "-9999", "0/0\n"):
+            self.verdicts.put(mail, score, code)
+
+    def process_inbox(self, origpastuids, highwater=0):
+        """Run spamassassin in the folder for spam.
+
+        Args:
+            origpastuids (list(int)): ``uids`` to not process.
+            highwater (int): The high-water mark. Only the ``uids`` higher
+                than it are searched. If ``0``, all the folder is searched.
+        Returns:
+            Sa_Process: It contains the information about the result of the
+            process, with the new high-water mark and, if `verdictindex` is
+            set, the keys of the messages processed.
+
+        """
         sa_proc = Sa_Process()
+        self._cachehits = 0
 
         spamlist = []
         spamdeletelist = []
@@ -443,94 +1281,309 @@ class SpamAssassin(object):
         self.imap.select(self.imapsets.inbox, 1)
 
         # get the uids of all mails with a size less then the maxsize
-        _, uids = self.imap.uid("SEARCH", None, "SMALLER", str(self.maxsize))
+        _, uids = self.imap.uid("SEARCH", None,
+                                *self._inbox_criteria(highwater))
+        uids, found = self._inbox_uids(sa_proc, uids, origpastuids, highwater)
+
+        self._stamps, self._keys = ({}, {})
+        if self.trustspamheaders and not self.dryrun:
+            self._stamps = self._stamp_verdicts(
+                imaputils.get_headers(self.imap, uids))
+            sa_proc.stamped = len(self._stamps)
+
+        # Main loop that iterates over each new uid we haven't seen before,
+        # the messages are retrieved in batches and scanned by the workers
+        # while we act over the previous ones.
+        lock = threading.Lock()
+
+        def hook(stage, seconds):
+            with lock:
+                sa_proc.add_stage_time(stage, seconds)
+            if self.stats_hook is not None:
+                self.stats_hook(stage, seconds)
+
+        for uid, mail, score, new_mail, code in pipeline(
+                self._inbox_messages(list(uids)), self._classify, self.workers,
+                self.queue_items, self.queue_bytes,
+                lambda message: 0 if message[1] is None else len(
+                    imaputils.mail_content(message[1])),
+                hook):
+            scored = self._scored(sa_proc, uids, uid, mail, score, new_mail,
+                                  code)
+            if scored is None:
+                break
+            score, code = scored
+            # Message is spam, delete it or move it to spaminbox
+            # (optionally with report)
+            if code and self._process_spam(uid, score, mail, spamdeletelist,
+                                           new_mail):
+                spamlist.append(uid)
+
+        # If we found any spams, now go and mark the original messages,
+        # and the messages scanned with the scankeyword.
+        if self._mark_needed(sa_proc, uids, spamlist, spamdeletelist):
+            self.imap.select(self.imapsets.inbox)
+            # The actions are sent in batches of uids.
+            move = self.imap.has_capability('MOVE')
+            actions = imaputils.UidCommands(self.imap)
+            self._keyword_actions(actions, uids)
+            deleted = self._spam_actions(actions, spamlist, spamdeletelist,
+                                         sa_proc, move)
+            actions.flush()
+            expunge = self._expunge_uids(deleted, sa_proc, move)
+            if expunge:
+                actions.add("EXPUNGE", expunge)
+                actions.flush()
+            elif expunge is None:
+                self.imap.expunge()
+
+        self._set_highwater(sa_proc, found, highwater, origpastuids)
+        return sa_proc
+
+    def _inbox_uids(self, sa_proc, uids, origpastuids, highwater):
+        """Get the *uids* to process from the ``UID SEARCH`` response.
+
+        Args:
+            sa_proc (Sa_Process): The result of the process.
+            uids (list(str)): The response of the search of
+                :py:meth:`_inbox_criteria`.
+            origpastuids (list(int)): ``uids`` to not process.
+            highwater (int): The high-water mark of the search.
+        Returns:
+            tuple: The *uids* to process and the *uids* found, as
+            :py:meth:`_found_uids`.
+
+        """
+        uids, found = self._found_uids(uids, highwater)
 
         uids, sa_proc.newpastuids = SpamAssassin.get_formated_uids(
             uids, origpastuids, self.partialrun)
 
         self.logger.debug(__('Got {} mails to check'.format(len(uids))))
+        self._faked = 0
+        return uids, found
 
-        if self.dryrun:
-            processednum = 0
-            fakespammax = 1
-            processmax = 5
+    def _scored(self, sa_proc, uids, uid, mail, score, new_mail, code):
+        """Account a message classified by :py:meth:`process_inbox`.
 
-        # Main loop that iterates over each new uid we haven't seen before
-        for uid in uids:
-            # Retrieve the entire message
-            mail = imaputils.get_message(self.imap, uid, sa_proc.uids,
-                                         logger=self.logger)
+        With `dryrun`, the first message is faked as spam, and the next
+        ones as ham.
 
-            # Unwrap spamassassin reports
-            unwrapped = sa_unwrap.unwrap(mail)
-            if unwrapped is not None and unwrapped:  # len(unwrapped) > 0
-                mail = unwrapped[0]
+        Args:
+            sa_proc (Sa_Process): The result of the process.
+            uids (list(str)): The *uids* to process. The messages that can't
+                be tested are removed from it.
+            uid, mail, score, new_mail, code: The result of
+                :py:meth:`_classify`.
+        Returns:
+            tuple(str, int): The score and the code of the message (``0`` if
+            it has to be skipped), or *None* if the process has to stop (with
+            `dryrun`).
 
-            # Feed it to SpamAssassin in test mode
-            if self.dryrun:
-                if processednum > processmax:
-                    break
-                if processednum < fakespammax:
-                    self.logger.info("Faking spam mail")
-                    score = "10/10"
-                    code = 1
-                else:
-                    self.logger.info("Faking ham mail")
-                    score = "0/10"
-                    code = 0
-                processednum = processednum + 1
+        Raises:
+            isbg.ISBGError: If ``spamd`` has failed.
+
+        """
+        sa_proc.uids.append(int(uid))
+
+        if self.dryrun:
+            fakespammax, processmax = (1, 5)
+            if self._faked > processmax:
+                return None
+            if self._faked < fakespammax:
+                self.logger.info("Faking spam mail")
+                score, code = ("10/10", 1)
             else:
-                score, code = test_mail(mail, cmd=self.cmd_test)
-                if score == "-9999":
-                    self.logger.exception(__(
-                        '{} error for mail {}'.format(self.cmd_test, uid)))
-                    self.logger.debug(repr(mail))
-                    uids.remove(uid)
-                    continue
-
-            if score == "0/0\n":
-                raise isbg.ISBGError(isbg.__exitcodes__['spamc'],
-                                     "spamc -> spamd error - aborting")
+                self.logger.info("Faking ham mail")
+                score, code = ("0/10", 0)
+            self._faked += 1
+        elif score == "-9999":
+            self.logger.exception(__('{} error for mail {}'.format(
+                self.cmd_process if new_mail is not None else
+                self.cmd_test, uid)))
+            self.logger.debug(repr(mail))
+            uids.remove(uid)
+            return score, 0
+
+        if score == "0/0\n":
+            raise isbg.ISBGError(isbg.__exitcodes__['spamc'],
+                                 "spamc -> spamd error - aborting")
 
-            self.logger.debug(__(
-                "Score for uid {}: {}".format(uid, score.strip())))
+        self.logger.debug(__(
+            "Score for uid {}: {}".format(uid, score.strip())))
+        self._add_index(sa_proc, uid, 'spam' if code else 'ham')
+        return score, code
 
-            if code != 0:
-                # Message is spam, delete it or move it to spaminbox
-                # (optionally with report)
-                if not self._process_spam(uid, score, mail, spamdeletelist):
-                    continue
-                spamlist.append(uid)
+    def _mark_needed(self, sa_proc, uids, spamlist, spamdeletelist):
+        """Account the spams found and check if the inbox must be marked.
+
+        Returns:
+            bool: *True* if there are spams to act over or messages to mark
+            with the `scankeyword`, and `dryrun` is not set.
 
+        """
         sa_proc.nummsg = len(uids)
+        sa_proc.cachehits = self._cachehits
         sa_proc.spamdeleted = len(spamdeletelist)
         sa_proc.numspam = len(spamlist) + sa_proc.spamdeleted
 
-        # If we found any spams, now go and mark the original messages
-        if sa_proc.numspam or sa_proc.spamdeleted:
-            if self.dryrun:
-                self.logger.info('Skipping labelling/expunging of mails ' +
-                                 ' because of --dryrun')
+        if not (sa_proc.numspam or sa_proc.spamdeleted or
+                (self.scankeyword and uids)):
+            return False
+        if self.dryrun:
+            self.logger.info('Skipping labelling/expunging of mails ' +
+                             ' because of --dryrun')
+            return False
+        return True
+
+    def _expunge_uids(self, deleted, sa_proc, move):
+        """Get what to expunge after acting over the spams, if `expunge`.
+
+        Args:
+            deleted (list(str)): The *uids* flagged as deleted by us.
+            sa_proc (Sa_Process): The result of the process.
+            move (bool): If ``UID MOVE`` has been used.
+        Returns:
+            list(str): The *uids* to expunge with ``UID EXPUNGE`` (the server
+            supports ``UIDPLUS``), empty if nothing has to be expunged, or
+            *None* if all the inbox must be expunged with ``EXPUNGE``.
+
+        """
+        if not self.expunge:
+            return []
+        if self.imap.has_capability('UIDPLUS'):
+            # Only the messages that we have flagged are expunged
+            return deleted
+        if deleted or (sa_proc.numspam and not move):
+            return None
+        # Nothing to expunge if the spams have been moved
+        return []
+
+    def _inbox_messages(self, uids):
+        """Get the messages to process, fetching only the needed bodies.
+
+        Returns:
+            Iterator[Tuple[str, isbg.imaputils.RawMessage]]: The *uid* and
+            the message (*None* if its body is not needed, see
+            :py:meth:`_need_body`) in the same order than `uids`.
+
+        """
+        fetched = self._keyed(imaputils.get_messages(
+            self.imap, [u for u in uids if self._need_body(u)],
+            logger=self.logger))
+        for uid in uids:
+            if self._need_body(uid):
+                yield next(fetched)
             else:
-                self.imap.select(self.imapsets.inbox)
-                # Only set message flags if there are any
-                if self.spamflags:  # len(self.smpamflgs) > 0
-                    for uid in spamlist:
-                        self.imap.uid("STORE", uid, self.spamflagscmd,
-                                      imaputils.imapflags(self.spamflags))
-                        sa_proc.newpastuids.append(uid)
-                # If its gmail, and --delete was passed, we actually copy!
-                if self.delete and self.gmail:
-                    for uid in spamlist:
-                        self.imap.uid("COPY", uid, "[Gmail]/Trash")
-                # Set deleted flag for spam with high score
-                for uid in spamdeletelist:
-                    if self.gmail is True:
-                        self.imap.uid("COPY", uid, "[Gmail]/Trash")
-                    else:
-                        self.imap.uid("STORE", uid, self.spamflagscmd,
-                                      "(\\Deleted)")
-                if self.expunge:
-                    self.imap.expunge()
+                yield uid, None
 
-        return sa_proc
+    def _inbox_criteria(self, highwater):
+        """Get the ``SEARCH`` criteria of the inbox messages to process.
+
+        Only the messages smaller than `maxsize` and, if `highwater` is not
+        ``0``, with an *uid* higher than it. If `scankeyword` is used, only
+        the messages smaller than `maxsize` without it.
+        """
+        if self.scankeyword:
+            return ["UNKEYWORD", self.scankeyword, "SMALLER",
+                    str(self.maxsize)]
+        if highwater:
+            return ["UID", "{}:*".format(highwater + 1), "SMALLER",
+                    str(self.maxsize)]
+        return ["SMALLER", str(self.maxsize)]
+
+    def _keyword_actions(self, actions, uids):
+        """Add the `scankeyword` to the messages scanned, if it's used.
+
+        It's added before acting over the spams, so the copies of the spams
+        also have it.
+        """
+        if self.scankeyword and uids:
+            actions.add("STORE", uids, "+FLAGS.SILENT",
+                        imaputils.imapflags([self.scankeyword]))
+
+    @staticmethod
+    def _found_uids(uids, highwater):
+        """Get the *uids* found in the inbox.
+
+        Args:
+            uids (list(str)): The ``SEARCH`` response.
+            highwater (int): The high-water mark of the search.
+        Returns:
+            tuple: The ``SEARCH`` response without the *uids* lower than
+            the high-water mark and the *uids* found as sorted integers.
+
+        """
+        if highwater:
+            # "n:*" matches the last message even if its uid is lower than n
+            uids = [' '.join(u for u in (uids[0] or '').split()
+                             if int(u) > highwater)]
+        return uids, sorted(int(u) for u in (uids[0] or '').split())
+
+    def _spam_actions(self, actions, spamlist, spamdeletelist, sa_proc, move):
+        """Add the actions over the spams found in the inbox.
+
+        Args:
+            actions (isbg.imaputils.UidCommands): The actions to send.
+            spamlist (list(str)): The spams to flag, copy or move.
+            spamdeletelist (list(str)): The spams to delete.
+            sa_proc (Sa_Process): The result of the process.
+            move (bool): If ``UID MOVE`` can be used.
+        Returns:
+            list(str): The *uids* flagged as deleted.
+
+        """
+        deleted = []  # The uids flagged as deleted by us.
+        if spamlist and self.move_spam:
+            # Moved, they are not flagged nor deleted
+            actions.add("MOVE", spamlist, self.imapsets.spaminbox)
+            sa_proc.newpastuids.extend(spamlist)
+        else:
+            if self.noreport:
+                # just copy them as they are
+                actions.add("COPY", spamlist, self.imapsets.spaminbox)
+            # Only set message flags if there are any
+            if self.spamflags and spamlist:
+                actions.add("STORE", spamlist, self.spamflagscmd,
+                            imaputils.imapflags(self.spamflags))
+                sa_proc.newpastuids.extend(spamlist)
+                if "\\Deleted" in self.spamflags:
+                    deleted.extend(spamlist)
+        # If its gmail, and --delete was passed, we actually copy!
+        trash = "MOVE" if move else "COPY"
+        if self.delete and self.gmail:
+            actions.add(trash, spamlist, "[Gmail]/Trash")
+        # Set deleted flag for spam with high score
+        if spamdeletelist and self.gmail is True:
+            actions.add(trash, spamdeletelist, "[Gmail]/Trash")
+        elif spamdeletelist:
+            actions.add("STORE", spamdeletelist, self.spamflagscmd,
+                        "(\\Deleted)")
+            deleted.extend(spamdeletelist)
+        return deleted
+
+    @staticmethod
+    def _set_highwater(sa_proc, found, highwater, origpastuids):
+        """Set the new high-water mark and past *uids* of a process.
+
+        The new high-water mark is the highest uid found with all the lower
+        ones processed (with partialrun the newest ones are processed
+        first). The past uids under the old high-water mark are kept, as
+        they have not been searched.
+        """
+        done = set(int(u) for u in sa_proc.newpastuids)
+        done.update(sa_proc.uids)
+        sa_proc.highwater = highwater
+        for uid in found:
+            if uid not in done:
+                break
+            sa_proc.highwater = uid
+        sa_proc.complete = not found or sa_proc.highwater == found[-1]
+        if highwater:
+            if isinstance(origpastuids, imaputils.UidSet):
+                newpastuids = origpastuids.upto(highwater)
+            else:
+                newpastuids = imaputils.UidSet(
+                    u for u in origpastuids if int(u) <= highwater)
+            newpastuids.update(sa_proc.newpastuids)
+            sa_proc.newpastuids = newpastuids
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  verdicts.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+r"""Persistent cache of the SpamAssassin verdicts.
+
+The same message is often delivered to several mailboxes. The verdict
+(score, required score and if it's spam) of a message is stored in a json
+file with the hash of its sender, subject and body, so the copies in the
+other accounts, or in later runs, are not scanned again.
+
+The values are normalized before hashing them: all the runs of whitespace
+are collapsed. The bodies shorter than :py:data:`MIN_BODY` are not cached,
+they are too generic to identify a message. The ``Message-ID`` is used as a
+secondary key when the hash is not found, but only for spams, and a ham
+verdict is only reused when the ``Message-ID`` matches too: a message can't
+get a ham verdict just by copying the body or the ``Message-ID`` of a ham.
+
+The entries expire after a time given when they are looked up, and the
+least recently used ones are evicted when there are more than
+:py:attr:`VerdictCache.max_entries`.
+
+Examples:
+    >>> cache = get_cache('/tmp/verdicts')
+    >>> cache.put(mail, "15.2/5.0\n", 1)
+    >>> cache.get(mail, ttl=3600)
+    ('15.2/5.0\n', 1)
+    >>> cache.save()
+
+.. versionadded:: 2.2.0
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from isbg import imaputils
+
+#: Min length of the normalized body of the mails cached.
+MIN_BODY = 64
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+_KEY_HEADERS_RE = [re.compile(br'^' + name + br':[ \t]*(.*(?:\r?\n[ \t].*)*)',
+                              re.IGNORECASE | re.MULTILINE)
+                   for name in (b'from', b'subject')]
+
+
+def get_cache(filename):
+    """Get the cache of a file.
+
+    The same :py:class:`VerdictCache` is returned for the same file, so it's
+    shared by the accounts processed from the same process.
+
+    Args:
+        filename (str): The cache file name.
+    Returns:
+        VerdictCache: The cache.
+
+    """
+    with _CACHES_LOCK:
+        if filename not in _CACHES:
+            _CACHES[filename] = VerdictCache(filename)
+        return _CACHES[filename]
+
+
+def mail_keys(mail):
+    """Get the keys of a mail in the cache.
+
+    Args:
+        mail (email.message.Message, isbg.imaputils.RawMessage): The mail.
+    Returns:
+        tuple(str, str): The hash of the normalized sender, subject and
+        body (*None* if the body is shorter than :py:data:`MIN_BODY`) and
+        the ``Message-ID`` (*None* if it has not one).
+
+    """
+    content = imaputils.mail_content(mail)
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8', errors='replace')
+    match = re.search(b'\r?\n\r?\n', content)
+    if match is None:
+        headers, body = (content, b'')
+    else:
+        headers, body = (content[:match.start()], content[match.end():])
+
+    body = b' '.join(body.split())
+    bodyhash = None
+    if len(body) >= MIN_BODY:
+        digest = hashlib.sha256()
+        for regex in _KEY_HEADERS_RE:
+            match = regex.search(headers)
+            digest.update(b' '.join(match.group(1).split()) if match else b'')
+            digest.update(b'\0')
+        digest.update(body)
+        bodyhash = digest.hexdigest()
+    match = imaputils.MESSAGEID_RE.search(headers)
+    messageid = match.group(1).decode('ascii', 'replace') if match else None
+    return bodyhash, messageid
+
+
+class VerdictCache(object):
+    """The verdicts of the messages scanned, stored in a json file.
+
+    It's thread safe. The file is read the first time that it's needed, and
+    written with :py:meth:`save`, merging it with the verdicts saved by
+    other processes since it was read.
+
+    Args:
+        filename (str): The cache file name.
+
+    """
+
+    #: Max number of verdicts kept.
+    max_entries = 50000
+    #: Max age in seconds of the verdicts kept in the file.
+    max_age = 7 * 24 * 3600
+
+    def __init__(self, filename):
+        """Initialize a VerdictCache object."""
+        self.filename = filename  #: The cache file name.
+        self._lock = threading.Lock()
+        self._bodies = None       # mail hash: verdict
+        self._messageids = None   # Message-ID: mail hash
+
+    @staticmethod
+    def _read(filename):
+        """Read a cache file, empty if it doesn't exist or it's invalid."""
+        try:
+            with open(filename, 'r') as rfile:
+                struct = json.load(rfile)
+            return (dict(struct.get('bodies', {})),
+                    dict(struct.get('messageids', {})))
+        except (IOError, OSError, ValueError, AttributeError, TypeError):
+            return {}, {}
+
+    def _load(self):
+        """Read the file, if it has not been read."""
+        if self._bodies is None:
+            self._bodies, self._messageids = self._read(self.filename)
+
+    def get(self, mail, ttl):
+        """Get the verdict of a mail.
+
+        Args:
+            mail (email.message.Message, isbg.imaputils.RawMessage): The mail.
+            ttl (int): The max age in seconds of the verdict.
+        Returns:
+            tuple(str, int): The score (as ``score/required``) and the code
+            (``1`` if it's spam) as returned by
+            :py:func:`isbg.spamproc.test_mail`, or *None* if it's not found
+            or it has expired.
+
+        """
+        bodyhash, messageid = mail_keys(mail)
+        now = time.time()
+        with self._lock:
+            self._load()
+            verdict = self._bodies.get(bodyhash)
+            if (verdict is not None and not verdict['spam'] and
+                    (messageid is None or
+                     verdict.get('messageid') != messageid)):
+                verdict = None  # A ham is only reused for the same mail.
+            if verdict is None and messageid is not None:
+                verdict = self._bodies.get(self._messageids.get(messageid))
+                if verdict is not None and not verdict['spam']:
+                    verdict = None
+            if verdict is None or now - verdict['time'] > ttl:
+                return None
+            verdict['used'] = now
+            return ("{}/{}\n".format(verdict['score'], verdict['required']),
+                    1 if verdict['spam'] else 0)
+
+    def put(self, mail, score, code):
+        """Store the verdict of a mail.
+
+        Args:
+            mail (email.message.Message, isbg.imaputils.RawMessage): The mail.
+            score (str): The score, as ``score/required``.
+            code (int): ``1`` if it's spam, ``0`` if not.
+
+        """
+        bodyhash, messageid = mail_keys(mail)
+        if bodyhash is None:
+            return
+        score, required = [float(x) for x in score.strip().split('/')]
+        now = time.time()
+        with self._lock:
+            self._load()
+            self._bodies[bodyhash] = {'score': score, 'required': required,
+                                      'spam': code == 1, 'time': now,
+                                      'used': now, 'messageid': messageid}
+            if messageid is not None:
+                self._messageids[messageid] = bodyhash
+            if len(self._bodies) > self.max_entries * 1.1:
+                self._evict(now)
+
+    def forget(self, mail):
+        """Remove the verdict of a mail, e.g. when it's learned.
+
+        Args:
+            mail (email.message.Message, isbg.imaputils.RawMessage): The mail.
+
+        """
+        bodyhash, messageid = mail_keys(mail)
+        with self._lock:
+            self._load()
+            self._bodies.pop(bodyhash, None)
+            self._bodies.pop(self._messageids.pop(messageid, None), None)
+
+    def _evict(self, now):
+        """Remove the old verdicts and the least recently used ones."""
+        for bodyhash, verdict in list(self._bodies.items()):
+            if now - verdict['time'] > self.max_age:
+                del self._bodies[bodyhash]
+        if len(self._bodies) > self.max_entries:
+            lru = sorted(self._bodies, key=lambda k: self._bodies[k]['used'])
+            for bodyhash in lru[:len(self._bodies) - self.max_entries]:
+                del self._bodies[bodyhash]
+        self._messageids = dict((k, v) for k, v in self._messageids.items()
+                                if v in self._bodies)
+
+    def save(self):
+        """Write the cache file.
+
+        It's merged with the file contents, keeping the most recently used
+        verdicts, and written atomically.
+        """
+        with self._lock:
+            if self._bodies is None:
+                return  # Not used.
+            bodies, messageids = self._read(self.filename)
+            for bodyhash, verdict in bodies.items():
+                mine = self._bodies.get(bodyhash)
+                if mine is None or mine['used'] < verdict.get('used', 0):
+                    self._bodies[bodyhash] = verdict
+            for messageid, bodyhash in messageids.items():
+                self._messageids.setdefault(messageid, bodyhash)
+            self._evict(time.time())
+
+            tmpname = "{}.{}.{}".format(self.filename, os.getpid(),
+                                        threading.current_thread().ident)
+            with open(tmpname, 'w') as wfile:
+                os.chmod(tmpname, 0o600)
+                json.dump({'bodies': self._bodies,
+                           'messageids': self._messageids}, wfile)
+            getattr(os, 'replace', os.rename)(tmpname, self.filename)
@@ -80,6 +80,7 @@ setup(
         'console_scripts': [
             'isbg = isbg.__main__:main',
             'isbg_sa_unwrap = isbg.sa_unwrap:isbg_sa_unwrap',
+            'isbg_accounts = isbg.accounts:isbg_accounts',
         ]
     },
     cmdclass={
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  conftest.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Configuration of the tests."""
+
+import imaplib
+import sys
+import time
+
+# isbg.aio requires python 3.5 (async and await).
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append('test_aio.py')
+
+
+class FakeImap(object):
+    """A fake IsbgImap4 with a mailbox for every folder.
+
+    The uids of the messages are also their sequence numbers.
+    """
+
+    def __init__(self, folders):
+        """Store the folders, a dict of name: {uid: body}."""
+        self.folders = folders
+        self.selected = None
+        self.commands = []
+        self.searches = []
+        self.fetches = []
+        self.capabilities = set()
+        self.modseqs = {}  # The modseq of every uid, 1 if it's not here.
+        self.internaldate = time.time()  # The INTERNALDATE of every message.
+        self.flags = {}  # The flags stored in every uid.
+        self.uidvalidity = 1
+
+    @staticmethod
+    def _uids(seqset):
+        """Get the uids of a sequence set."""
+        uids = []
+        for rng in str(seqset).split(','):
+            first, _, last = rng.partition(':')
+            uids.extend(range(int(first), int(last or first) + 1))
+        return uids
+
+    def has_capability(self, name):
+        """Check a capability."""
+        return name in self.capabilities
+
+    def get_status(self, mailbox, names):
+        """Get the HIGHESTMODSEQ and the UIDVALIDITY."""
+        return {'HIGHESTMODSEQ': max([1] + list(self.modseqs.values())),
+                'UIDVALIDITY': self.uidvalidity}
+
+    def select(self, mailbox='INBOX', readonly=False):
+        """Select a mailbox."""
+        self.selected = mailbox
+        return 'OK', [str(len(self.folders[mailbox]))]
+
+    def append(self, mailbox, flags, date_time, message):
+        """Append a message."""
+        self.commands.append(('APPEND', mailbox))
+        return 'OK', [None]
+
+    def expunge(self):
+        """Expunge the mailbox."""
+        self.commands.append(('EXPUNGE',))
+        return 'OK', [None]
+
+    def uid(self, command, *args):
+        """Execute a uid command."""
+        mails = self.folders[self.selected]
+        if command == 'SEARCH':
+            self.searches.append(args)
+            uids = sorted(mails)
+            if 'UID' in args:
+                first = int(args[args.index('UID') + 1].split(':')[0])
+                # "n:*" always matches the last message.
+                uids = [u for u in uids if u >= first] or uids[-1:]
+            if 'UNKEYWORD' in args:
+                keyword = args[args.index('UNKEYWORD') + 1]
+                uids = [u for u in uids
+                        if keyword not in self.flags.get(u, set())]
+            if 'MODSEQ' in args:
+                modseq = int(args[args.index('MODSEQ') + 1])
+                uids = [u for u in uids if self.modseqs.get(u, 1) >= modseq]
+                return 'OK', ['{} (MODSEQ {})'.format(
+                    ' '.join(str(u) for u in uids),
+                    max([1] + list(self.modseqs.values())))]
+            return 'OK', [' '.join(str(u) for u in uids)]
+        if command == 'FETCH':
+            self.fetches.append(args)
+            data = []
+            for uid in self._uids(args[0]):
+                if uid not in mails:
+                    continue
+                if 'BODY.PEEK[HEADER]' in args[1]:
+                    headers = mails[uid].split('\n\n')[0] + '\n\n'
+                    data.append((
+                        '{} (UID {} INTERNALDATE {} BODY[HEADER] {{{}}}'
+                        .format(uid, uid, imaplib.Time2Internaldate(
+                            self.internaldate), len(headers)), headers))
+                elif 'HEADER.FIELDS' in args[1]:
+                    fields = args[1].split('FIELDS (')[1].split(')')[0]
+                    headers = ''.join(
+                        line + '\n' for line in mails[uid].split('\n\n')[0]
+                        .split('\n') if line.split(':')[0].upper() in
+                        fields.split())
+                    data.append((
+                        '{} (UID {} RFC822.SIZE {} BODY[HEADER.FIELDS '
+                        '({})] {{{}}}'.format(uid, uid, len(mails[uid]),
+                                              fields, len(headers)),
+                        headers))
+                else:
+                    data.append(('{} (UID {} BODY[] {{{}}}'.format(
+                        uid, uid, len(mails[uid])), mails[uid]))
+                data.append(')')
+            return 'OK', data
+        self.commands.append((command,) + args)
+        if command == 'STORE' and args[1].startswith('+FLAGS'):
+            for uid in self._uids(args[0]):
+                self.flags.setdefault(uid, set()).update(
+                    args[2].strip('()').split())
+        return 'OK', [None]
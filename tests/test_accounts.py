@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_accounts.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Tests for accounts.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sys
+import threading
+import time
+try:
+    import pytest
+except ImportError:
+    pass
+try:
+    from unittest import mock  # Python 3
+except ImportError:
+    import mock                # Python 2
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import accounts  # noqa: E402
+from isbg import isbg      # noqa: E402
+
+
+def test_read_accounts(tmpdir):
+    """Test read_accounts."""
+    filename = str(tmpdir.join('accounts'))
+    with open(filename, 'w') as wfile:
+        wfile.write("[DEFAULT]\n"
+                    "imaphost = imap.example.org\n"
+                    "delete = yes\n"
+                    "[user1]\n"
+                    "imapuser = user1\n"
+                    "imappasswd = pass%1\n"
+                    "[user2]\n"
+                    "imapuser = user2\n"
+                    "delete = no\n"
+                    "workers = 1\n")
+    accs = dict(accounts.read_accounts(filename))
+    assert sorted(accs) == ['user1', 'user2']
+    assert sorted(accs['user1']) == sorted([
+        '--imaphost', 'imap.example.org', '--delete', '--imapuser', 'user1',
+        '--imappasswd', 'pass%1'])
+    assert sorted(accs['user2']) == sorted([
+        '--imaphost', 'imap.example.org', '--imapuser', 'user2',
+        '--workers', '1'])
+
+    with pytest.raises(isbg.ISBGError, match="Can't read"):
+        accounts.read_accounts(str(tmpdir.join('foo')))
+
+
+def test_run_account():
+    """Test run_account."""
+    argv = ['--imaphost', 'localhost', '--imappasswd', 'foo', '--imapuser']
+    with mock.patch.object(isbg.ISBG, 'do_isbg', autospec=True) as mocked:
+        mocked.side_effect = lambda sbg: sbg._do_lockfile_or_raise()
+        semaphore = threading.BoundedSemaphore(1)
+        assert accounts.run_account('u1', argv + ['u1'], semaphore) == 0
+        assert accounts.run_account('u2', argv + ['u2']) == 0
+        # Every account has its own lock file and logger, and the lock
+        # files are removed:
+        sbg1, sbg2 = [call[0][0] for call in mocked.call_args_list]
+        assert sbg1.lockfilename != sbg2.lockfilename
+        assert not os.path.exists(sbg1.lockfilename)
+        assert sbg1.logger.name.endswith('.u1')
+        assert sbg1.sa_semaphore is semaphore
+        assert sbg2.sa_semaphore is None
+        assert sbg1.interactive is False
+
+        # A running account keeps its lock:
+        with open(sbg1.lockfilename, 'w') as lockfile:
+            lockfile.write('0')
+        assert accounts.run_account('u1', argv + ['u1']) == \
+            isbg.__exitcodes__['locked']
+        assert os.path.exists(sbg1.lockfilename)
+        os.remove(sbg1.lockfilename)
+
+        mocked.side_effect = ValueError("foo")
+        assert accounts.run_account('u1', argv + ['u1']) == \
+            isbg.__exitcodes__['error']
+
+    assert accounts.run_account('u1', ['--foo']) != 0
+
+
+def test_run_accounts():
+    """Test run_accounts limits the accounts processed concurrently."""
+    lock = threading.Lock()
+    running = [0, 0]  # current and max
+
+    def run_account(name, argv, sa_semaphore):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return 0 if name != 'u3' else 11
+
+    accs = [('u{}'.format(i), []) for i in range(6)]
+    with mock.patch.object(accounts, 'run_account', run_account):
+        codes = accounts.run_accounts(accs, 2, 1)
+    assert codes == [('u0', 0), ('u1', 0), ('u2', 0), ('u3', 11),
+                     ('u4', 0), ('u5', 0)]
+    assert running[1] <= 2
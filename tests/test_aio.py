@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_aio.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Tests for aio.py."""
+
+import asyncio
+import imaplib
+import os
+import sys
+try:
+    import pytest
+except ImportError:
+    pass
+from unittest import mock
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import aio       # noqa: E402
+from isbg import imaputils  # noqa: E402
+from isbg import isbg      # noqa: E402
+from isbg import spamproc  # noqa: E402
+from isbg.imaputils import new_message  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(__file__))
+from test_spamproc import (fake_mails, fake_test_mail,  # noqa: E402
+                           new_isbg)
+
+
+def run(coroutine):
+    """Run a coroutine in a new event loop."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class FakeImapServer(object):
+    """A fake IMAP server answering the commands with canned responses."""
+
+    def __init__(self, responses):
+        """Store the responses, a dict of command: lines."""
+        self.responses = responses
+        self.commands = []
+        self.server = None
+        self.delays = {}  # The seconds to wait before answering a command.
+
+    async def start(self):
+        """Listen in a TCP port of localhost."""
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        """Answer a connection."""
+        writer.write(b'* OK fake server ready\r\n')
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            tag, _, command = line.rstrip(b'\r\n').partition(b' ')
+            if command.endswith(b'}'):
+                size = int(command[command.rindex(b'{') + 1:-1])
+                writer.write(b'+ go ahead\r\n')
+                command += b' ' + await reader.readexactly(size + 2)
+            self.commands.append(command)
+            name = command.split(b' ')[0]
+            if name == b'UID':
+                name += b' ' + command.split(b' ')[1]
+            await asyncio.sleep(self.delays.get(name, 0))
+            writer.write(self.responses.get(name, b''))
+            writer.write(tag + b' OK done\r\n')
+            if name == b'LOGOUT':
+                break
+        writer.close()
+
+
+def test_async_imap4():
+    """Test AsyncImap4 with a fake server."""
+    server = FakeImapServer({
+        b'CAPABILITY': b'* CAPABILITY IMAP4rev1 MOVE UIDPLUS\r\n',
+        b'SELECT': b'* 2 EXISTS\r\n* 0 RECENT\r\n',
+        b'STATUS': b'* STATUS "My Spam" (UIDNEXT 3 MESSAGES 2)\r\n',
+        b'UID SEARCH': b'* SEARCH 1 2\r\n',
+        b'UID FETCH': b'* 1 FETCH (UID 1 BODY[] {17}\r\n'
+                      b'Subject: foo\r\n\r\nb)\r\n'
+                      b'* 2 FETCH (UID 2 BODY[] {5}\r\nboo\r\n)\r\n',
+        b'LOGOUT': b'* BYE see you\r\n'})
+
+    async def session():
+        port = await server.start()
+        imap = aio.AsyncImap4('127.0.0.1', port, nossl=True)
+        await imap.connect()
+        assert imap.has_capability('move')
+        assert not imap.has_capability('CONDSTORE')
+        assert await imap.login('user', 'pass"word') == ('OK', [None])
+        assert await imap.select('INBOX') == ('OK', ['2'])
+        assert await imap.get_status('My Spam', ['UIDNEXT', 'MESSAGES']) == \
+            {'UIDNEXT': 3, 'MESSAGES': 2}
+        assert await imap.uid('SEARCH', None, 'ALL') == ('OK', ['1 2'])
+        messages = await aio.fetch_messages(imap, ['1', '2'])
+        assert [uid for uid, _ in messages] == ['1', '2']
+        assert messages[0][1]['Subject'] == 'foo'
+        res = await imap.append('My Spam', None, None, b'Subject: spam\r\n')
+        assert res[0] == 'OK'
+        await imap.logout()
+        server.server.close()
+
+    run(session())
+    assert server.commands == [
+        b'CAPABILITY', b'LOGIN "user" "pass\\"word"', b'CAPABILITY',
+        b'SELECT INBOX', b'STATUS "My Spam" (UIDNEXT MESSAGES)',
+        b'UID SEARCH ALL', b'UID FETCH 1:2 (BODY.PEEK[])',
+        b'APPEND "My Spam" {15} Subject: spam\r\n\r\n', b'LOGOUT']
+
+
+def test_pipeline_stop():
+    """Test the connection is usable after the pipeline stops early."""
+    server = FakeImapServer({
+        b'UID FETCH': b'* 1 FETCH (UID 1 BODY[] {17}\r\n'
+                      b'Subject: foo\r\n\r\nb)\r\n'})
+    server.delays[b'UID FETCH'] = 0.05
+
+    async def session():
+        port = await server.start()
+        imap = aio.AsyncImap4('127.0.0.1', port, nossl=True)
+        await imap.connect()
+        sa = aio.AsyncSpamAssassin(imap=imap)
+        sa.batch_size = 1
+        acted = []
+
+        async def classify(message):
+            return message[0]
+
+        async def act(res):
+            acted.append(res)
+            return False
+
+        # It stops while the second batch is being fetched:
+        await sa._pipeline(['1', '2'], classify, 1, act)
+        assert acted == ['1']
+        assert await imap.noop() == ('OK', [None])
+
+        # A cancelled command closes the connection:
+        fetching = asyncio.ensure_future(imap.uid('FETCH', '1',
+                                                  '(BODY.PEEK[])'))
+        await asyncio.sleep(0.01)
+        fetching.cancel()
+        with pytest.raises(imaplib.IMAP4.abort):
+            await imap.noop()
+        server.server.close()
+
+    run(session())
+    assert server.commands[-2:] == [b'NOOP', b'UID FETCH 1 (BODY.PEEK[])']
+
+
+def test_async_spamd_client():
+    """Test AsyncSpamdClient with a fake spamd."""
+    requests = []
+    responses = [b'SPAMD/1.1 0 EX_OK\r\nSpam: True ; 15.2 / 5.0\r\n\r\n',
+                 b'SPAMD/1.1 0 EX_OK\r\nDidSet: local\r\n\r\n']
+
+    async def handle(reader, writer):
+        requests.append(await reader.read())
+        writer.write(responses.pop(0))
+        writer.close()
+
+    async def session():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        client = aio.AsyncSpamdClient(port=port)
+        mail = new_message(b'Subject: foo\n\nboo\n')
+        assert await client.test_mail(mail) == ("15.2/5.0\n", 1)
+        assert await client.learn_mail(mail, 'spam') == (5, 0)
+        server.close()
+        # No server:
+        assert await client.test_mail(mail) == ("-9999", None)
+        client.max_size = 5
+        assert await client.learn_mail(mail, 'spam') == (98, 98)
+
+    run(session())
+    assert requests[0].startswith(b'CHECK SPAMC/1.5\r\n')
+    assert b'\r\nMessage-class: spam\r\nSet: local\r\n' in requests[1]
+
+
+class AsyncFakeImap(object):
+    """A `FakeImap` with coroutines, as `aio.AsyncImap4`."""
+
+    def __init__(self, fake):
+        """Wrap a FakeImap."""
+        self.fake = fake
+
+    def has_capability(self, name):
+        """Check a capability."""
+        return self.fake.has_capability(name)
+
+    def __getattr__(self, name):
+        """Get a coroutine calling the FakeImap method."""
+        method = getattr(self.fake, name)
+
+        async def coroutine(*args):
+            await asyncio.sleep(0)
+            return method(*args)
+        return coroutine
+
+
+async def async_fake_test_mail(mail):
+    """Score a mail of FakeImap after a while."""
+    await asyncio.sleep(0.001 if '3' in mail['Subject'] else 0)
+    return fake_test_mail(mail)
+
+
+class TestAsyncSpamAssassin(object):
+    """Tests for AsyncSpamAssassin."""
+
+    @staticmethod
+    def new_isbg():
+        """Get a ISBG with a FakeImap."""
+        return new_isbg({'INBOX': fake_mails(range(1, 121))}, workers=8)
+
+    def test_process_inbox(self):
+        """Test process_inbox gives the same results than the sync one."""
+        sbg = self.new_isbg()
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+        sa._test_mail = fake_test_mail
+        proc = sa.process_inbox([])
+
+        asbg = self.new_isbg()
+        fake = asbg.imap
+        asbg.imap = AsyncFakeImap(fake)
+        asa = aio.AsyncSpamAssassin.create_from_isbg(asbg)
+        assert isinstance(asa, aio.AsyncSpamAssassin)
+        asa._test_mail = async_fake_test_mail
+        aproc = run(asa.process_inbox([]))
+
+        assert (aproc.nummsg, aproc.numspam) == (120, 40)
+        assert aproc.uids == proc.uids
+        assert aproc.highwater == proc.highwater == 120
+        assert fake.commands == sbg.imap.commands
+        assert aproc.stages['classify'][0] == 120
+
+    def test_process_inbox_stamps(self):
+        """Test process_inbox trusting the X-Spam-Status headers."""
+        sbg = self.new_isbg()
+        for uid in range(1, 61):
+            sbg.imap.folders['INBOX'][uid] = (
+                'X-Spam-Checker-Version: SpamAssassin on mx\n'
+                'X-Spam-Status: No, score=1.0 required=5.0\n' +
+                sbg.imap.folders['INBOX'][uid])
+        sbg.trustspamheaders = 'mx'
+        fake = sbg.imap
+        sbg.imap = AsyncFakeImap(fake)
+        sa = aio.AsyncSpamAssassin.create_from_isbg(sbg)
+        sa._test_mail = async_fake_test_mail
+        proc = run(sa.process_inbox([]))
+        assert (proc.nummsg, proc.numspam, proc.stamped) == (120, 20, 60)
+        assert [args[0] for args in fake.fetches] == [
+            '1:120', '71:120', '61:70']
+
+    def test_verdict_index(self, tmpdir):
+        """Test the remap of the messages after a UIDVALIDITY change."""
+        sbg = aio.AsyncISBG()
+        fake = self.new_isbg().imap
+        fake.folders['INBOX'] = dict(
+            (uid, 'Message-ID: <{}@foo>\n'.format(uid) + mail)
+            for uid, mail in fake.folders['INBOX'].items())
+        fake.folders['INBOX.spam'] = {}
+        sbg.imap = AsyncFakeImap(fake)
+        sbg.noreport, sbg.partialrun, sbg.nostats = (True, None, True)
+        sbg.trackfile = str(tmpdir.join('track'))
+        sbg.verdictindex = True
+        tested = []
+
+        async def test_mail(sa, mail):
+            tested.append(mail['Subject'])
+            return fake_test_mail(mail)
+
+        with mock.patch.object(aio.AsyncSpamAssassin, '_test_mail',
+                               test_mail):
+            proc = run(sbg.do_spamassassin())
+            assert (proc.nummsg, len(proc.index)) == (120, 120)
+
+            fake.folders['INBOX'] = dict(
+                (uid + 1000, mail)
+                for uid, mail in fake.folders['INBOX'].items() if uid > 20)
+            fake.folders['INBOX'][2000] = \
+                'Message-ID: <2000@foo>\nSubject: spam 2000\n\nfoo\n'
+            fake.uidvalidity, tested[:] = (2, [])
+            proc = run(sbg.do_spamassassin())
+        assert tested == ['spam 2000']
+        assert len(sbg.index_read(2)) == 101
+        assert 1021 in sbg.pastuid_read(2)
+
+    def test_learn(self):
+        """Test learn."""
+        sbg = self.new_isbg()
+        sbg.learnthenflag = True
+        sbg.imap = AsyncFakeImap(sbg.imap)
+        sa = aio.AsyncSpamAssassin.create_from_isbg(sbg)
+
+        async def learn_mail(mail, learn_type):
+            return (6, 0) if mail['Subject'].endswith(' 1') else (5, 0)
+
+        sa._learn_mail = learn_mail
+        learn = run(sa.learn('INBOX', 'spam', None, imaputils.UidSet([2])))
+        assert learn.tolearn == 119
+        assert learn.learned == 118
+        assert learn.newpastuids == [2]
+        assert sbg.imap.fake.commands == [
+            ('STORE', '1,3:120', '+FLAGS.SILENT', '(\\Flagged)')]
+
+        async def misconfigured(mail, learn_type):
+            return 69, 69
+
+        sa._learn_mail = misconfigured
+        with pytest.raises(isbg.ISBGError, match="misconfigured"):
+            run(sa.learn('INBOX', 'spam', None, []))
+
+    def test_sa_semaphore(self):
+        """Test the calls to SpamAssassin hold sa_semaphore."""
+        sa = aio.AsyncSpamAssassin.create_from_isbg(self.new_isbg())
+
+        async def check():
+            sa.sa_semaphore = asyncio.BoundedSemaphore(1)
+
+            async def run_blocking(func, *args):
+                assert sa.sa_semaphore.locked()
+                return ('0/10', 0)
+
+            sa._run = run_blocking
+            assert await sa._test_mail('mail') == ('0/10', 0)
+            assert not sa.sa_semaphore.locked(), "It should be released."
+
+        run(check())
+
+    def test_process_spam(self):
+        """Test _process_spam leaves alone the spams not appended."""
+        sbg = self.new_isbg()
+        sbg.noreport = False
+        sbg.imap = AsyncFakeImap(sbg.imap)
+        sa = aio.AsyncSpamAssassin.create_from_isbg(sbg)
+
+        async def feed_mail(mail):
+            return u"-9999", 1
+
+        sa._feed_mail = feed_mail
+        spamdeletelist = ['1']
+        mail = new_message('Subject: spam 1\n\nfoo\n')
+        assert not run(sa._process_spam('1', '10/5', mail, spamdeletelist))
+        assert spamdeletelist == []
+
+
+def test_run_accounts():
+    """Test run_accounts."""
+    codes = run(aio.run_accounts([('u1', ['--foo']), ('u2', ['--bar'])], 2))
+    assert [name for name, _ in codes] == ['u1', 'u2']
+    assert all(code != 0 for _, code in codes)
+
+    semaphores = []
+
+    async def run_account(name, argv, semaphore, sa_semaphore):
+        semaphores.append(sa_semaphore)
+        return 0
+
+    with mock.patch.object(aio, 'run_account', run_account):
+        run(aio.run_accounts([('u1', []), ('u2', [])], 2, 1))
+    assert semaphores[0] is semaphores[1]
+    assert isinstance(semaphores[0], asyncio.BoundedSemaphore)
@@ -29,13 +29,22 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import email
+import imaplib
 import logging
 import os
+import socket
 import sys
+import threading
+import time
+import zlib
 try:
     import pytest
 except ImportError:
     pass
+try:
+    from unittest import mock  # Python 3
+except ImportError:
+    import mock                # Python 2
 
 from socket import gaierror
 
@@ -43,6 +52,7 @@ from socket import gaierror
 sys.path.insert(0, os.path.abspath(os.path.join(
     os.path.dirname(__file__), '..')))
 from isbg import imaputils  # noqa: E402
+from conftest import FakeImap  # noqa: E402
 
 
 def test_mail_content():
@@ -80,12 +90,161 @@ def test_new_message():
     assert isinstance(foo, email.message.Message)
 
 
+def test_raw_message():
+    """Test RawMessage."""
+    raw = b'Subject: foo\r\nX-Foo: \xc3\xb1\r\n\r\nboo\r\n'
+    mail = imaputils.RawMessage(raw)
+    assert mail._message is None
+    assert mail.size == len(raw)
+    assert mail.as_bytes() is raw
+    assert imaputils.mail_content(mail) is raw
+    assert mail._message is None, "The message has not been parsed."
+    assert mail['Subject'] == 'foo'
+    assert 'X-Foo' in mail
+    assert isinstance(mail.message, email.message.Message)
+    assert mail.get_payload() == 'boo\r\n'
+    assert u'\xf1' in mail.as_string()
+    assert imaputils.RawMessage('Subject: foo\n\n').raw == \
+        b'Subject: foo\n\n'
+    with pytest.raises(TypeError, match="cannot be empty"):
+        imaputils.RawMessage(b"\r\n")
+
+
 def test_get_message():
     """Test get_message."""
     # FIXME:
     pass
 
 
+def test_uid_sequence_set():
+    """Test uid_sequence_set."""
+    assert imaputils.uid_sequence_set([]) == ''
+    assert imaputils.uid_sequence_set(['7']) == '7'
+    assert imaputils.uid_sequence_set(
+        [110, '101', 102, 105, 106, 107, 106]) == '101:102,105:107,110'
+
+
+def test_uid_sequence_sets():
+    """Test uid_sequence_sets."""
+    uids = [1, 2, 3, 5, 7, 8]
+    assert list(imaputils.uid_sequence_sets(uids)) == ['1:3,5,7:8']
+    assert list(imaputils.uid_sequence_sets(uids, 6)) == ['1:3,5', '7:8']
+    assert list(imaputils.uid_sequence_sets(uids, 1)) == ['1:3', '5', '7:8']
+    assert list(imaputils.uid_sequence_sets([])) == []
+
+
+def test_uid_commands():
+    """Test UidCommands."""
+    imap = mock.Mock()
+    actions = imaputils.UidCommands(imap, maxlen=8)
+    actions.add("STORE", [12, 13, 14], "+FLAGS.SILENT", "(\\Seen)")
+    actions.add("COPY", ['55'], "Spam")
+    actions.add("STORE", [15, 20, 30], "+FLAGS.SILENT", "(\\Seen)")
+    actions.add("STORE", [16], "+FLAGS.SILENT", "(\\Deleted)")
+    assert len(actions) == 3
+    actions.flush()
+    assert len(actions) == 0
+    assert imap.uid.call_args_list == [
+        mock.call("STORE", "12:15,20", "+FLAGS.SILENT", "(\\Seen)"),
+        mock.call("STORE", "30", "+FLAGS.SILENT", "(\\Seen)"),
+        mock.call("COPY", "55", "Spam"),
+        mock.call("STORE", "16", "+FLAGS.SILENT", "(\\Deleted)")]
+    actions.flush()
+    assert imap.uid.call_count == 4
+
+
+class TestUidSet(object):
+    """Test object UidSet."""
+
+    def test(self):
+        """Test the object."""
+        uidset = imaputils.UidSet(['7', 3, 1, 2, 2])
+        assert uidset.ranges == [[1, 3], [7, 7]]
+        assert len(uidset) == 4
+        assert list(uidset) == [1, 2, 3, 7]
+        assert 2 in uidset and '7' in uidset
+        assert 0 not in uidset and 4 not in uidset and 8 not in uidset
+        uidset.update([4, 5, 9])
+        assert uidset.ranges == [[1, 5], [7, 7], [9, 9]]
+        uidset.add(8)
+        assert uidset.sequence_set() == '1:5,7:9'
+        uidset.update(imaputils.UidSet.from_ranges([[20, 30], [6, 6]]))
+        assert uidset.ranges == [[1, 9], [20, 30]]
+        assert uidset == imaputils.UidSet.from_ranges([[1, 9], [20, 30]])
+        assert uidset != imaputils.UidSet()
+        assert len(imaputils.UidSet()) == 0
+        assert 1 not in imaputils.UidSet()
+        assert uidset.upto(25).ranges == [[1, 9], [20, 25]]
+        assert uidset.upto(10).ranges == [[1, 9]]
+        assert uidset.upto(0).ranges == []
+
+
+def test_parse_fetch():
+    """Test parse_fetch."""
+    data = [(b'1 (UID 101 RFC822.SIZE 5 BODY[] {5}', b'Foo: '),
+            b')',
+            b'2 (UID 102 FLAGS (\\Seen))',
+            (b'3 (BODY[HEADER.FIELDS (MESSAGE-ID)] {4}', b'Boo:'),
+            b' UID 103)']
+    res = dict(imaputils.parse_fetch(data))
+    assert sorted(res) == [101, 102, 103]
+    assert res[101]['BODY[]'] == b'Foo: '
+    assert res[101]['RFC822.SIZE'] == '5'
+    assert res[102]['FLAGS'] == '(\\Seen)'
+    assert res[103]['BODY[HEADER.FIELDS (MESSAGE-ID)]'] == b'Boo:'
+
+
+def test_fetched_fingerprints():
+    """Test fetched_fingerprints."""
+    res = ('OK', [
+        (b'1 (UID 101 RFC822.SIZE 50 BODY[HEADER.FIELDS (MESSAGE-ID DATE '
+         b'FROM)] {18}', b'Message-ID: <a>\r\n\r\n'), b')',
+        (b'2 (UID 102 RFC822.SIZE 51 BODY[HEADER.FIELDS (MESSAGE-ID DATE '
+         b'FROM)] {17}', b'message-id: <a>\n\n'), b')',
+        (b'3 (UID 103 RFC822.SIZE 50 BODY[HEADER.FIELDS (MESSAGE-ID DATE '
+         b'FROM)] {2}', b'\r\n'), b')'])
+    fingerprints = imaputils.fetched_fingerprints(res)
+    assert sorted(fingerprints) == [101, 102, 103]
+    assert fingerprints[101] != fingerprints[102], "Different sizes."
+    assert fingerprints[103] is None
+    res[1][2] = (res[1][2][0].replace(b'51', b'50'), res[1][2][1])
+    assert imaputils.fetched_fingerprints(res)[102] == fingerprints[101]
+    assert imaputils.fetched_fingerprints(('NO', [None])) == {}
+
+
+def test_message_keys():
+    """Test message_key and fetched_message_keys."""
+    raw = b'Subject: foo\r\nMessage-Id:  <a@b>\r\n\r\nMessage-ID: <c@d>\r\n'
+    assert imaputils.message_key(imaputils.RawMessage(raw)) == '<a@b> 55'
+    assert imaputils.message_key(
+        imaputils.RawMessage(b'Subject: foo\n\nMessage-ID: <c@d>\n')) is None
+    res = ('OK', [
+        (b'1 (UID 101 RFC822.SIZE 55 BODY[HEADER.FIELDS (MESSAGE-ID)] {21}',
+         b'Message-ID: <a@b>\r\n\r\n'), b')',
+        (b'2 (UID 102 RFC822.SIZE 50 BODY[HEADER.FIELDS (MESSAGE-ID)] {2}',
+         b'\r\n'), b')'])
+    assert imaputils.fetched_message_keys(res) == {101: '<a@b> 55',
+                                                   102: None}
+    assert imaputils.fetched_message_keys(('NO', [None])) == {}
+
+
+def test_get_messages():
+    """Test get_messages."""
+    imap = FakeImap({'INBOX': {101: 'Subject: 101', 102: 'Subject: 102',
+                               105: 'Subject: 105'}})
+    imap.select()
+    res = list(imaputils.get_messages(imap, ['105', '102', '101', '104'],
+                                      batch_size=3,
+                                      logger=logging.getLogger(__name__)))
+    assert [uid for uid, _ in res] == ['105', '102', '101', '104']
+    assert res[0][1]['Subject'] == '105'
+    assert res[2][1]['Subject'] == '101'
+    assert res[3][1]['Subject'] is None, "104 does not exist."
+    assert isinstance(res[0][1], imaputils.RawMessage)
+    assert imap.fetches == [('101:102,105', '(BODY.PEEK[])'),
+                            ('104', '(BODY.PEEK[])')]
+
+
 def test_imapflags():
     """Test imapflags."""
     assert imaputils.imapflags(['foo', 'boo']) == '(foo,boo)'
@@ -101,6 +260,131 @@ class TestIsbgImap4(object):
             imaputils.IsbgImap4()
         # FIXME: require network
 
+    def test_get_status(self):
+        """Test get_status and has_capability without network."""
+        imap = imaputils.IsbgImap4.__new__(imaputils.IsbgImap4)
+        imap.assertok, imap.lock = (None, threading.RLock())
+        imap._capabilities = None
+        imap.imap = mock.Mock()
+        imap.imap.status.return_value = (
+            'OK', [b'"INBOX 2" (UIDNEXT 44 HIGHESTMODSEQ 7011231777)'])
+        imap.imap.capability.return_value = (
+            'OK', [b'IMAP4rev1 condstore MOVE'])
+        assert imap.get_status('INBOX 2', ['UIDNEXT', 'HIGHESTMODSEQ']) == {
+            'UIDNEXT': 44, 'HIGHESTMODSEQ': 7011231777}
+        imap.imap.status.assert_called_with('INBOX 2',
+                                            '(UIDNEXT HIGHESTMODSEQ)')
+        imap.imap.status.return_value = ('NO', [b'Unknown mailbox'])
+        assert imap.get_status('Foo', ['UIDNEXT']) == {}
+        assert imap.has_capability('CONDSTORE')
+        assert imap.has_capability('move')
+        assert not imap.has_capability('QRESYNC')
+        assert imap.imap.capability.call_count == 1
+
+
+def test_compress():
+    """Test IsbgImap4.compress with a socket pair."""
+    client, server = socket.socketpair()
+    imap = imaputils.IsbgImap4.__new__(imaputils.IsbgImap4)
+    imap.assertok, imap.lock = (None, threading.RLock())
+    imap._capabilities = set(['IMAP4REV1'])
+    imap.imap = mock.Mock(spec=['sock', 'file', 'read', 'readline', 'send',
+                                '_simple_command'])
+    imap.imap.sock = client
+    imap.imap._simple_command.return_value = ('OK', [b'DEFLATE active'])
+    assert not imap.compress(), "COMPRESS=DEFLATE not supported."
+    imap._capabilities.add('COMPRESS=DEFLATE')
+    assert imap.compress()
+    imap.imap._simple_command.assert_called_once_with('COMPRESS', 'DEFLATE')
+
+    # Client -> server:
+    imap.imap.send(b'a001 UID FETCH 1 (BODY.PEEK[])\r\n')
+    decompressor = zlib.decompressobj(-15)
+    assert decompressor.decompress(server.recv(4096)) == \
+        b'a001 UID FETCH 1 (BODY.PEEK[])\r\n'
+
+    # Server -> client:
+    body = b'Subject: foo\r\n\r\n' + b'boo ' * 10000
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                  zlib.DEFLATED, -15)
+    data = b'* 1 FETCH (UID 1 BODY[] {' + str(len(body)).encode() + \
+        b'}\r\n' + body + b')\r\na001 OK done\r\n'
+    server.sendall(compressor.compress(data) +
+                   compressor.flush(zlib.Z_SYNC_FLUSH))
+    assert imap.imap.readline() == b'* 1 FETCH (UID 1 BODY[] {40016}\r\n'
+    assert imap.imap.read(len(body)) == body
+    assert imap.imap.readline() == b')\r\n'
+    assert imap.imap.readline() == b'a001 OK done\r\n'
+    client.close()
+    server.close()
+
+
+def test_idle():
+    """Test IsbgImap4.idle with a socket pair."""
+    client, server = socket.socketpair()
+    imap = imaputils.IsbgImap4.__new__(imaputils.IsbgImap4)
+    imap.assertok, imap.lock = (None, threading.RLock())
+    imap.imap = mock.Mock(spec=['sock', 'file', 'send', 'readline',
+                                '_new_tag', 'tagged_commands'])
+    imap.imap.sock = client
+    imap.imap.file = client.makefile('rb')
+    imap.imap.send = client.sendall
+    imap.imap.readline = lambda: imap.imap.file.readline()
+    imap.imap._new_tag.return_value = b'A001'
+    imap.imap.tagged_commands = {}
+
+    def serve(untagged, buffered=False):
+        """Answer to IDLE, sending the untagged responses, and DONE."""
+        requests = [server.recv(100)]
+        server.sendall(b'+ idling\r\n' + (untagged if buffered else b''))
+        if untagged and not buffered:
+            time.sleep(0.05)
+            server.sendall(untagged)
+        requests.append(server.recv(100))
+        server.sendall(b'A001 OK IDLE terminated\r\n')
+        assert requests == [b'A001 IDLE\r\n', b'DONE\r\n']
+
+    # Timeout without changes:
+    thread = threading.Thread(target=serve, args=(b'',))
+    thread.start()
+    assert imap.idle(0.1) == []
+    thread.join()
+
+    # New messages:
+    thread = threading.Thread(target=serve,
+                              args=(b'* 4 EXISTS\r\n* 1 RECENT\r\n',))
+    thread.start()
+    assert imap.idle(5) == ['* 4 EXISTS', '* 1 RECENT']
+    thread.join()
+
+    # New messages sent with the continuation, already in the buffer:
+    thread = threading.Thread(target=serve, args=(b'* 5 EXISTS\r\n', True))
+    thread.start()
+    start = time.time()
+    assert imap.idle(5) == ['* 5 EXISTS']
+    assert time.time() - start < 1, "Not waiting for the timeout."
+    thread.join()
+
+    # Refused:
+    server.sendall(b'A001 BAD unknown command\r\n')
+    with pytest.raises(imaplib.IMAP4.error, match="unknown command"):
+        imap.idle(5)
+    client.close()
+    server.close()
+
+
+def test_examine():
+    """Test IsbgImap4.examine."""
+    imap = imaputils.IsbgImap4.__new__(imaputils.IsbgImap4)
+    imap.assertok, imap.lock = (None, threading.RLock())
+    imap.imap = mock.Mock()
+    imap.imap.select.return_value = ('OK', [b'3'])
+    imap.imap.response.return_value = ('UIDNEXT', [b'10'])
+    assert imap.examine('INBOX') == {'EXISTS': 3, 'UIDNEXT': 10}
+    imap.imap.select.assert_called_once_with('INBOX', True)
+    imap.imap.response.return_value = ('UIDNEXT', [None])
+    assert imap.examine('INBOX') == {'EXISTS': 3}
+
 
 def test_login_imap():
     """Test login_imap."""
@@ -111,7 +395,7 @@ def test_login_imap():
     imapsets = imaputils.ImapSettings()
     imapsets.host = ''  # don't try to connect to internet
     imapsets.nossl = True
-    with pytest.raises(Exception, match="[Errno -5]",
+    with pytest.raises(imaputils.ImapConnectionError, match="[Errno -5]",
                        message="No address associated with hostname"):
         imaputils.login_imap(imapsets, logger=logging.getLogger(__name__))
     # FIXME: require network
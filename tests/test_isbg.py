@@ -31,17 +31,25 @@ from __future__ import unicode_literals
 # With atexit._run_exitfuncs()  we free the lockfile, but we lost coverage
 # statistics.
 
+import json
 import os
+import socket
 import sys
 try:
     import pytest
 except ImportError:
     pass
+try:
+    from unittest import mock  # Python 3
+except ImportError:
+    import mock                # Python 2
 
 # We add the upper dir to the path
 sys.path.insert(0, os.path.abspath(os.path.join(
     os.path.dirname(__file__), '..')))
+from isbg import imaputils  # noqa: E402
 from isbg import isbg  # noqa: E402
+from isbg import spamproc  # noqa: E402
 
 
 def test_ISBGError():
@@ -79,6 +87,138 @@ class TestISBG(object):
         assert os.path.exists(sbg.lockfilename) is False, \
             "File should not exist."
 
+    def test_pastuid_read_write(self, tmpdir):
+        """Test pastuid_read and pastuid_write."""
+        sbg = isbg.ISBG()
+        sbg.trackfile = str(tmpdir.join('track'))
+        assert len(sbg.pastuid_read(1)) == 0
+
+        # Old format, with the list of uids:
+        with open(sbg.trackfile + 'inbox', 'w') as wfile:
+            json.dump({'uidvalidity': 1, 'uids': [1, 2, 3, 5]}, wfile)
+        pastuids = sbg.pastuid_read(1)
+        assert list(pastuids) == [1, 2, 3, 5]
+        assert len(sbg.pastuid_read(2)) == 0, "uidvalidity has changed."
+
+        sbg.pastuid_write(1, pastuids, [4, '6', 10])
+        with open(sbg.trackfile + 'inbox') as rfile:
+            assert json.load(rfile) == {'uidvalidity': 1,
+                                        'ranges': [[1, 6], [10, 10]]}
+        assert list(sbg.pastuid_read(1)) == [1, 2, 3, 4, 5, 6, 10]
+        assert sbg.highwater_read(1) == 0
+
+        sbg.pastuid_write(1, pastuids, [], highwater=5)
+        assert sbg.highwater_read(1) == 5
+        assert sbg.highwater_read(2) == 0, "uidvalidity has changed."
+        sbg.maxsize = 200000
+        assert sbg.highwater_read(1) == 0, "maxsize is higher."
+
+        assert sbg.modseq_read(1, 'spam') == 0
+        sbg.pastuid_write(1, pastuids, [], 'spam', modseq=1234)
+        assert sbg.modseq_read(1, 'spam') == 1234
+        assert sbg.modseq_read(2, 'spam') == 0, "uidvalidity has changed."
+
+    def test_status_unchanged(self, tmpdir):
+        """Test status_unchanged and the skip of do_spamassassin."""
+        sbg = isbg.ISBG()
+        sbg.trackfile = str(tmpdir.join('track'))
+        status = {'UIDVALIDITY': 1, 'UIDNEXT': 11, 'MESSAGES': 10}
+        assert not sbg.status_unchanged(status)
+        sbg.pastuid_write(1, [1, 2], [], highwater=2, status=status)
+        assert sbg.status_unchanged(status)
+        assert not sbg.status_unchanged(dict(status, UIDNEXT=12))
+        assert not sbg.status_unchanged(dict(status, MESSAGES=9))
+        assert not sbg.status_unchanged(dict(status, UIDVALIDITY=2))
+        assert not sbg.status_unchanged({'UIDVALIDITY': 1})
+        sbg.maxsize = 200000
+        assert not sbg.status_unchanged(status), "maxsize is higher."
+        sbg.maxsize = 120000
+
+        # The inbox is not selected nor searched:
+        sbg.imap = mock.Mock()
+        sbg.imap.get_status.return_value = status
+        proc = sbg.do_spamassassin()
+        assert proc.nummsg == 0
+        sbg.imap.get_status.assert_called_once_with('INBOX',
+                                                    sbg.status_items)
+        assert not sbg.imap.select.called
+        assert not sbg.imap.uid.called
+
+        # The trackfile is read only once:
+        sbg.verdictindex = True
+        sbg.imap.get_status.return_value = dict(status, UIDNEXT=12)
+        with mock.patch.object(isbg.json, 'load',
+                               wraps=json.load) as load, \
+                mock.patch.object(spamproc.SpamAssassin, 'process_inbox',
+                                  return_value=spamproc.Sa_Process()):
+            sbg.do_spamassassin()
+        assert load.call_count == 1
+
+    def test_do_daemon(self):
+        """Test do_daemon."""
+        sbg = isbg.ISBG()
+        sbg.ignorelockfile, sbg.reconnect_delay = (True, 0)
+        sbg.imap = mock.Mock()
+        sbg.imap.has_capability.return_value = True
+        # Two changes, a lost connection and a interruption:
+        sbg.imap.idle.side_effect = [['* 2 EXISTS'], [],
+                                     socket.error("Connection reset"),
+                                     KeyboardInterrupt]
+        imap = sbg.imap
+        with mock.patch.object(sbg, 'do_spamassassin') as do_spamassassin, \
+                mock.patch.object(sbg, 'do_imap_login') as do_imap_login:
+            do_imap_login.side_effect = lambda: setattr(sbg, 'imap', imap)
+            sbg.do_daemon()
+        assert do_spamassassin.call_count == 4
+        assert do_imap_login.call_count == 1
+        sbg.imap.idle.assert_called_with(sbg.idle_timeout)
+        imap.shutdown.assert_called_once_with()  # The lost connection.
+
+        # Messages arrived while processing, no IDLE until it's processed:
+        statuses = [{'UIDNEXT': 3}, {'UIDNEXT': 5}, {'UIDNEXT': 5}]
+        sbg.imap.examine.return_value = {'EXISTS': 4, 'UIDNEXT': 5}
+        sbg.imap.idle.reset_mock()
+        sbg.imap.idle.side_effect = KeyboardInterrupt
+        with mock.patch.object(sbg, 'do_spamassassin') as do_spamassassin:
+            do_spamassassin.side_effect = lambda: setattr(
+                sbg, '_inbox_status', statuses.pop(0)) or \
+                spamproc.Sa_Process()
+            sbg.do_daemon()
+        assert do_spamassassin.call_count == 2
+        assert sbg.imap.idle.call_count == 1
+
+        # A backlog left by partialrun, no IDLE until it's processed:
+        procs = [spamproc.Sa_Process() for _ in range(3)]
+        for uid, proc in enumerate(procs):
+            proc.uids, proc.complete = ([uid], uid == 2)
+        sbg.imap.idle.reset_mock()
+        with mock.patch.object(sbg, 'do_spamassassin',
+                               side_effect=procs) as do_spamassassin:
+            sbg.do_daemon()
+        assert do_spamassassin.call_count == 3
+        assert sbg.imap.idle.call_count == 1
+
+        # The server can't be reached for a while:
+        sbg.reconnect_delay, sbg.max_reconnect_delay = (1, 3)
+        sbg.imap = None
+        with mock.patch.object(sbg, 'do_spamassassin',
+                               side_effect=KeyboardInterrupt), \
+                mock.patch.object(sbg, 'do_imap_login') as do_imap_login, \
+                mock.patch.object(isbg.time, 'sleep') as sleep:
+            do_imap_login.side_effect = [
+                imaputils.ImapConnectionError("unreachable")] * 4 + [None]
+            sbg.do_daemon()
+        assert [args[0][0] for args in sleep.call_args_list] == [1, 2, 3, 3]
+        sbg.imap = imap
+
+        # Without IDLE:
+        sbg.imap.has_capability.return_value = False
+        sbg.imap.noop.side_effect = KeyboardInterrupt
+        sbg.poll_interval = 0
+        with mock.patch.object(sbg, 'do_spamassassin'):
+            sbg.do_daemon()
+        assert sbg.imap.noop.called
+
     def test_do_isbg(self):
         """Test do_isbg."""
         sbg = isbg.ISBG()
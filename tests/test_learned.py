@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_learned.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Tests for learned.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sys
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import learned  # noqa: E402
+
+
+def test_learned_index(tmpdir):
+    """Test LearnedIndex."""
+    filename = str(tmpdir.join('learned'))
+    index = learned.LearnedIndex(filename, 'spamc')
+    assert index.learned('a') is None
+    index.add('a', 'spam')
+    index.add(None, 'spam')
+    assert index.learned('a') == 'spam'
+    assert index.learned(None) is None
+    index.save()
+
+    # Every backend has its own fingerprints:
+    assert learned.LearnedIndex(filename, 'spamc').learned('a') == 'spam'
+    other = learned.LearnedIndex(filename, 'localhost:783')
+    assert other.learned('a') is None
+    other.add('b', 'ham')
+    other.save()
+    assert learned.LearnedIndex(filename, 'spamc').learned('a') == 'spam'
+
+    # The oldest are removed:
+    index = learned.LearnedIndex(filename, 'spamc')
+    index.max_entries = 1
+    index.add('c', 'ham')
+    index.save()
+    index = learned.LearnedIndex(filename, 'spamc')
+    assert (index.learned('a'), index.learned('c')) == (None, 'ham')
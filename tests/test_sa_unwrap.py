@@ -41,6 +41,7 @@ except ImportError:
 # We add the upper dir to the path
 sys.path.insert(0, os.path.abspath(os.path.join(
     os.path.dirname(__file__), '..')))
+from isbg import imaputils  # noqa: E402
 from isbg import sa_unwrap  # noqa: E402
 
 
@@ -108,6 +109,29 @@ def test_unwrap():
     """ Test a email.message.Message."""
     assert sa_unwrap.unwrap(email.message.Message()) is None
 
+    """Test the raw mails."""
+    with open('examples/spam.from.spamassassin.eml', 'rb') as f:
+        ftext = f.read()
+    assert len(sa_unwrap.unwrap(ftext)) == 1
+    assert len(sa_unwrap.unwrap(ftext.decode('utf-8', 'replace'))) == 1
+    mail = imaputils.RawMessage(ftext)
+    assert len(sa_unwrap.unwrap(mail)) == 1
+    assert sa_unwrap.unwrap(b'Subject: foo\n\nfoo\n') is None
+    mail = imaputils.RawMessage(b'Subject: foo\n\nfoo\n')
+    assert sa_unwrap.unwrap(mail) is None
+    assert mail._message is None, "Not parsed"
+
+
+def test_maybe_wrapped():
+    """Test maybe_wrapped."""
+    with open('examples/spam.from.spamassassin.eml', 'rb') as f:
+        assert sa_unwrap.maybe_wrapped(f.read())
+    with open('examples/spam.eml', 'rb') as f:
+        assert not sa_unwrap.maybe_wrapped(f.read())
+    assert sa_unwrap.maybe_wrapped('Content-Type: message/rfc822; '
+                                   'X-Spam-Type=original')
+    assert not sa_unwrap.maybe_wrapped('')
+
 
 def test_isbg_sa_unwrap(capsys):
     """Test no multipart spam mail."""
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_spamd.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Tests for spamd.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import socket
+import sys
+import threading
+try:
+    import pytest
+except ImportError:
+    pass
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import spamd  # noqa: E402
+from isbg.imaputils import new_message  # noqa: E402
+
+
+class FakeSpamd(object):
+    """A fake spamd answering the requests with canned responses."""
+
+    def __init__(self, responses):
+        """Listen in a TCP port of localhost."""
+        self.responses = list(responses)
+        self.requests = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        """Answer a request for every response."""
+        for response in self.responses:
+            conn, _ = self.sock.accept()
+            data = b''
+            while True:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            self.requests.append(data)
+            conn.sendall(response)
+            conn.close()
+        self.sock.close()
+
+
+def test_spamd_response():
+    """Test SpamdResponse."""
+    res = spamd.SpamdResponse.parse(
+        b'SPAMD/1.1 0 EX_OK\r\nSpam: True ; 15.2 / 5.0\r\n\r\n')
+    assert res.code == 0
+    assert res.message == 'EX_OK'
+    assert res.spam == (True, '15.2', '5.0')
+    assert res.body == b''
+
+    res = spamd.SpamdResponse.parse(
+        b'SPAMD/1.1 0 EX_OK\r\nSpam: False ; -1 / 5.0\r\n\r\nFoo\r\n\r\nBoo')
+    assert res.spam == (False, '-1', '5.0')
+    assert res.body == b'Foo\r\n\r\nBoo'
+
+    with pytest.raises(spamd.SpamdError, match="Bad response"):
+        spamd.SpamdResponse.parse(b'HTTP/1.1 200 OK\r\n\r\n')
+
+
+def test_from_address():
+    """Test SpamdClient.from_address."""
+    client = spamd.SpamdClient.from_address('/run/spamd.sock')
+    assert client.socket_path == '/run/spamd.sock'
+    client = spamd.SpamdClient.from_address('spamd.example.org')
+    assert (client.host, client.port) == ('spamd.example.org', 783)
+    client = spamd.SpamdClient.from_address('127.0.0.1:1783')
+    assert (client.host, client.port) == ('127.0.0.1', 1783)
+    client = spamd.SpamdClient.from_address('[::1]:1783')
+    assert (client.host, client.port) == ('::1', 1783)
+
+
+def test_spamd_client():
+    """Test SpamdClient with a fake spamd."""
+    mail = new_message(b'Subject: foo\n\nboo\n')
+    server = FakeSpamd([
+        b'SPAMD/1.1 0 EX_OK\r\nSpam: True ; 15.2 / 5.0\r\n\r\n',
+        b'SPAMD/1.1 0 EX_OK\r\nSpam: True ; 15.2 / 5.0\r\n'
+        b'Content-length: 9\r\n\r\nSpam: Yes',
+        b'SPAMD/1.1 0 EX_OK\r\nSpam: False ; 1.0 / 5.0\r\n'
+        b'Content-length: 8\r\n\r\nSpam: No',
+        b'SPAMD/1.1 0 EX_OK\r\nDidSet: local\r\n\r\n',
+        b'SPAMD/1.1 0 EX_OK\r\n\r\n',
+        b'SPAMD/1.0 69 EX_UNAVAILABLE TELL commands are not enabled\r\n'])
+    client = spamd.SpamdClient(port=server.port, user='isbg')
+
+    assert client.test_mail(mail) == ("15.2/5.0\n", 1)
+    assert client.feed_mail(mail) == (b'Spam: Yes', 0)
+    assert client.process_mail(mail) == ("1.0/5.0\n", b'Spam: No', 0)
+    assert client.learn_mail(mail, 'spam') == (5, 0)
+    assert client.learn_mail(mail, 'ham') == (6, 0)
+    assert client.learn_mail(mail, 'forget') == (69, 69)
+    server.thread.join(5)
+
+    assert server.requests[0].startswith(
+        b'CHECK SPAMC/1.5\r\nContent-length: 18\r\nUser: isbg\r\n\r\n')
+    assert server.requests[0].endswith(b'\n\nboo\n')
+    assert server.requests[1].startswith(b'PROCESS SPAMC/1.5\r\n')
+    assert server.requests[2].startswith(b'PROCESS SPAMC/1.5\r\n')
+    assert b'\r\nMessage-class: spam\r\nSet: local\r\n' in server.requests[3]
+    assert b'\r\nMessage-class: ham\r\nSet: local\r\n' in server.requests[4]
+    assert b'\r\nRemove: local\r\n' in server.requests[5]
+
+    # Too big:
+    client.max_size = 5
+    assert client.learn_mail(mail, 'spam') == (98, 98)
+    assert client.test_mail(mail) == ("-9999", 98)
+
+    # No server:
+    client = spamd.SpamdClient(port=server.port)
+    assert client.test_mail(mail) == ("-9999", None)
+    assert client.learn_mail(mail, 'spam') == (-9999, None)
@@ -30,10 +30,16 @@ from __future__ import unicode_literals
 
 import os
 import sys
+import threading
+import time
 try:
     import pytest
 except ImportError:
     pass
+try:
+    from unittest import mock  # Python 3
+except ImportError:
+    import mock                # Python 2
 
 from email.errors import MessageError
 
@@ -42,7 +48,11 @@ sys.path.insert(0, os.path.abspath(os.path.join(
     os.path.dirname(__file__), '..')))
 from isbg import spamproc   # noqa: E402
 from isbg import isbg       # noqa: E402
+from isbg import imaputils  # noqa: E402
+from isbg import learned    # noqa: E402
+from isbg import verdicts   # noqa: E402
 from isbg.imaputils import new_message  # noqa: E402
+from conftest import FakeImap  # noqa: E402
 
 # To check if a cmd exists:
 
@@ -53,6 +63,138 @@ def cmd_exists(x):
                for path in os.environ["PATH"].split(os.pathsep))
 
 
+def fake_test_mail(mail):
+    """Score a mail of FakeImap."""
+    if 'spam' in mail['Subject']:
+        return "6.0/5.0\n", 1
+    return "1.0/5.0\n", 0
+
+
+def fake_mails(uids, spams=None, fmt='Subject: {0} {1}\n\nfoo\n'):
+    """Get the messages of a FakeImap folder.
+
+    The message of every uid is `fmt` formatted with ``spam`` (if the uid is
+    in `spams`, by default the multiples of 3) or ``ham``, and the uid.
+    """
+    return dict((uid, fmt.format(
+        'spam' if (uid % 3 == 0 if spams is None else uid in spams)
+        else 'ham', uid)) for uid in uids)
+
+
+def new_isbg(folders, **attrs):
+    """Get a ISBG with a FakeImap of `folders`, and `attrs` set.
+
+    By default, all the messages are processed and the spams are flagged and
+    copied without report.
+    """
+    sbg = isbg.ISBG()
+    sbg.imap = FakeImap(folders)
+    sbg.noreport, sbg.partialrun = (True, None)
+    sbg.spamflags = ['\\Flagged']
+    for name, value in attrs.items():
+        setattr(sbg, name, value)
+    return sbg
+
+
+def new_sa(folders, **attrs):
+    """Get a SpamAssassin of `new_isbg`, testing with `fake_test_mail`."""
+    sa = spamproc.SpamAssassin.create_from_isbg(new_isbg(folders, **attrs))
+    sa._test_mail = fake_test_mail
+    return sa
+
+
+def test_ordered_map():
+    """Test ordered_map."""
+    items = list(range(50))
+    for workers in [None, 1, 4]:
+        res = list(spamproc.ordered_map(lambda x: x * 2, items, workers))
+        assert res == [x * 2 for x in items]
+
+
+def test_bounded_queue():
+    """Test BoundedQueue."""
+    queue = spamproc.BoundedQueue(3, maxbytes=10)
+    assert queue.put('a', 8)
+    assert queue._full(3), "It should be full of bytes."
+    assert not queue._full(2)
+    assert queue.put('b', 2)
+    assert queue.get() == 'a'
+    assert queue.get() == 'b'
+    assert queue.put('c', 20), "A big item fits in an empty queue."
+    queue.close()
+    assert queue.get() == 'c'
+    assert queue.get() is spamproc.BoundedQueue.DONE
+    queue.abort()
+    assert not queue.put('d')
+
+
+def test_pipeline():
+    """Test pipeline."""
+    stages = {}
+
+    def hook(stage, seconds):
+        stages[stage] = stages.get(stage, 0) + 1
+
+    for workers in [1, 4]:
+        stages.clear()
+        res = list(spamproc.pipeline(range(100), lambda x: x * 2, workers,
+                                     maxitems=5, maxbytes=20,
+                                     size=lambda x: 4, hook=hook))
+        assert res == [x * 2 for x in range(100)]
+        assert stages == {'fetch': 100, 'classify': 100, 'act': 100}
+
+    # Errors are raised in order:
+    def fail(x):
+        if x == 7:
+            raise ValueError("seven")
+        return x
+
+    res = []
+    with pytest.raises(ValueError, match="seven"):
+        for x in spamproc.pipeline(range(100), fail, 4, maxitems=5):
+            res.append(x)
+    assert res == list(range(7))
+
+    # The errors of the source too:
+    def source():
+        for x in range(10, 30, 10):
+            yield x
+        raise ValueError("source")
+
+    res = []
+    with pytest.raises(ValueError, match="source"):
+        for x in spamproc.pipeline(source(), lambda x: x, 4, maxitems=5):
+            res.append(x)
+    assert res == [10, 20]
+
+    # The caller can stop it:
+    for x in spamproc.pipeline(range(100), fail, 4, maxitems=5):
+        if x == 3:
+            break
+
+
+def test_pipeline_slow_item():
+    """Test pipeline does not get ahead of a slow item."""
+    # The max items in flight, by items or by bytes:
+    for maxitems, maxbytes, limit in [(5, None, 5), (50, 30, 3)]:
+        fetched = []
+
+        def source():
+            for x in range(100):
+                fetched.append(x)
+                yield x
+
+        def slow(x):
+            if x == 0:
+                time.sleep(0.2)
+            return x
+
+        for x in spamproc.pipeline(source(), slow, 4, maxitems=maxitems,
+                                   maxbytes=maxbytes, size=lambda x: 10):
+            # The items fetched are in flight, plus the one being fetched:
+            assert len(fetched) - x <= limit + 1
+
+
 def test_learn_mail():
     """Tests for learn_mail."""
     fmail = open('examples/spam.eml', 'rb')
@@ -209,7 +351,10 @@ class Test_SpamAssassin(object):
     _kwargs = ['imap', 'spamc', 'logger', 'partialrun', 'dryrun',
                'learnthendestroy', 'gmail', 'learnthenflag', 'learnunflagged',
                'learnflagged', 'deletehigherthan', 'imapsets', 'maxsize',
-               'noreport', 'spamflags', 'delete', 'expunge']
+               'noreport', 'spamflags', 'delete', 'expunge', 'spamd',
+               'singlepass', 'workers', 'learnworkers', 'sa_semaphore',
+               'verdicts', 'verdictttl', 'fingerprints', 'trustspamheaders',
+               'spamheadersmaxage', 'scankeyword', 'verdictindex']
 
     def test__kwars(self):
         """Test _kwargs is up to date."""
@@ -239,6 +384,13 @@ class Test_SpamAssassin(object):
         sa.spamc = False
         assert sa.cmd_save == ['spamassassin']
 
+    def test_cmd_process(self):
+        """Test cmd_process."""
+        sa = spamproc.SpamAssassin()
+        assert sa.cmd_process == ["spamassassin", "--exit-code"]
+        sa.spamc = True
+        assert sa.cmd_process == ["spamc", "-E"]
+
     def test_cmd_test(self):
         """Test cmd_test."""
         sa = spamproc.SpamAssassin()
@@ -266,6 +418,23 @@ class Test_SpamAssassin(object):
                            message="Should rise error."):
             sa.learn('Spam', 'ham', None, [])
 
+    def test_sa_semaphore(self):
+        """Test the calls to SpamAssassin hold sa_semaphore."""
+        sa = spamproc.SpamAssassin()
+        sa.sa_semaphore = threading.BoundedSemaphore(1)
+
+        class FakeClient(object):
+            """A spamd client checking the semaphore is held."""
+
+            def test_mail(self, mail):
+                """Test a mail."""
+                assert not sa.sa_semaphore.acquire(False)
+                return (u'1/5', 0)
+
+        sa._spamd_client = FakeClient()
+        assert sa._test_mail('foo') == (u'1/5', 0)
+        assert sa.sa_semaphore.acquire(False), "It should be released."
+
     def test_get_formated_uids(self):
         """Test get_formated_uids."""
         sbg = isbg.ISBG()
@@ -318,3 +487,306 @@ class Test_SpamAssassin(object):
         with pytest.raises(AttributeError, match="has no attribute",
                            message="Should rise error, IMAP not created."):
             sa.process_inbox([])
+
+    def test_process_inbox_workers(self):
+        """Test process_inbox with workers gives the same results."""
+        results = []
+        for workers in [1, 4]:
+            sa = new_sa({'INBOX': fake_mails(range(1, 31))}, workers=workers)
+            proc = sa.process_inbox([])
+            assert proc.nummsg == 30
+            assert proc.numspam == 10
+            results.append((proc.uids, sa.imap.commands))
+        assert results[0] == results[1]
+
+    def test_process_inbox_highwater(self):
+        """Test process_inbox with a high-water mark."""
+        sa = new_sa({'INBOX': fake_mails(range(1, 11), [])}, partialrun=4)
+
+        # The newest are processed first, so the mark can't move:
+        proc = sa.process_inbox(imaputils.UidSet([1, 2, 3]))
+        assert proc.uids == [10, 9, 8, 7]
+        assert proc.highwater == 3
+        assert sa.imap.searches[-1] == (None, 'SMALLER', '120000')
+
+        proc = sa.process_inbox(imaputils.UidSet([1, 2, 3, 7, 8, 9, 10]), 3)
+        assert proc.uids == [6, 5, 4]
+        assert proc.highwater == 10
+        assert proc.newpastuids == imaputils.UidSet.from_ranges([[1, 3],
+                                                                 [7, 10]])
+        assert sa.imap.searches[-1] == (None, 'UID', '4:*', 'SMALLER',
+                                        '120000')
+
+        # Nothing new, the last message is filtered:
+        proc = sa.process_inbox(imaputils.UidSet.from_ranges([[1, 10]]), 10)
+        assert proc.uids == []
+        assert proc.highwater == 10
+        assert proc.newpastuids == imaputils.UidSet.from_ranges([[1, 10]])
+
+    def test_process_inbox_verdicts(self, tmpdir):
+        """Test process_inbox with a verdict cache."""
+        cache = verdicts.VerdictCache(str(tmpdir.join('verdicts')))
+        for account in [1, 2]:
+            sa = new_sa({'INBOX': dict(
+                (uid, 'Message-ID: <{3}@foo>\nSubject: {0} {1}\nTo: user{2}'
+                      '\n\nfoo {3}\n{4}\n'.format(
+                          'spam' if uid % 3 == 0 else 'ham', uid, account,
+                          uid if account == 1 or uid > 3 else -uid,
+                          'long enough to be cached ' * 3))
+                for uid in range(1, 11))}, verdicts=cache)
+            tested = []
+            sa._test_mail = lambda mail: tested.append(mail) or \
+                fake_test_mail(mail)
+            proc = sa.process_inbox([])
+            assert (proc.nummsg, proc.numspam) == (10, 3)
+        # The messages 1 to 3 of the second account are new:
+        assert proc.cachehits == 7
+        assert len(tested) == 3
+
+        sa._learn_mail = lambda mail, learn_type: (5, 0)
+        sa.imap.folders['Spam'] = sa.imap.folders['INBOX']
+        sa.learn('Spam', 'spam', None, [])
+        proc = sa.process_inbox([])
+        assert proc.cachehits == 0, "Forgotten after learning them."
+
+    def test_process_inbox_stamps(self):
+        """Test process_inbox trusting the X-Spam-Status headers."""
+        checker = 'X-Spam-Checker-Version: SpamAssassin 3.4.2 on {}\n'
+        status = ('X-Spam-Status: {}, score={} required=5.0 tests=FOO,\n'
+                  '\tBOO autolearn=no\n')
+        mails = {
+            1: checker.format('mx') + status.format('Yes', '7.1'),
+            2: checker.format('MX') + status.format('No', '-1.0'),
+            3: checker.format('other') + status.format('No', '-1.0'),
+            4: status.format('No', '-1.0'),
+            5: checker.format('mx') + 'X-Spam-Status: No\n',
+            6: checker.format('mx')}
+        sa = new_sa({'INBOX': dict(
+            (uid, mails[uid] + mail)
+            for uid, mail in fake_mails(mails).items())},
+            trustspamheaders='mx')
+        tested = []
+        sa._test_mail = lambda mail: tested.append(mail) or \
+            fake_test_mail(mail)
+        proc = sa.process_inbox([])
+        assert (proc.nummsg, proc.numspam, proc.stamped) == (6, 3, 2)
+        assert sorted(m['Subject'] for m in tested) == [
+            'ham 4', 'ham 5', 'spam 3', 'spam 6']
+        assert [args[0] for args in sa.imap.fetches] == ['1:6', '3:6']
+        assert sa.imap.commands == [
+            ('COPY', '1,3,6', 'INBOX.spam'),
+            ('STORE', '1,3,6', '+FLAGS.SILENT', '(\\Flagged)')]
+
+        # The body of the spams is needed to add the report:
+        sa.imap.fetches = []
+        sa.noreport = False
+        sa._feed_mail = lambda mail: (mail.as_bytes(), 0)
+        proc = sa.process_inbox([])
+        assert proc.stamped == 2
+        assert [args[0] for args in sa.imap.fetches] == ['1:6', '1,3:6']
+
+        # Old messages are scanned again:
+        sa.imap.fetches = []
+        sa.imap.internaldate -= 3601
+        proc = sa.process_inbox([])
+        assert proc.stamped == 0
+        assert [args[0] for args in sa.imap.fetches] == ['1:6', '1:6']
+
+    def test_process_inbox_keyword(self):
+        """Test process_inbox with a scan keyword."""
+        sa = new_sa({'INBOX': fake_mails(range(1, 11))}, partialrun=4,
+                    scankeyword='$IsbgScanned')
+        proc = sa.process_inbox([])
+        assert (proc.uids, proc.numspam) == ([10, 9, 8, 7], 1)
+        assert sa.imap.searches[-1] == (None, 'UNKEYWORD', '$IsbgScanned',
+                                        'SMALLER', '120000')
+        assert sa.imap.commands == [
+            ('STORE', '7:10', '+FLAGS.SILENT', '($IsbgScanned)'),
+            ('COPY', '9', 'INBOX.spam'),
+            ('STORE', '9', '+FLAGS.SILENT', '(\\Flagged)')]
+
+        # The next runs only process the messages without the keyword:
+        proc = sa.process_inbox([])
+        assert proc.uids == [6, 5, 4, 3]
+        proc = sa.process_inbox([])
+        assert proc.uids == [2, 1]
+        sa.imap.commands = []
+        proc = sa.process_inbox([])
+        assert (proc.uids, sa.imap.commands) == ([], [])
+
+    def test_learn_workers(self):
+        """Test learn with workers."""
+        for workers in [1, 4]:
+            uids = range(1, 21)
+            sa = new_sa({'Spam': fake_mails(uids, uids)}, learnthenflag=True,
+                        learnworkers=workers)
+            codes = {1: 6, 2: 98}
+            sa._learn_mail = lambda mail, learn_type: (
+                codes.get(int(mail['Subject'].split()[1]), 5), 0)
+            learn = sa.learn('Spam', 'spam', None, [])
+            assert learn.tolearn == 20
+            assert learn.learned == 18
+            assert learn.uids == list(range(20, 0, -1))
+            assert sa.imap.commands == [
+                ('STORE', '1:20', '+FLAGS.SILENT', '(\\Flagged)')]
+
+            codes[10] = 69
+            with pytest.raises(isbg.ISBGError, match="misconfigured"):
+                sa.learn('Spam', 'spam', None, [])
+
+    def test_learn_fingerprints(self, tmpdir):
+        """Test learn with a index of the learned messages."""
+        uids = range(1, 6)
+        sa = new_sa({'Spam': fake_mails(
+            uids, uids, 'Message-ID: <{1}@foo>\nSubject: {0} {1}\n\nfoo\n')},
+            learnthenflag=True, fingerprints=learned.LearnedIndex(
+                str(tmpdir.join('learned')), 'spamc'))
+        sa.imap.folders['Spam'][6] = 'Subject: spam 6\n\nfoo\n'
+        calls = []
+        sa._learn_mail = lambda mail, learn_type: calls.append(mail) or (5, 0)
+
+        learn = sa.learn('Spam', 'spam', None, [])
+        assert (learn.tolearn, learn.learned, len(calls)) == (6, 6, 6)
+        sa.fingerprints.save()
+
+        # All the folder is learned again (e.g. a new uidvalidity):
+        sa.imap.commands, sa.imap.fetches, calls[:] = ([], [], [])
+        sa.fingerprints = learned.LearnedIndex(
+            str(tmpdir.join('learned')), 'spamc')
+        learn = sa.learn('Spam', 'spam', None, [])
+        assert (learn.tolearn, learn.learned) == (6, 1)
+        assert len(calls) == 1, "Only the message without fingerprint."
+        assert sorted(learn.uids) == list(range(1, 7))
+        assert sa.imap.commands == [
+            ('STORE', '1:6', '+FLAGS.SILENT', '(\\Flagged)')]
+        assert [args[0] for args in sa.imap.fetches] == ['1:6', '6']
+
+        # As ham they are learned:
+        learn = sa.learn('Spam', 'ham', None, [])
+        assert learn.learned == 6
+
+    def test_verdict_index(self, tmpdir):
+        """Test the remap of the messages after a UIDVALIDITY change."""
+        sbg = new_isbg({'INBOX': fake_mails(
+            range(1, 11),
+            fmt='Message-ID: <{1}@foo>\nSubject: {0} {1}\n\nfoo\n'),
+            'INBOX.spam': {}}, nostats=True, verdictindex=True,
+            trackfile=str(tmpdir.join('track')))
+        sbg.imap.folders['INBOX'][11] = 'Subject: ham 11\n\nfoo\n'
+        tested = []
+
+        def test_mail(sa, mail):
+            tested.append(mail['Subject'])
+            return fake_test_mail(mail)
+
+        with mock.patch.object(spamproc.SpamAssassin, '_test_mail',
+                               test_mail):
+            proc = sbg.do_spamassassin()
+            assert (proc.nummsg, proc.numspam) == (11, 3)
+            assert len(proc.index) == 10, "11 has not Message-ID."
+            assert proc.index['<3@foo> 41'] == [3, 'spam']
+
+            # The server is migrated, the uids change and a new message:
+            sbg.imap.folders['INBOX'] = dict(
+                (uid + 100, mail)
+                for uid, mail in sbg.imap.folders['INBOX'].items())
+            sbg.imap.folders['INBOX'][200] = \
+                'Message-ID: <200@foo>\nSubject: spam 200\n\nfoo\n'
+            sbg.imap.uidvalidity = 2
+            sbg.imap.fetches, tested[:] = ([], [])
+            proc = sbg.do_spamassassin()
+        assert sorted(tested) == ['ham 11', 'spam 200']
+        assert (proc.nummsg, proc.numspam) == (2, 1)
+        assert sbg.imap.fetches[0] == (
+            '101:111,200', '(RFC822.SIZE BODY.PEEK[HEADER.FIELDS '
+            '(MESSAGE-ID)])')
+        assert list(sbg.pastuid_read(2)) == list(range(101, 112)) + [200]
+        index = sbg.index_read(2)
+        assert len(index) == 11
+        assert index['<3@foo> 41'] == [103, 'spam']
+        assert sbg.index_read(1) == {}
+
+    def test_learn_modseq(self):
+        """Test learn with CONDSTORE."""
+        uids = range(1, 6)
+        sa = new_sa({'Spam': fake_mails(uids, uids)})
+        sa.imap.capabilities.add('CONDSTORE')
+        sa._learn_mail = lambda mail, learn_type: (5, 0)
+
+        learn = sa.learn('Spam', 'spam', None, imaputils.UidSet())
+        assert learn.tolearn == 5
+        assert learn.modseq == 1
+        assert sa.imap.searches[-1] == (None, 'ALL')
+
+        # Nothing has changed, the folder is skipped:
+        pastuids = imaputils.UidSet(learn.uids)
+        learn = sa.learn('Spam', 'spam', None, pastuids, learn.modseq)
+        assert learn.tolearn == 0
+        assert learn.modseq == 1
+        assert learn.newpastuids == pastuids
+        assert len(sa.imap.searches) == 1
+
+        # Only the changed messages are searched:
+        sa.imap.folders['Spam'][6] = 'Subject: spam 6\n\nfoo\n'
+        sa.imap.modseqs.update({3: 2, 6: 3})
+        learn = sa.learn('Spam', 'spam', None, pastuids, 1)
+        assert sa.imap.searches[-1] == (None, 'MODSEQ', '2', 'ALL')
+        assert learn.uids == [6]
+        assert learn.modseq == 3
+        assert learn.newpastuids == pastuids
+
+        # Without CONDSTORE:
+        sa.imap.capabilities.clear()
+        learn = sa.learn('Spam', 'spam', None, pastuids, 3)
+        assert sa.imap.searches[-1] == (None, 'ALL')
+        assert learn.uids == [6]
+        assert learn.modseq == 0
+
+    def test_move(self):
+        """Test process_inbox and learn with UID MOVE and batches."""
+        sa = new_sa({'INBOX': fake_mails(range(1, 7), [2, 3, 5])},
+                    delete=True, expunge=True, spamflags=['\\Deleted'])
+        sa.imap.capabilities.add('MOVE')
+        proc = sa.process_inbox([])
+        assert proc.numspam == 3
+        assert sa.imap.commands == [('MOVE', '2:3,5', 'INBOX.spam')]
+
+        # Without MOVE:
+        sa.imap.capabilities.clear()
+        sa.imap.commands = []
+        proc = sa.process_inbox([])
+        assert sa.imap.commands == [
+            ('COPY', '2:3,5', 'INBOX.spam'),
+            ('STORE', '2:3,5', '+FLAGS.SILENT', '(\\Deleted)'),
+            ('EXPUNGE',)]
+
+        # Gmail:
+        sa.imap.capabilities.add('MOVE')
+        sa.imap.commands = []
+        sa.gmail, sa.spamflags = (True, [])
+        proc = sa.process_inbox([])
+        assert sa.imap.commands == [('COPY', '2:3,5', 'INBOX.spam'),
+                                    ('MOVE', '2:3,5', '[Gmail]/Trash')]
+
+        # Learn ham and move it:
+        sa.imap.folders['Ham'] = sa.imap.folders['INBOX']
+        sa.imap.commands = []
+        sa._learn_mail = lambda mail, learn_type: (5, 0)
+        learn = sa.learn('Ham', 'ham', 'INBOX', [])
+        assert learn.learned == 6
+        assert sa.imap.commands == [('MOVE', '1:6', 'INBOX')]
+
+    def test_uid_expunge(self):
+        """Test process_inbox with UIDPLUS."""
+        sa = new_sa({'INBOX': fake_mails(range(1, 7), [2, 3, 5])},
+                    noreport=False, delete=True, expunge=True,
+                    spamflags=['\\Deleted'])
+        sa.imap.capabilities.add('UIDPLUS')
+        sa._feed_mail = lambda mail: (mail, 0)
+        proc = sa.process_inbox([])
+        assert proc.numspam == 3
+        assert sa.imap.commands == [
+            ('APPEND', 'INBOX.spam'), ('APPEND', 'INBOX.spam'),
+            ('APPEND', 'INBOX.spam'),
+            ('STORE', '2:3,5', '+FLAGS.SILENT', '(\\Deleted)'),
+            ('EXPUNGE', '2:3,5')]
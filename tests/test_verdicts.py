@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_verdicts.py
+#  This file is part of isbg.
+#
+#  Copyright 2018 Carles Muñoz Gorriz <carlesmu@internautas.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Tests for verdicts.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sys
+import time
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import verdicts  # noqa: E402
+from isbg.imaputils import RawMessage, new_message  # noqa: E402
+
+BODY = (b'Buy  now\r\n  cheap pills, only today at our online pharmacy,\r\n'
+        b'with free shipping.\r\n')
+SPAM = (b'Message-ID: <1@spam>\r\nFrom: x@spam\r\nSubject: Sale\r\n'
+        b'To: a\r\n\r\n' + BODY)
+HAM = (b'Message-ID: <2@ham>\nFrom: y@ham\nSubject: Hi\n\n'
+       b'Hello, see you tomorrow at the meeting about the new project plan.\n')
+
+
+def test_mail_keys():
+    """Test mail_keys."""
+    bodyhash, messageid = verdicts.mail_keys(RawMessage(SPAM))
+    assert messageid == '<1@spam>'
+    # The other headers and the whitespace don't change the hash:
+    assert verdicts.mail_keys(new_message(
+        'From:  x@spam\nSubject: Sale\nTo: b\n\n' +
+        ' '.join(BODY.decode().split()))) == (bodyhash, None)
+    assert verdicts.mail_keys(RawMessage(
+        b'From: x@spam\nSubject:\n Sale\n\n' + BODY))[0] == bodyhash
+    # The sender and the subject do:
+    assert verdicts.mail_keys(RawMessage(
+        b'From: z@spam\nSubject: Sale\n\n' + BODY))[0] != bodyhash
+    assert verdicts.mail_keys(RawMessage(
+        b'From: x@spam\nSubject: Hi\n\n' + BODY))[0] != bodyhash
+    # The short bodies are not keyed:
+    assert verdicts.mail_keys(RawMessage(b'To: b\n\n')) == (None, None)
+    assert verdicts.mail_keys(RawMessage(
+        b'Message-ID: <3@a>\n\nThanks!\n')) == (None, '<3@a>')
+
+
+def test_verdict_cache(tmpdir):
+    """Test VerdictCache."""
+    filename = str(tmpdir.join('verdicts'))
+    cache = verdicts.VerdictCache(filename)
+    spam = RawMessage(SPAM)
+    assert cache.get(spam, 60) is None
+    cache.put(spam, "15.2/5.0\n", 1)
+    assert cache.get(spam, 60) == ("15.2/5.0\n", 1)
+    assert cache.get(spam, -1) is None, "Expired."
+
+    # The Message-ID is only used for spams:
+    assert cache.get(RawMessage(
+        b'Message-ID: <1@spam>\n\nBuy now!\n'), 60) == ("15.2/5.0\n", 1)
+    assert cache.get(RawMessage(SPAM.replace(b'<1@spam>', b'<3@spam>')),
+                     60) == ("15.2/5.0\n", 1)
+    ham = RawMessage(HAM)
+    cache.put(ham, "-1.0/5.0", 0)
+    assert cache.get(ham, 60) == ("-1.0/5.0\n", 0)
+    assert cache.get(RawMessage(b'Message-ID: <2@ham>\n\nBuy\n'), 60) is None
+
+    # A ham is only reused with the same Message-ID:
+    assert cache.get(RawMessage(HAM.replace(b'<2@ham>', b'<3@ham>')),
+                     60) is None
+    assert cache.get(RawMessage(HAM.split(b'\n', 1)[1]), 60) is None
+
+    # The short bodies are not cached:
+    short = RawMessage(b'Message-ID: <4@ham>\n\nThanks!\n')
+    cache.put(short, "-1.0/5.0", 0)
+    assert cache.get(short, 60) is None
+    assert '<4@ham>' not in cache._messageids
+
+    # It's shared with other processes through the file:
+    cache.save()
+    other = verdicts.VerdictCache(filename)
+    assert other.get(spam, 60) == ("15.2/5.0\n", 1)
+    other.forget(spam)
+    assert other.get(spam, 60) is None
+    other.put(RawMessage(b'To: b\n\n' + BODY + b'Foo\n'), "1.0/5.0", 0)
+    other.save()
+    cache.save()
+    assert len(verdicts.VerdictCache(filename)._read(filename)[0]) == 3
+
+    # The least recently used are evicted:
+    cache.max_entries = 2
+    time.sleep(0.01)
+    cache.get(spam, 60)
+    cache.save()
+    bodies, messageids = verdicts.VerdictCache._read(filename)
+    assert len(bodies) == 2
+    assert list(messageids) == ['<1@spam>']
+
+
+def test_get_cache(tmpdir):
+    """Test get_cache."""
+    filename = str(tmpdir.join('verdicts'))
+    assert verdicts.get_cache(filename) is verdicts.get_cache(filename)
+    verdicts.get_cache(filename).save()
+    assert not os.path.exists(filename), "Not used, not written."